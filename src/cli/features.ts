@@ -0,0 +1,151 @@
+import { GameComponent } from "@/gameplay/components";
+import { AbilityId } from "@/gameplay/components/abilities";
+
+// Packed per-entity features used to build observations without going
+// through the full JSON state. The layout has to match the one in
+// warlock_rl/game.py:
+// - header
+// - one row per player (in entity id order) with the PLAYER_FIELDS
+//   followed by the ABILITY_FIELDS for every requested ability
+// - one row per projectile (in entity id order)
+// Missing values (eg. lastUsedFrame of an unused ability) are NaN.
+
+export const HEADER_FIELDS = [
+  "frameNumber",
+  "deltaTime",
+  "arenaRadius",
+  "shop",
+  "stateStartFrame",
+  "round",
+  "numPlayers",
+  "numProjectiles",
+] as const;
+
+export const PLAYER_FIELDS = [
+  "entityId",
+  "owningPlayerId",
+  "x",
+  "y",
+  "vx",
+  "vy",
+  "facing",
+  "health",
+  "knockbackMultiplier",
+  "casting",
+  "moving",
+  "shielded",
+  "linked",
+  "gold",
+] as const;
+
+export const ABILITY_FIELDS = [
+  "owned",
+  "lastUsedFrame",
+  "cooldown",
+  "cost",
+] as const;
+
+export const PROJECTILE_FIELDS = [
+  "entityId",
+  "owningPlayerId",
+  "x",
+  "y",
+  "vx",
+  "vy",
+  "homing",
+  "boomerang",
+  "swap",
+  "gravity",
+  "link",
+] as const;
+
+export function getEntityFeatures(
+  components: GameComponent,
+  abilityIds: AbilityId[]
+): Float64Array {
+  const {
+    gameState,
+    arena,
+    players,
+    bodies,
+    healths,
+    units,
+    shields,
+    pulls,
+    shops,
+    abilities,
+    projectiles,
+    playerOwneds,
+  } = components;
+
+  const playerIds = Object.keys(players);
+  const projectileIds = Object.keys(projectiles);
+  const playerSize =
+    PLAYER_FIELDS.length + ABILITY_FIELDS.length * abilityIds.length;
+
+  const features = new Float64Array(
+    HEADER_FIELDS.length +
+      playerIds.length * playerSize +
+      projectileIds.length * PROJECTILE_FIELDS.length
+  );
+
+  let i = 0;
+
+  features[i++] = gameState.frameNumber;
+  features[i++] = gameState.deltaTime;
+  features[i++] = arena.radius;
+  features[i++] = gameState.state.type === "shop" ? 1 : 0;
+  features[i++] = gameState.state.startFrame;
+  features[i++] = gameState.round;
+  features[i++] = playerIds.length;
+  features[i++] = projectileIds.length;
+
+  for (const playerId of playerIds) {
+    const body = bodies[playerId];
+    const unit = units[playerId];
+    const shop = shops[playerId];
+
+    features[i++] = parseInt(playerId);
+    features[i++] = playerOwneds[playerId].owningPlayerId;
+    features[i++] = body.location.e1;
+    features[i++] = body.location.e2;
+    features[i++] = body.velocity.e1;
+    features[i++] = body.velocity.e2;
+    features[i++] = body.facing;
+    features[i++] = healths[playerId].current;
+    features[i++] = unit.knockbackMultiplier;
+    features[i++] = unit.state.type === "casting" ? 1 : 0;
+    features[i++] = unit.state.type === "moving" ? 1 : 0;
+    features[i++] = playerId in shields ? 1 : 0;
+    features[i++] = playerId in pulls ? 1 : 0;
+    features[i++] = shop.gold;
+
+    for (const abilityId of abilityIds) {
+      const ability = abilities[playerId][abilityId];
+      features[i++] = ability !== undefined ? 1 : 0;
+      features[i++] = ability?.lastUsedFrame ?? NaN;
+      features[i++] = ability?.cooldown ?? NaN;
+      features[i++] = shop.costs[abilityId] ?? NaN;
+    }
+  }
+
+  for (const projectileId of projectileIds) {
+    const body = bodies[projectileId];
+    const projectile = projectiles[projectileId];
+
+    features[i++] = parseInt(projectileId);
+    features[i++] = playerOwneds[projectileId].owningPlayerId;
+    features[i++] = body.location.e1;
+    features[i++] = body.location.e2;
+    features[i++] = body.velocity.e1;
+    features[i++] = body.velocity.e2;
+    features[i++] = projectile.homing ? 1 : 0;
+    features[i++] = projectile.boomerang ? 1 : 0;
+    features[i++] = projectile.swap ? 1 : 0;
+    features[i++] = projectile.gravity ? 1 : 0;
+    // Same as the "link" flag of the Python observations
+    features[i++] = "link" in projectile && projectile.link ? 1 : 0;
+  }
+
+  return features;
+}
@@ -1,100 +1,629 @@
+import { deepCopy } from "@/common";
 import { makeGame } from "@/gameplay";
+import { GameComponent } from "@/gameplay/components";
 import { AbilityId } from "@/gameplay/components/abilities";
 import { Order } from "@/gameplay/components/order";
-import { buyAbility } from "@/gameplay/utils/shop";
+import { getEntityFeatures } from "./features";
+import {
+  GameCommand,
+  Replay,
+  applyGameCommand,
+  makeReplay,
+  readReplay,
+  recordCommand,
+  recordFrame,
+  restoreReplayFrame,
+} from "./replay";
 
-let game: ReturnType<typeof makeGame> | undefined = undefined;
+// Every game hosted by this process with the state that belongs to it.
+// Commands select the game with their gameId, commands without one use the
+// default game.
+type Session = {
+  game: ReturnType<typeof makeGame>;
+  // Only recorded when the game was started with recordReplay
+  replay?: Replay;
+  // Serialized components as last sent in a delta, by component name and
+  // entity id ("" for singleton components)
+  sentComponents: Map<string, Map<string, string>>;
+};
+
+const DEFAULT_GAME_ID = "";
+
+const sessions = new Map<string, Session>();
+
+// Copies of game components by handle, shared by all games so a snapshot
+// of one game can be restored into others
+const snapshots = new Map<string, GameComponent>();
+
+// Part of a replay last read by replayFrame, usually read for many frames
+// in a row
+let cachedReplay: { path: string; replay: Replay } | undefined = undefined;
+
+// Milliseconds spent in each phase of handling commands since the last
+// getTimings, read by the rollout benchmark (warlock_rl/benchmark.py). Only
+// measured after the first getTimings so other clients don't pay for it.
+const timings = {
+  parse: 0,
+  simulate: 0,
+  stringify: 0,
+  features: 0,
+  write: 0,
+};
+let timingsEnabled = false;
+
+// Start time of a timed phase, undefined while timings are off
+function startTiming(): number | undefined {
+  return timingsEnabled ? performance.now() : undefined;
+}
+
+function endTiming(phase: keyof typeof timings, startTime: number | undefined) {
+  if (startTime !== undefined) {
+    timings[phase] += performance.now() - startTime;
+  }
+}
+
+function getSession(gameId?: string | null): Session {
+  const session = sessions.get(gameId ?? DEFAULT_GAME_ID);
+  if (!session) {
+    throw new Error(`Game ${gameId} not started`);
+  }
+  return session;
+}
+
+// For commands that replace all components of a game, which can also be
+// used to start a game
+function getOrMakeSession(
+  gameId: string | null | undefined,
+  deltaTime: number
+): Session {
+  let session = sessions.get(gameId ?? DEFAULT_GAME_ID);
+  if (!session) {
+    session = {
+      game: makeGame({ deltaTime, seed: 0 }),
+      sentComponents: new Map(),
+    };
+    sessions.set(gameId ?? DEFAULT_GAME_ID, session);
+  }
+  return session;
+}
+
+// Commands that change the game between steps go through here so they get
+// recorded in the replay
+function applyCommand(session: Session, command: GameCommand) {
+  applyGameCommand(session.game.components, command);
+  if (session.replay) {
+    recordCommand(session.replay, session.game.components, command);
+  }
+}
 
 export type CLICommandStartGame = {
   type: "start";
+  gameId?: string;
   seed?: number;
   deltaTime?: number;
   numPlayers: number;
   startGold?: number;
+  recordReplay?: boolean;
+  // Frames between the keyframes of the replay
+  keyframeInterval?: number | null;
+  // Recorded in the replay start
+  framesPerStep?: number | null;
 };
 
 export type CLICommandStep = {
   type: "step";
+  gameId?: string;
   steps: number;
+  // Stop before `steps` frames if the game state type changes
+  // (round over -> shop, shop over -> round)
+  stopOnStateChange?: boolean;
 };
 
 export type CLICommandSetOrder = {
   type: "setOrder";
+  gameId?: string;
   entityId: number;
   order: Order;
 };
 
 export type CLICommandSetReady = {
   type: "setReady";
+  gameId?: string;
   entityId: number;
   ready: boolean;
 };
 
 export type CLICommandBuyAbility = {
   type: "buyAbility";
+  gameId?: string;
   entityId: number;
   abilityId: AbilityId;
 };
 
 export type CLICommandGetComponents = {
   type: "getComponents";
+  gameId?: string;
+  // Only send the components that changed since the last delta
+  delta?: boolean;
+  // Only send these components, whole (not with delta)
+  componentNames?: string[] | null;
+};
+
+export type CLICommandGetEntityFeatures = {
+  type: "getEntityFeatures";
+  gameId?: string;
+  abilityIds: AbilityId[];
+};
+
+// Responds with the replay JSON and stops recording it. The client writes
+// it so the simulator doesn't stall on compression and file I/O.
+export type CLICommandGetReplay = {
+  type: "getReplay";
+  gameId?: string;
+};
+
+// Sets the game to a frame of a saved replay, starting the game if it was
+// not started yet
+export type CLICommandReplayFrame = {
+  type: "replayFrame";
+  gameId?: string;
+  path: string;
+  frame: number;
+};
+
+// Steps all the given games (all games by default) and responds with the
+// components of every game in one response, by game id. Steps can be given
+// per game in the same order as the game ids.
+export type CLICommandStepAll = {
+  type: "stepAll";
+  gameIds?: string[];
+  steps: number | number[];
+  stopOnStateChange?: boolean;
+  delta?: boolean;
+  componentNames?: string[] | null;
+};
+
+export type CLICommandCloseGame = {
+  type: "closeGame";
+  gameId?: string;
+};
+
+// Snapshot handles are chosen by the client so taking one needs no response
+export type CLICommandSnapshot = {
+  type: "snapshot";
+  gameId?: string;
+  handle: string;
+};
+
+// Replaces the state of the game with the snapshot, starting the game if
+// it was not started yet
+export type CLICommandRestore = {
+  type: "restore";
+  gameId?: string;
+  handle: string;
+};
+
+export type CLICommandReleaseSnapshot = {
+  type: "releaseSnapshot";
+  handle: string;
+};
+
+export type CLICommandPing = {
+  type: "ping";
+};
+
+// Responds with the seconds spent in each phase of handling commands since
+// the last getTimings and resets them. The first one turns the timings on
+// and responds with zeros.
+export type CLICommandGetTimings = {
+  type: "getTimings";
+};
+
+export type CLICommandBatch = {
+  type: "batch";
+  commands: CLICommand[];
 };
 
 export type CLICommand =
+  | CLICommandBatch
   | CLICommandStartGame
   | CLICommandStep
   | CLICommandSetOrder
   | CLICommandSetReady
   | CLICommandBuyAbility
-  | CLICommandGetComponents;
+  | CLICommandGetComponents
+  | CLICommandGetEntityFeatures
+  | CLICommandGetReplay
+  | CLICommandReplayFrame
+  | CLICommandStepAll
+  | CLICommandCloseGame
+  | CLICommandSnapshot
+  | CLICommandRestore
+  | CLICommandReleaseSnapshot
+  | CLICommandPing
+  | CLICommandGetTimings;
 
-for await (const line of console) {
-  const command: CLICommand = JSON.parse(line);
+const singletonComponentNames: Set<string> = new Set<keyof GameComponent>([
+  "gameState",
+  "gameEvents",
+  "arena",
+  "detectedCollisions",
+]);
 
-  switch (command.type) {
-    case "step":
-      if (!game) {
-        throw new Error("Game not started");
+// Returns the JSON of all singleton components that changed and all entity
+// components that were changed, added or removed (as null) since the last
+// delta. Components are compared by their serialized JSON.
+function serializeComponentsDelta(
+  components: GameComponent,
+  sentComponents: Map<string, Map<string, string>>
+): string {
+  const singletons: string[] = [];
+  const entities: string[] = [];
+
+  for (const [name, component] of Object.entries(components)) {
+    let sent = sentComponents.get(name);
+    const isNew = sent === undefined;
+    if (sent === undefined) {
+      sent = new Map();
+      sentComponents.set(name, sent);
+    }
+
+    if (singletonComponentNames.has(name)) {
+      const serialized = JSON.stringify(component);
+      if (serialized !== sent.get("")) {
+        sent.set("", serialized);
+        singletons.push(`${JSON.stringify(name)}:${serialized}`);
+      }
+      continue;
+    }
+
+    const changed: string[] = [];
+    for (const [entityId, entityComponent] of Object.entries(component)) {
+      const serialized = JSON.stringify(entityComponent);
+      if (serialized !== sent.get(entityId)) {
+        sent.set(entityId, serialized);
+        changed.push(`${JSON.stringify(entityId)}:${serialized}`);
       }
-      for (let i = 0; i < command.steps; i++) {
-        game.step();
+    }
+    for (const entityId of sent.keys()) {
+      if (!(entityId in component)) {
+        sent.delete(entityId);
+        changed.push(`${JSON.stringify(entityId)}:null`);
+      }
+    }
+
+    if (isNew || changed.length > 0) {
+      entities.push(`${JSON.stringify(name)}:{${changed.join(",")}}`);
+    }
+  }
+
+  return `{"singletons":{${singletons.join(",")}},"entities":{${entities.join(
+    ","
+  )}}}`;
+}
+
+function serializeComponents(
+  session: Session,
+  delta?: boolean,
+  componentNames?: string[] | null
+): string {
+  const startTime = startTiming();
+  const components: Record<string, unknown> = session.game.components;
+  const serialized = componentNames
+    ? `{${componentNames
+        .map(
+          (name) =>
+            `${JSON.stringify(name)}:${JSON.stringify(components[name])}`
+        )
+        .join(",")}}`
+    : delta
+    ? serializeComponentsDelta(session.game.components, session.sentComponents)
+    : JSON.stringify(session.game.components);
+  endTiming("stringify", startTime);
+  return serialized;
+}
+
+function stepGame(
+  session: Session,
+  steps: number,
+  stopOnStateChange?: boolean
+) {
+  const startTime = startTiming();
+  const { game } = session;
+  const startStateType = game.components.gameState.state.type;
+  for (let i = 0; i < steps; i++) {
+    game.step();
+    if (session.replay) {
+      recordFrame(session.replay, game.components);
+    }
+    if (
+      stopOnStateChange &&
+      game.components.gameState.state.type !== startStateType
+    ) {
+      break;
+    }
+  }
+  endTiming("simulate", startTime);
+}
+
+// Set in the length header of a response that is the JSON of a CLIError
+const ERROR_RESPONSE_FLAG = 0x80000000;
+
+// Commands that always write a response
+const RESPONSE_COMMAND_TYPES = new Set<CLICommand["type"]>([
+  "getComponents",
+  "getEntityFeatures",
+  "getReplay",
+  "stepAll",
+  "ping",
+  "getTimings",
+]);
+
+type CLIError = {
+  gameId: string | null;
+  message: string;
+  // Whether the error is sent in place of the command's response
+  response: boolean;
+};
+
+function errorMessage(error: unknown): string {
+  return error instanceof Error ? error.message : String(error);
+}
+
+// Every response is framed with a 4 byte little endian length header
+// so the reader knows exactly how much to read.
+function writeResponse(response: string | Uint8Array, error = false) {
+  const startTime = startTiming();
+  const length =
+    typeof response === "string"
+      ? Buffer.byteLength(response)
+      : response.byteLength;
+  const frame = Buffer.allocUnsafe(4 + length);
+  frame.writeUInt32LE(error ? length + ERROR_RESPONSE_FLAG : length, 0);
+  if (typeof response === "string") {
+    frame.write(response, 4);
+  } else {
+    frame.set(response, 4);
+  }
+  process.stdout.write(frame);
+  endTiming("write", startTime);
+}
+
+// This process hosts every game of a worker so a failed command must not
+// end it, or skip the commands after it which can belong to other games.
+// Every failed command sends one error. Commands with a response send it
+// in place of the response so every response stays paired with its
+// command, the client keeps the errors of the others for their game.
+async function handleCommandErrors(command: CLICommand) {
+  try {
+    await handleCommand(command);
+  } catch (error) {
+    writeError({
+      gameId: ("gameId" in command ? command.gameId : null) ?? null,
+      message: errorMessage(error),
+      response: RESPONSE_COMMAND_TYPES.has(command.type),
+    });
+  }
+}
+
+function writeError(error: CLIError) {
+  writeResponse(JSON.stringify(error), true);
+}
+
+async function handleCommand(command: CLICommand) {
+  switch (command.type) {
+    case "batch":
+      for (const batchCommand of command.commands) {
+        await handleCommandErrors(batchCommand);
       }
       break;
+    case "step":
+      stepGame(
+        getSession(command.gameId),
+        command.steps,
+        command.stopOnStateChange
+      );
+      break;
+    case "stepAll":
+      const gameIds = command.gameIds ?? [...sessions.keys()];
+      // A game that fails gets {"error": message} instead of its components
+      // so the other games still step
+      const stepResults = gameIds.map((gameId, i) => {
+        try {
+          const session = getSession(gameId);
+          stepGame(
+            session,
+            typeof command.steps === "number"
+              ? command.steps
+              : command.steps[i],
+            command.stopOnStateChange
+          );
+          return serializeComponents(
+            session,
+            command.delta,
+            command.componentNames
+          );
+        } catch (error) {
+          return JSON.stringify({ error: errorMessage(error) });
+        }
+      });
+      writeResponse(
+        `{${gameIds
+          .map((gameId, i) => `${JSON.stringify(gameId)}:${stepResults[i]}`)
+          .join(",")}}`
+      );
+      break;
     case "start":
-      game = makeGame({
-        deltaTime: command.deltaTime ?? 1 / 30,
+      const start = {
         seed: command.seed ?? Math.floor(1_000_000_000 * Math.random()),
-      });
+        deltaTime: command.deltaTime ?? 1 / 30,
+        numPlayers: command.numPlayers,
+        startGold: command.startGold,
+        framesPerStep: command.framesPerStep ?? undefined,
+      };
+      const game = makeGame(start);
 
       for (let i = 0; i < command.numPlayers; i++) {
         game.addPlayer(command.startGold);
       }
+
+      sessions.set(command.gameId ?? DEFAULT_GAME_ID, {
+        game,
+        replay: command.recordReplay
+          ? makeReplay(
+              start,
+              game.components,
+              command.keyframeInterval ?? undefined
+            )
+          : undefined,
+        sentComponents: new Map(),
+      });
+      break;
+    case "closeGame":
+      sessions.delete(command.gameId ?? DEFAULT_GAME_ID);
       break;
     case "setOrder":
-      if (!game) {
-        throw new Error("Game not started");
-      }
-      game.components.orders[command.entityId].order = command.order;
+      applyCommand(getSession(command.gameId), {
+        type: "setOrder",
+        entityId: command.entityId,
+        order: command.order,
+      });
       break;
     case "setReady":
-      if (!game) {
-        throw new Error("Game not started");
-      }
-      game.components.players[command.entityId].ready = command.ready;
+      applyCommand(getSession(command.gameId), {
+        type: "setReady",
+        entityId: command.entityId,
+        ready: command.ready,
+      });
       break;
     case "buyAbility":
-      if (!game) {
-        throw new Error("Game not started");
-      }
-      buyAbility(command.entityId, command.abilityId, game.components);
+      applyCommand(getSession(command.gameId), {
+        type: "buyAbility",
+        entityId: command.entityId,
+        abilityId: command.abilityId,
+      });
       break;
     case "getComponents":
-      if (!game) {
-        throw new Error("Game not started");
+      writeResponse(
+        serializeComponents(
+          getSession(command.gameId),
+          command.delta,
+          command.componentNames
+        )
+      );
+      break;
+    case "getEntityFeatures":
+      const featuresStartTime = startTiming();
+      const features = getEntityFeatures(
+        getSession(command.gameId).game.components,
+        command.abilityIds
+      );
+      endTiming("features", featuresStartTime);
+      writeResponse(
+        new Uint8Array(features.buffer, features.byteOffset, features.byteLength)
+      );
+      break;
+    case "getReplay":
+      const session = getSession(command.gameId);
+      if (!session.replay) {
+        throw new Error(`Game ${command.gameId} has no replay`);
+      }
+      writeResponse(JSON.stringify(session.replay));
+      session.replay = undefined;
+      break;
+    case "replayFrame":
+      const cachedFirstFrame =
+        cachedReplay?.replay.keyframes[0].gameState.frameNumber;
+      if (
+        cachedReplay?.path !== command.path ||
+        command.frame < cachedFirstFrame! ||
+        command.frame > cachedReplay.replay.lastFrame
+      ) {
+        cachedReplay = {
+          path: command.path,
+          replay: await readReplay(command.path, command.frame),
+        };
+      }
+
+      const replaySession = getOrMakeSession(
+        command.gameId,
+        cachedReplay.replay.start.deltaTime
+      );
+      restoreReplayFrame(
+        cachedReplay.replay,
+        replaySession.game,
+        command.frame
+      );
+      replaySession.replay = undefined;
+      replaySession.sentComponents = new Map();
+      break;
+    case "snapshot":
+      snapshots.set(
+        command.handle,
+        deepCopy(getSession(command.gameId).game.components)
+      );
+      break;
+    case "restore":
+      const snapshot = snapshots.get(command.handle);
+      if (!snapshot) {
+        throw new Error(`Snapshot ${command.handle} not found`);
+      }
+
+      const restoreSession = getOrMakeSession(
+        command.gameId,
+        snapshot.gameState.deltaTime
+      );
+
+      // The game steps the components object it was made with so it has to
+      // be updated in place
+      Object.assign(restoreSession.game.components, deepCopy(snapshot));
+      restoreSession.sentComponents = new Map();
+      // The replay continues from the restored state
+      if (restoreSession.replay) {
+        restoreSession.replay = makeReplay(
+          restoreSession.replay.start,
+          restoreSession.game.components,
+          restoreSession.replay.keyframeInterval
+        );
+      }
+      break;
+    case "releaseSnapshot":
+      snapshots.delete(command.handle);
+      break;
+    case "ping":
+      writeResponse("pong");
+      break;
+    case "getTimings":
+      writeResponse(
+        JSON.stringify(
+          Object.fromEntries(
+            Object.entries(timings).map(([phase, ms]) => [phase, ms / 1000])
+          )
+        )
+      );
+      for (const phase of Object.keys(timings) as (keyof typeof timings)[]) {
+        timings[phase] = 0;
       }
-      process.stdout.write(JSON.stringify(game.components));
+      timingsEnabled = true;
       break;
     default:
       throw new Error(`Unhandled command ${command}`);
   }
 }
+
+for await (const line of console) {
+  if (!line) {
+    continue;
+  }
+
+  let command: CLICommand;
+  try {
+    const startTime = startTiming();
+    command = JSON.parse(line);
+    endTiming("parse", startTime);
+  } catch (error) {
+    writeError({ gameId: null, message: errorMessage(error), response: false });
+    continue;
+  }
+  await handleCommandErrors(command);
+}
@@ -0,0 +1,286 @@
+import { deepCopy } from "@/common";
+import { makeGame } from "@/gameplay";
+import { GameComponent } from "@/gameplay/components";
+import { AbilityId } from "@/gameplay/components/abilities";
+import { Order } from "@/gameplay/components/order";
+import { buyAbility } from "@/gameplay/utils/shop";
+
+// Replays store how a game was started and the commands that changed it
+// between steps instead of every frame. Games are deterministic given
+// their components so any frame can be rebuilt by restoring the closest
+// keyframe before it and replaying the commands from there.
+
+export const REPLAY_VERSION = 1;
+export const DEFAULT_KEYFRAME_INTERVAL = 300;
+
+type Game = ReturnType<typeof makeGame>;
+
+// Commands that change a game between steps
+export type GameCommand =
+  | { type: "setOrder"; entityId: number; order: Order }
+  | { type: "setReady"; entityId: number; ready: boolean }
+  | { type: "buyAbility"; entityId: number; abilityId: AbilityId };
+
+export type ReplayStart = {
+  seed: number;
+  deltaTime: number;
+  numPlayers: number;
+  startGold?: number;
+  // Frames the client stepped per action, only recorded for readers of the
+  // replay
+  framesPerStep?: number;
+};
+
+export type Replay = {
+  version: typeof REPLAY_VERSION;
+  start: ReplayStart;
+  keyframeInterval: number;
+  // Components every keyframeInterval frames, always including the first
+  // frame of the replay
+  keyframes: GameComponent[];
+  // Commands in the order they were applied, with the frame they were
+  // applied on (before stepping it)
+  commands: { frame: number; command: GameCommand }[];
+  lastFrame: number;
+  // Player entity ids that won each round that ended, for the replay
+  // catalog
+  roundWinners: number[][];
+};
+
+export function applyGameCommand(
+  components: GameComponent,
+  command: GameCommand
+) {
+  switch (command.type) {
+    case "setOrder":
+      components.orders[command.entityId].order = command.order;
+      break;
+    case "setReady":
+      components.players[command.entityId].ready = command.ready;
+      break;
+    case "buyAbility":
+      buyAbility(command.entityId, command.abilityId, components);
+      break;
+  }
+}
+
+export function makeReplay(
+  start: ReplayStart,
+  components: GameComponent,
+  keyframeInterval: number = DEFAULT_KEYFRAME_INTERVAL
+): Replay {
+  return {
+    version: REPLAY_VERSION,
+    start,
+    keyframeInterval,
+    keyframes: [deepCopy(components)],
+    commands: [],
+    lastFrame: components.gameState.frameNumber,
+    roundWinners: [],
+  };
+}
+
+export function recordCommand(
+  replay: Replay,
+  components: GameComponent,
+  command: GameCommand
+) {
+  replay.commands.push({ frame: components.gameState.frameNumber, command });
+}
+
+// Has to be called after every step
+export function recordFrame(replay: Replay, components: GameComponent) {
+  const { frameNumber } = components.gameState;
+  replay.lastFrame = frameNumber;
+  for (const event of components.gameEvents.events) {
+    if (event.type === "roundOver") {
+      replay.roundWinners.push(event.winners);
+    }
+  }
+  if (frameNumber % replay.keyframeInterval === 0) {
+    replay.keyframes.push(deepCopy(components));
+  }
+}
+
+export function makeReplayGame(replay: Replay): Game {
+  return makeGame({
+    deltaTime: replay.start.deltaTime,
+    seed: replay.start.seed,
+  });
+}
+
+// Index of the first command applied on or after the frame
+function findCommandIndex(replay: Replay, frame: number): number {
+  let low = 0;
+  let high = replay.commands.length;
+  while (low < high) {
+    const middle = (low + high) >> 1;
+    if (replay.commands[middle].frame < frame) {
+      low = middle + 1;
+    } else {
+      high = middle;
+    }
+  }
+  return low;
+}
+
+// Steps the game to the frame, applying the commands of every frame before
+// stepping it
+function playReplay(
+  replay: Replay,
+  game: Game,
+  frame: number,
+  commandIndex: number,
+  onFrame?: (components: GameComponent) => void
+) {
+  const { components } = game;
+  while (components.gameState.frameNumber < frame) {
+    while (
+      commandIndex < replay.commands.length &&
+      replay.commands[commandIndex].frame === components.gameState.frameNumber
+    ) {
+      applyGameCommand(components, replay.commands[commandIndex].command);
+      commandIndex++;
+    }
+    game.step();
+    onFrame?.(components);
+  }
+}
+
+// Sets the components of the game to the ones at the frame of the replay
+export function restoreReplayFrame(replay: Replay, game: Game, frame: number) {
+  const { keyframes } = replay;
+  const firstFrame = keyframes[0].gameState.frameNumber;
+  if (frame < firstFrame || frame > replay.lastFrame) {
+    throw new Error(
+      `Frame ${frame} not in replay (${firstFrame} to ${replay.lastFrame})`
+    );
+  }
+
+  let keyframe = keyframes[0];
+  for (const candidate of keyframes) {
+    if (candidate.gameState.frameNumber > frame) {
+      break;
+    }
+    keyframe = candidate;
+  }
+
+  // The game steps the components object it was made with so it has to be
+  // updated in place
+  Object.assign(game.components, deepCopy(keyframe));
+  playReplay(
+    replay,
+    game,
+    frame,
+    findCommandIndex(replay, keyframe.gameState.frameNumber)
+  );
+}
+
+// Every frame of the replay like the history of the game
+export function rebuildReplayFrames(replay: Replay): GameComponent[] {
+  const game = makeReplayGame(replay);
+  Object.assign(game.components, deepCopy(replay.keyframes[0]));
+
+  const frames = [deepCopy(game.components)];
+  playReplay(replay, game, replay.lastFrame, 0, (components) =>
+    frames.push(deepCopy(components))
+  );
+  return frames;
+}
+
+// Replays are saved in a container of independently compressed blocks,
+// each with a keyframe and the commands up to the next block. The layout
+// has to match warlock_rl/replay_file.py:
+// - header: magic and version
+// - blocks: gzipped JSON ReplayBlock
+// - index: JSON ReplayIndex
+// - trailer: index size (uint32 LE) and magic
+
+const REPLAY_FILE_MAGIC = "WRPL";
+const REPLAY_FILE_VERSION = 1;
+const REPLAY_INDEX_MAGIC = "WRPI";
+const REPLAY_FILE_HEADER_SIZE = 8;
+const REPLAY_FILE_TRAILER_SIZE = 8;
+
+type ReplayBlock = {
+  keyframe: GameComponent;
+  commands: Replay["commands"];
+};
+
+export type ReplayIndex = {
+  start: ReplayStart;
+  keyframeInterval: number;
+  lastFrame: number;
+  roundWinners?: number[][];
+  blocks: { offset: number; size: number; firstFrame: number }[];
+};
+
+export async function readReplayIndex(path: string): Promise<ReplayIndex> {
+  const file = Bun.file(path);
+  const decoder = new TextDecoder();
+
+  const header = new DataView(
+    await file.slice(0, REPLAY_FILE_HEADER_SIZE).arrayBuffer()
+  );
+  const trailer = new DataView(
+    await file.slice(file.size - REPLAY_FILE_TRAILER_SIZE).arrayBuffer()
+  );
+  if (
+    decoder.decode(header.buffer.slice(0, 4)) !== REPLAY_FILE_MAGIC ||
+    header.getUint32(4, true) !== REPLAY_FILE_VERSION ||
+    decoder.decode(trailer.buffer.slice(4, 8)) !== REPLAY_INDEX_MAGIC
+  ) {
+    throw new Error(`${path} is not a version ${REPLAY_FILE_VERSION} replay`);
+  }
+
+  const indexEnd = file.size - REPLAY_FILE_TRAILER_SIZE;
+  return JSON.parse(
+    await file.slice(indexEnd - trailer.getUint32(0, true), indexEnd).text()
+  ) as ReplayIndex;
+}
+
+async function readReplayBlock(
+  path: string,
+  index: ReplayIndex,
+  blockIndex: number
+): Promise<ReplayBlock> {
+  const { offset, size } = index.blocks[blockIndex];
+  const data = await Bun.file(path)
+    .slice(offset, offset + size)
+    .arrayBuffer();
+  return JSON.parse(
+    new TextDecoder().decode(Bun.gunzipSync(new Uint8Array(data)))
+  ) as ReplayBlock;
+}
+
+// Reads the replay or only the part of it with the frame, which only
+// decompresses the block the frame is in
+export async function readReplay(
+  path: string,
+  frame?: number
+): Promise<Replay> {
+  const index = await readReplayIndex(path);
+
+  let blockIndices = index.blocks.map((_, i) => i);
+  let lastFrame = index.lastFrame;
+  if (frame !== undefined) {
+    const blockIndex = index.blocks.findLastIndex(
+      (block) => block.firstFrame <= frame
+    );
+    blockIndices = [Math.max(blockIndex, 0)];
+    lastFrame = index.blocks[blockIndex + 1]?.firstFrame ?? index.lastFrame;
+  }
+
+  const blocks = await Promise.all(
+    blockIndices.map((i) => readReplayBlock(path, index, i))
+  );
+  return {
+    version: REPLAY_VERSION,
+    start: index.start,
+    keyframeInterval: index.keyframeInterval,
+    keyframes: blocks.map((block) => block.keyframe),
+    commands: blocks.flatMap((block) => block.commands),
+    lastFrame,
+    roundWinners: index.roundWinners ?? [],
+  };
+}
@@ -1,10 +1,12 @@
 import { Router } from "@stricjs/router";
 import { dir } from "@stricjs/utils";
 import { sleep } from "bun";
+import { Database } from "bun:sqlite";
 import fs from "fs/promises";
+import { readReplay, rebuildReplayFrames } from "./cli/replay";
 import { GameComponent } from "./gameplay/components";
 
-async function readReplay(path: string): Promise<GameComponent[]> {
+async function readStateHistory(path: string): Promise<GameComponent[]> {
   const retries = 5; // sometimes the file isn't completely written yet
   for (let i = 0; i < retries; i++) {
     try {
@@ -29,18 +31,118 @@ async function readReplay(path: string): Promise<GameComponent[]> {
 }
 
 const LOG_DIR = "./logs/"; //"/mnt/e/warlock_rl_logs/logs/";
+const CATALOG_PATH = LOG_DIR + "catalog.sqlite3";
+const MAX_CATALOG_ENTRIES = 100;
+
+type CatalogEntry = {
+  name: string;
+  game_id: string;
+  timestamp: number;
+  path: string;
+  seed: number | null;
+  num_players: number | null;
+  num_frames: number | null;
+  num_rounds: number | null;
+  winners: number[];
+};
+
+let catalog: Database | undefined = undefined;
+
+// Index of the logged games, see warlock_rl/catalog.py. Doesn't exist
+// until the first game is logged.
+async function getCatalog(): Promise<Database | undefined> {
+  if (!catalog && (await Bun.file(CATALOG_PATH).exists())) {
+    catalog = new Database(CATALOG_PATH, { readonly: true });
+  }
+  return catalog;
+}
+
+async function findGames(
+  winner: number | null,
+  seed: number | null,
+  limit: number
+): Promise<CatalogEntry[]> {
+  const db = await getCatalog();
+  if (!db) {
+    return [];
+  }
+
+  let query = "SELECT games.* FROM games";
+  const conditions: string[] = [];
+  const parameters: number[] = [];
+  if (winner !== null) {
+    query += " JOIN game_winners USING (name, timestamp)";
+    conditions.push("game_winners.player_id = ?");
+    parameters.push(winner);
+  }
+  if (seed !== null) {
+    conditions.push("games.seed = ?");
+    parameters.push(seed);
+  }
+  if (conditions.length > 0) {
+    query += " WHERE " + conditions.join(" AND ");
+  }
+  query += " ORDER BY games.timestamp DESC LIMIT ?";
+  parameters.push(limit);
+
+  const rows = db.query(query).all(...parameters) as (Omit<
+    CatalogEntry,
+    "winners"
+  > & { winners: string })[];
+  return rows.map((row) => ({ ...row, winners: JSON.parse(row.winners) }));
+}
+
+function parseNumberParam(params: URLSearchParams, name: string) {
+  const value = params.get(name);
+  return value === null ? null : parseInt(value);
+}
+
+function jsonResponse(value: unknown): Response {
+  return new Response(JSON.stringify(value), {
+    headers: { "Content-Type": "application/json" },
+  });
+}
 
 export default new Router()
   .get("/replay", async () => {
-    const names = await fs.readdir(LOG_DIR);
-    names.sort();
-    const replayName = names[names.length - 1];
+    const [latest] = await findGames(null, null, 1);
+    if (latest) {
+      return jsonResponse({ name: latest.name });
+    }
 
-    return new Response(JSON.stringify({ name: replayName }), {
-      headers: { "Content-Type": "application/json" },
-    });
+    // Logs from before the catalog
+    const names = (await fs.readdir(LOG_DIR)).filter((name) =>
+      /^\d+_/.test(name)
+    );
+    names.sort();
+    return jsonResponse({ name: names[names.length - 1] });
+  })
+  .get("/replays", async (ctx) => {
+    // Newest logged games, optionally only ones won by a player or with a
+    // seed: /replays?winner=1000&seed=0&limit=10
+    const params = new URL(ctx.url).searchParams;
+    return jsonResponse(
+      await findGames(
+        parseNumberParam(params, "winner"),
+        parseNumberParam(params, "seed"),
+        Math.min(
+          parseNumberParam(params, "limit") ?? MAX_CATALOG_ENTRIES,
+          MAX_CATALOG_ENTRIES
+        )
+      )
+    );
   })
   .get("/replay/*", async (ctx) => {
+    // Replays only store the commands, the frames are rebuilt here
+    const replayPath = LOG_DIR + ctx.params["*"] + "/replay.wrp";
+    if (await Bun.file(replayPath).exists()) {
+      return new Response(
+        JSON.stringify(rebuildReplayFrames(await readReplay(replayPath))),
+        { headers: { "Content-Type": "application/json" } }
+      );
+    }
+
+    // Older logs have the full state of every frame
     let path = LOG_DIR + ctx.params["*"] + "/state_history.json";
 
     if (!(await Bun.file(path).exists())) {
@@ -50,7 +152,7 @@ export default new Router()
       return new Response("Replay not found", { status: 404 });
     }
 
-    return new Response(JSON.stringify(await readReplay(path)), {
+    return new Response(JSON.stringify(await readStateHistory(path)), {
       headers: { "Content-Type": "application/json" },
     });
   })
@@ -0,0 +1,60 @@
+import pytest
+
+import warlock_rl.game
+from warlock_rl.benchmark import (
+    PHASES,
+    Scenario,
+    find_regressions,
+    make_scenarios,
+    run_scenario,
+)
+from warlock_rl.envs import NUM_PLAYERS
+
+
+def test_make_scenarios():
+    scenarios = make_scenarios(
+        ["game", "env"], ["random", "scripted"], [2, 8], [6], [0, 1]
+    )
+    # Random and two shoot rates for each game player count, env only has
+    # NUM_PLAYERS
+    assert len(scenarios) == 3 * 2 + 3
+    assert {
+        scenario.num_players for scenario in scenarios if scenario.target == "env"
+    } == {NUM_PLAYERS}
+    assert len({scenario.name for scenario in scenarios}) == len(scenarios)
+
+
+def test_run_scenario():
+    json_module = warlock_rl.game.json
+    for scenario in [
+        Scenario("game", "scripted", 2, 6, 1.0),
+        Scenario("env", "random", NUM_PLAYERS, 6),
+    ]:
+        result = run_scenario(scenario, steps=20, warmup_steps=5)
+        assert result["name"] == scenario.name
+        assert result["steps"] == 20
+        assert result["frames"] > 20
+        assert set(result["phases"]) == set(PHASES)
+        for phase in ["encode", "write", "read", "parse", "mask", "simulate"]:
+            assert result["phases"][phase] > 0, phase
+    # The hot path is restored
+    assert warlock_rl.game.json is json_module
+
+    with pytest.raises(ValueError):
+        run_scenario(Scenario("game", "random", 2, 6), steps=0)
+
+
+def test_find_regressions():
+    def benchmark(steps_per_second: dict[str, float]) -> dict:
+        return {
+            "results": [
+                {"name": name, "steps_per_second": value}
+                for name, value in steps_per_second.items()
+            ]
+        }
+
+    baseline = benchmark({"a": 1000, "b": 1000, "c": 1000})
+    assert find_regressions(benchmark({"a": 950, "b": 1200, "d": 1}), baseline) == []
+    regressions = find_regressions(benchmark({"a": 800, "b": 1000}), baseline)
+    assert len(regressions) == 1
+    assert regressions[0].startswith("a:")
@@ -0,0 +1,67 @@
+from warlock_rl.catalog import ReplayCatalog, game_winners
+from warlock_rl.replay_file import write_replay_file
+
+
+def make_replay(seed: int, round_winners: list[list[int]]) -> dict:
+    return {
+        "start": {"seed": seed, "numPlayers": 2},
+        "keyframeInterval": 300,
+        "keyframes": [{"gameState": {"frameNumber": 0}}],
+        "commands": [],
+        "lastFrame": 100,
+        "roundWinners": round_winners,
+    }
+
+
+def test_game_winners():
+    assert game_winners([]) == []
+    assert game_winners([[1000], [1001], [1000]]) == [1000]
+    assert game_winners([[1000], [1001], []]) == [1000, 1001]
+
+
+def test_catalog(tmp_path):
+    with ReplayCatalog(str(tmp_path)) as catalog:
+        assert catalog.latest() is None
+
+        catalog.add(str(tmp_path / "3_c" / "replay.wrp"), make_replay(1, [[1001]]))
+        catalog.add(str(tmp_path / "1_a" / "replay.wrp"), make_replay(0, [[1000]]))
+        catalog.add(
+            str(tmp_path / "2_b" / "replay.wrp"), make_replay(0, [[1000], [1001]])
+        )
+
+        latest = catalog.latest()
+        assert latest.name == "3_c"
+        assert latest.game_id == "c"
+        assert latest.timestamp == 3
+        assert latest.path == "3_c/replay.wrp"
+        assert latest.seed == 1
+        assert latest.num_frames == 100
+        assert latest.num_rounds == 1
+        assert latest.winners == [1001]
+
+        assert catalog.get("a").winners == [1000]
+        assert [entry.name for entry in catalog.find(winner=1000)] == ["2_b", "1_a"]
+        assert [entry.name for entry in catalog.find(winner=1001, seed=0)] == ["2_b"]
+        assert [entry.name for entry in catalog.find(limit=2)] == ["3_c", "2_b"]
+
+        # Adding again replaces the game
+        catalog.add(str(tmp_path / "1_a" / "replay.wrp"), make_replay(0, [[1001]]))
+        assert len(catalog) == 3
+        assert [entry.name for entry in catalog.find(winner=1000)] == ["2_b"]
+
+
+def test_index_logs(tmp_path):
+    (tmp_path / "1_a").mkdir()
+    (tmp_path / "1_a" / "state_history.json.gz").write_bytes(b"")
+    (tmp_path / "2_b").mkdir()
+    write_replay_file(str(tmp_path / "2_b" / "replay.wrp"), make_replay(0, [[1000]]))
+    (tmp_path / "3_c").mkdir()
+
+    with ReplayCatalog(str(tmp_path)) as catalog:
+        assert catalog.index_logs() == 2
+        assert catalog.index_logs() == 0
+
+        assert catalog.latest().name == "2_b"
+        assert catalog.latest().winners == [1000]
+        assert catalog.get("a").path == "1_a/state_history.json.gz"
+        assert catalog.get("a").seed is None
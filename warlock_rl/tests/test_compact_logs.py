@@ -0,0 +1,77 @@
+import gzip
+import json
+import lzma
+
+from warlock_rl.compact_logs import MANIFEST_FILE_NAME, compact_logs
+from warlock_rl.replay import load_replay
+
+
+def make_logs(log_dir):
+    replay = {
+        "start": {"seed": 0},
+        "keyframeInterval": 300,
+        "keyframes": [{"gameState": {"frameNumber": 0}}],
+        "commands": [],
+        "lastFrame": 0,
+    }
+    for i in range(3):
+        game_dir = log_dir / f"{i}_game"
+        game_dir.mkdir(parents=True)
+        (game_dir / "state_history.json").write_text(json.dumps([{"frame": i}]))
+    with gzip.open(log_dir / "0_game" / "replay.json.gz", "wt") as replay_file:
+        json.dump(replay, replay_file)
+
+
+def test_compact_logs(tmp_path):
+    make_logs(tmp_path)
+
+    stats = compact_logs(str(tmp_path), replays=True, num_workers=2)
+    assert stats["num_compacted"] == 4
+    assert stats["num_failed"] == 0
+    for i in range(3):
+        game_dir = tmp_path / f"{i}_game"
+        assert not (game_dir / "state_history.json").exists()
+        with gzip.open(game_dir / "state_history.json.gz", "rt") as log_file:
+            assert json.load(log_file) == [{"frame": i}]
+    assert not (tmp_path / "0_game" / "replay.json.gz").exists()
+    assert load_replay(str(tmp_path / "0_game" / "replay.wrp"))["lastFrame"] == 0
+    assert not list(tmp_path.glob("**/*.tmp"))
+
+    # Recompressed with a different codec
+    stats = compact_logs(str(tmp_path), codec="xz", num_workers=2)
+    assert stats["num_compacted"] == 3
+    with lzma.open(tmp_path / "1_game" / "state_history.json.xz", "rt") as log_file:
+        assert json.load(log_file) == [{"frame": 1}]
+
+
+def test_compact_logs_skips_compacted(tmp_path):
+    make_logs(tmp_path)
+
+    stats = compact_logs(str(tmp_path), keep=True, num_workers=2)
+    assert stats["num_compacted"] == 3
+    assert (tmp_path / "0_game" / "state_history.json").exists()
+
+    stats = compact_logs(str(tmp_path), keep=True, num_workers=2)
+    assert stats["num_compacted"] == 0
+    assert stats["num_skipped"] == 3
+
+    # Changed files get compacted again
+    (tmp_path / "2_game" / "state_history.json").write_text("[]")
+    stats = compact_logs(str(tmp_path), keep=True, num_workers=2)
+    assert stats["num_compacted"] == 1
+    assert len((tmp_path / MANIFEST_FILE_NAME).read_text().splitlines()) == 4
+
+
+def test_compact_logs_truncated(tmp_path):
+    make_logs(tmp_path)
+    compact_logs(str(tmp_path), num_workers=2)
+    # A gzip log cut off by a killed run
+    path = tmp_path / "1_game" / "state_history.json.gz"
+    path.write_bytes(path.read_bytes()[:-8])
+
+    stats = compact_logs(str(tmp_path), codec="xz", num_workers=2)
+    # The other state histories and the replay JSON
+    assert stats["num_compacted"] == 3
+    assert stats["num_failed"] == 1
+    assert path.exists()
+    assert not list(tmp_path.glob("**/*.tmp"))
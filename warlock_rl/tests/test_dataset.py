@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+import pytest
+
+import warlock_rl.dataset
+import warlock_rl.envs
+from warlock_rl.catalog import ReplayCatalog
+from warlock_rl.dataset import (
+    DATASET_FILE_NAME,
+    export_dataset,
+    load_dataset,
+    order_to_action,
+)
+from warlock_rl.envs import (
+    ABILITY_IDS,
+    ACTION_ORDER_TEMPLATES,
+    FRAMES_PER_STEP,
+    MOVE_ACTION_TYPE,
+    UNTARGETED_ABILITY_IDS,
+    WarlockEnv,
+    action_to_order,
+    index_to_entity_id,
+)
+from test_obs import random_actions
+
+
+def test_order_to_action():
+    # Every action type but "nothing", which has no order
+    for action_type in range(1, len(ACTION_ORDER_TEMPLATES)):
+        action = {
+            "action_type": action_type,
+            "move_target_location": [0.25, 0.75],
+            "cast_target_location": [0.5, 0.125],
+        }
+        order = action_to_order(set(ABILITY_IDS), action)
+        decoded_type, target = order_to_action(order)
+        assert decoded_type == action_type
+        if action_type == MOVE_ACTION_TYPE:
+            assert np.allclose(target, [0.25, 0.75])
+        elif action_type < MOVE_ACTION_TYPE or (
+            ABILITY_IDS[action_type - 3] in UNTARGETED_ABILITY_IDS
+        ):
+            assert np.isnan(target).all()
+        else:
+            assert np.allclose(target, [0.5, 0.125])
+
+
+@pytest.mark.parametrize("frames_per_step", [FRAMES_PER_STEP, 4])
+def test_export_dataset(tmp_path, monkeypatch, frames_per_step):
+    (tmp_path / "cwd").mkdir()
+    monkeypatch.chdir(tmp_path / "cwd")
+    # Log every game
+    monkeypatch.setattr(warlock_rl.envs.np.random, "random", lambda: 0.0)
+
+    # The start gold is random
+    np.random.seed(0)
+
+    env = WarlockEnv({"frames_per_step": frames_per_step})
+    rng = np.random.default_rng(0)
+    obs, _ = env.reset(seed=0)
+    # Observations and sent actions of the round steps by (frame, player),
+    # played until the round is over
+    steps = {}
+    rewards = {}
+    while not rewards:
+        actions = random_actions(obs, rng)
+        if not env.shopping:
+            view = env._game.view
+            for player_index, action in actions.items():
+                order = action_to_order(
+                    view.abilities[index_to_entity_id[player_index]], action
+                )
+                steps[view.frame, player_index] = (
+                    obs[player_index],
+                    0 if order is None else action["action_type"],
+                )
+        obs, reward, terminated, _, _ = env.step(actions)
+        if terminated["__all__"]:
+            rewards = {i: reward[i] for i in range(env.num_players) if i in reward}
+    # Logs the game, the next one isn't logged when closing
+    env.reset()
+    env.close()
+
+    stats = export_dataset(
+        str(tmp_path / "dataset"), log_dir=str(tmp_path / "logs"), num_workers=1
+    )
+    assert stats["num_games"] == 1
+    (shard,) = load_dataset(str(tmp_path / "dataset"))
+    assert isinstance(shard["obs"], np.memmap)
+
+    assert len(shard["obs"]) == len(steps)
+    assert (shard["game"] == 0).all()
+    for row in range(len(shard["obs"])):
+        obs, action_type = steps[int(shard["frame"][row]), int(shard["player"][row])]
+        assert np.array_equal(shard["obs"][row], obs["obs"])
+        assert np.array_equal(shard["action_mask"][row], obs["action_mask"])
+        assert shard["action_type"][row] == action_type
+
+    # The last steps of players that died before the round was over are
+    # done too
+    done_rewards = {
+        int(shard["player"][row]): shard["reward"][row]
+        for row in np.flatnonzero(shard["done"])
+    }
+    assert len(done_rewards) == env.num_players
+    for player_index, reward in done_rewards.items():
+        assert reward == rewards.get(player_index, 0)
+
+    # A corrupt log is left out without failing the other games of its shard
+    broken_path = tmp_path / "logs" / "0_broken" / "state_history.json.gz"
+    broken_path.parent.mkdir()
+    broken_path.write_bytes(b"not gzip")
+    with ReplayCatalog(str(tmp_path / "logs")) as catalog:
+        catalog.add(str(broken_path))
+    dataset_dir = tmp_path / "dataset_with_broken"
+    stats = export_dataset(
+        str(dataset_dir), log_dir=str(tmp_path / "logs"), num_workers=1
+    )
+    assert stats["num_games"] == 1
+    assert stats["num_failed_games"] == 1
+    assert stats["num_failed_shards"] == 0
+    (shard,) = load_dataset(str(dataset_dir))
+    assert len(shard["obs"]) == len(steps)
+    assert (shard["game"] == 0).all()
+
+    # A failed shard leaves nothing behind, also not the shard of the last
+    # export. The workers are forked so they write with the patched save.
+    def failing_save(path, array):
+        open(path, "wb").close()
+        raise OSError("Disk full")
+
+    monkeypatch.setattr(warlock_rl.dataset.np, "save", failing_save)
+    stats = export_dataset(
+        str(dataset_dir), log_dir=str(tmp_path / "logs"), num_workers=1
+    )
+    assert stats["num_failed_shards"] == 1
+    assert stats["num_failed_games"] == 2
+    assert sorted(os.listdir(dataset_dir)) == [DATASET_FILE_NAME]
@@ -1,8 +1,20 @@
+import glob
 import math
+import os
 
+import numpy as np
 import pytest
 
-from warlock_rl.game import Game
+from warlock_rl.catalog import ReplayCatalog
+from warlock_rl.game import (
+    Game,
+    Simulator,
+    SimulatorCommandError,
+    StateView,
+    StepAllError,
+    step_all,
+)
+from warlock_rl.replay import ReplayReader, load_replay
 
 
 @pytest.fixture
@@ -184,3 +196,323 @@ def test_stop_scourge(game: Game):
             steps=1,
         )
     assert game.state["healths"][player_id]["current"] == 100, str(game.state)
+
+
+def test_step_multiple_frames(game: Game):
+    frame_number = game.state["gameState"]["frameNumber"]
+    game.step(steps=6)
+    assert game.state["gameState"]["frameNumber"] == frame_number + 6
+
+
+def test_step_stop_on_state_change(shop_game: Game):
+    for player_id in shop_game.state["players"].keys():
+        shop_game.set_ready(int(player_id), True)
+    shop_game.step(steps=6, stop_on_state_change=True)
+    assert shop_game.state["gameState"]["state"]["type"] == "round"
+    assert shop_game.state["gameState"]["frameNumber"] == 1
+
+
+def test_view(shop_game: Game):
+    view = shop_game.view
+    assert view.shopping
+    assert view.frame == shop_game.state["gameState"]["frameNumber"]
+    assert view.player_ids == list(shop_game.state["players"].keys())
+    # Cached until the next read of the state
+    assert shop_game.view is view
+
+    for player_id in view.player_ids:
+        shop_game.set_ready(int(player_id), True)
+    shop_game.step(steps=1)
+    assert shop_game.view is not view
+    assert not shop_game.view.shopping
+    assert shop_game.view.frame == view.frame + 1
+
+
+def test_log_game(shop_game: Game, tmp_path, monkeypatch):
+    # Games are logged to ../logs
+    (tmp_path / "cwd").mkdir()
+    monkeypatch.chdir(tmp_path / "cwd")
+    shop_game.start(num_players=1, seed=0, logging=True)
+    shop_game.step(steps=3)
+    assert shop_game.log_game()
+    # Closing waits for the replay to be written
+    shop_game.close()
+
+    (log_path,) = glob.glob(str(tmp_path / "logs" / "*" / "replay.wrp"))
+    replay = load_replay(log_path)
+    assert replay["start"]["seed"] == 0
+    assert replay["keyframes"][0]["gameState"]["frameNumber"] == 0
+    assert replay["lastFrame"] == 3
+
+    with ReplayCatalog(str(tmp_path / "logs")) as catalog:
+        assert catalog.latest().path == os.path.relpath(log_path, tmp_path / "logs")
+        assert catalog.latest().seed == 0
+
+
+def test_read_large_state(game: Game):
+    # Force a response larger than the initial read buffer
+    game.simulator._read_buffer = bytearray(16)
+    game.step(steps=1)
+    assert len(game.simulator._read_buffer) > 16
+    assert game.state["gameState"]["state"]["type"] == "round"
+
+
+def test_batched_commands(game: Game, monkeypatch):
+    writes = []
+
+    class RecordingStdin:
+        def __init__(self, stdin):
+            self._stdin = stdin
+
+        def write(self, data: bytes):
+            writes.append(data)
+            return self._stdin.write(data)
+
+    process = game.simulator._process
+    monkeypatch.setattr(process, "stdin", RecordingStdin(process.stdin))
+
+    player_id = list(game.state["players"].keys())[0]
+    game.order(
+        entity_id=player_id,
+        order={"type": "move", "target": {"e1": 100, "e2": 100}},
+    )
+    game.set_ready(int(player_id), True)
+    game.step(steps=2)
+
+    assert len(writes) == 1
+    assert game.state["units"][player_id]["state"]["type"] == "moving"
+    assert game.state["players"][player_id]["ready"]
+
+
+def test_delta_state():
+    full_game = Game()
+    delta_game = Game(delta_state=True)
+
+    for game in [full_game, delta_game]:
+        game.start(num_players=2, seed=0)
+        for player_id in game.state["players"].keys():
+            game.set_ready(int(player_id), True)
+        game.step(1)
+
+    # Shoot every 40 frames so projectiles get added and removed
+    for i in range(200):
+        assert delta_game.state == full_game.state
+        for game in [full_game, delta_game]:
+            if i % 40 == 0:
+                game.order(
+                    entity_id=1000,
+                    order={
+                        "type": "useAbility",
+                        "abilityId": "shoot",
+                        "target": {"e1": -100, "e2": -100},
+                    },
+                )
+            game.step(steps=1)
+
+    assert delta_game.state == full_game.state
+
+
+def test_lazy_state():
+    full_game = Game(feature_ability_ids=["shoot", "teleport"])
+    lazy_game = Game(feature_ability_ids=["shoot", "teleport"], lazy_state=True)
+
+    for game in [full_game, lazy_game]:
+        game.start(num_players=2, seed=0)
+        for player_id in game.view.player_ids:
+            game.set_ready(int(player_id), True)
+        game.step(1)
+
+    for i in range(100):
+        # Only read every few steps
+        if i % 10 == 0:
+            assert lazy_game.state == full_game.state
+        for name in StateView.__slots__:
+            if name != "abilities":
+                assert getattr(lazy_game.view, name) == getattr(full_game.view, name)
+        # Only the abilities in the features are known
+        for player_id, abilities in full_game.view.abilities.items():
+            assert lazy_game.view.abilities[player_id] == {
+                ability_id
+                for ability_id in abilities
+                if ability_id in ["shoot", "teleport"]
+            }
+        for game in [full_game, lazy_game]:
+            shoot(game, i)
+            game.step(steps=2)
+
+
+@pytest.mark.parametrize(
+    "delta_state,lazy_state", [(False, False), (True, False), (False, True)]
+)
+def test_step_all(delta_state: bool, lazy_state: bool):
+    # Games hosted by one simulator stepped together match separate games
+    simulator = Simulator()
+    hosted_games = [
+        Game(
+            simulator,
+            delta_state=delta_state,
+            feature_ability_ids=["shoot"],
+            lazy_state=lazy_state,
+        )
+        for _ in range(3)
+    ]
+    separate_games = [
+        Game(
+            delta_state=delta_state,
+            feature_ability_ids=["shoot"],
+            lazy_state=lazy_state,
+        )
+        for _ in range(3)
+    ]
+
+    for seed, games in enumerate(zip(hosted_games, separate_games)):
+        for game in games:
+            game.start(num_players=2, seed=seed)
+            for player_id in game.state["players"].keys():
+                game.set_ready(int(player_id), True)
+
+    for i in range(100):
+        if i % 30 == 0:
+            for game in [hosted_games[0], separate_games[0]]:
+                game.order(
+                    entity_id=1000,
+                    order={
+                        "type": "useAbility",
+                        "abilityId": "shoot",
+                        "target": {"e1": -100, "e2": -100},
+                    },
+                )
+
+        step_all(hosted_games, steps=2)
+        for game in separate_games:
+            game.step(steps=2)
+
+        for hosted_game, separate_game in zip(hosted_games, separate_games):
+            assert hosted_game.state == separate_game.state
+            assert np.array_equal(
+                hosted_game.entity_features.players,
+                separate_game.entity_features.players,
+                equal_nan=True,
+            )
+
+    # Closing a hosted game leaves the others running
+    hosted_games[0].close()
+    step_all(hosted_games[1:], steps=1)
+    assert simulator.alive
+
+    for game in separate_games:
+        game.close()
+    simulator.close()
+
+
+def shoot(game: Game, frame: int):
+    game.order(
+        entity_id=1000,
+        order={
+            "type": "useAbility",
+            "abilityId": "shoot",
+            "target": {"e1": math.cos(frame), "e2": math.sin(frame)},
+        },
+    )
+
+
+def test_command_error(game: Game):
+    # A command for a game the simulator doesn't host fails without taking
+    # down the simulator or its other games
+    unknown_game = Game(game.simulator)
+    with pytest.raises(SimulatorCommandError, match="not started"):
+        unknown_game.step(1)
+    frame = game.state["gameState"]["frameNumber"]
+    with pytest.raises(StepAllError) as error:
+        step_all([game, unknown_game], steps=1)
+    assert list(error.value.errors) == [unknown_game]
+    assert game.state["gameState"]["frameNumber"] == frame + 1
+
+    # Errors of commands without a response go to their game, also when
+    # nothing reads after them
+    unknown_game.order(1000, {"type": "stop"})
+    game.simulator.flush()
+    unknown_game.order(1000, {"type": "stop"})
+    game.step(1)
+    assert game.state["gameState"]["frameNumber"] == frame + 2
+    assert game.simulator.ping()
+    with pytest.raises(SimulatorCommandError, match="not started"):
+        unknown_game.step(1)
+    assert not game.simulator.pop_command_errors(unknown_game.simulator_game_id)
+    game.step(1)
+    assert game.state["gameState"]["frameNumber"] == frame + 3
+
+
+def test_snapshot_restore(game: Game):
+    game.step(steps=20)
+    snapshot = game.snapshot()
+
+    def play():
+        states = []
+        for frame in range(60):
+            if frame % 20 == 0:
+                shoot(game, frame)
+            game.step(steps=1)
+            states.append(game.state)
+        return states
+
+    states = play()
+    game.restore(snapshot)
+    assert play() == states
+
+    # Snapshots can be restored into other games of the simulator
+    forked_game = Game(game.simulator)
+    forked_game.restore(snapshot)
+    forked_game.step(steps=60)
+    game.restore(snapshot)
+    game.step(steps=60)
+    assert forked_game.state == game.state
+
+    # Restoring a released snapshot fails but the game goes on
+    game.release_snapshot(snapshot)
+    state = game.state
+    with pytest.raises(SimulatorCommandError, match="not found"):
+        game.restore(snapshot)
+    assert game.state == state
+    game.step(steps=1)
+    assert game.state["gameState"]["frameNumber"] == (
+        state["gameState"]["frameNumber"] + 1
+    )
+
+    # Also for games that weren't started
+    unstarted_game = Game(game.simulator)
+    with pytest.raises(SimulatorCommandError):
+        unstarted_game.restore(snapshot)
+    assert not unstarted_game.started
+
+
+def test_replay(tmp_path, monkeypatch):
+    (tmp_path / "cwd").mkdir()
+    monkeypatch.chdir(tmp_path / "cwd")
+    game = Game()
+    game.start(num_players=2, seed=0, logging=True, keyframe_interval=50)
+
+    states = [game.state]
+    for frame in range(300):
+        if frame == 10:
+            game.buy_ability(entity_id=1000, ability_id="homing")
+        if frame == 20:
+            for player_id in game.state["players"].keys():
+                game.set_ready(int(player_id), True)
+        if frame % 40 == 0:
+            shoot(game, frame)
+        game.step(steps=1)
+        states.append(game.state)
+    game.log_game()
+    game.close()
+
+    (log_path,) = glob.glob(str(tmp_path / "logs" / "*" / "replay.wrp"))
+    assert len(load_replay(log_path)["keyframes"]) == 7
+
+    reader = ReplayReader(log_path)
+    assert reader.num_frames == len(states)
+    for frame in [0, 1, 49, 50, 51, 123, 300]:
+        assert reader.frame(frame) == states[frame]
+    for frame, state in enumerate(reader.frames()):
+        assert state == states[frame]
+    reader.close()
@@ -0,0 +1,192 @@
+import gymnasium as gym
+import numpy as np
+import pytest
+import torch
+
+from warlock_rl.models import (
+    TorchFrameStackingModel,
+    TorchLeagueModel,
+    league_snapshot_ids,
+)
+
+
+def make_model(
+    incremental_inference: bool = False, hidden_activation: str = "tanh"
+) -> TorchFrameStackingModel:
+    torch.manual_seed(0)
+    return TorchFrameStackingModel(
+        obs_space=gym.spaces.Box(-1, 1, (10,)),
+        action_space=gym.spaces.Discrete(5),
+        num_outputs=5,
+        model_config={},
+        name="model",
+        num_frames=4,
+        incremental_inference=incremental_inference,
+        hidden_activation=hidden_activation,
+    )
+
+
+@pytest.mark.parametrize("hidden_activation", ["tanh", "relu", "linear"])
+def test_forward(hidden_activation: str):
+    # Same as running the layers on every frame with its one-hot index
+    model = make_model(hidden_activation=hidden_activation)
+    obs = torch.randn(3, 4, 10)
+    action_mask = torch.tensor([[1.0, 1, 1, 1, 1], [1, 0, 1, 0, 1], [0, 0, 0, 0, 1]])
+
+    with torch.no_grad():
+        out, _ = model(
+            {"prev_n_obs": obs.reshape(3, -1), "obs": {"action_mask": action_mask}},
+            [],
+            None,
+        )
+        value = model.value_function()
+
+        frames = torch.concat([obs, torch.eye(4).expand(3, 4, 4)], -1)
+        expected_out = torch.mean(model.out(model.layer1(frames)), -2)
+        expected_value = torch.mean(model.values(model.value_layer1(frames)), -2)
+
+    assert torch.allclose(out[action_mask > 0], expected_out[action_mask > 0])
+    assert torch.all(out[action_mask == 0] < -1e30)
+    assert torch.allclose(value, expected_value[:, 0])
+
+
+def test_incremental_inference():
+    # Computing actions one frame at a time is the same as with the stacked
+    # frames, which repeat the first frame before it, also after the weights
+    # change during the episode
+    model = make_model(incremental_inference=True)
+    episode = torch.randn(2, 7, 10)
+    action_mask = torch.ones(2, 5)
+    padded_episode = torch.concat([episode[:, :1].expand(2, 3, 10), episode], 1)
+
+    states = [state.expand(2, *state.shape) for state in model.get_initial_state()]
+    with torch.no_grad():
+        for t in range(7):
+            if t == 4:
+                for parameter in model.parameters():
+                    parameter.add_(torch.randn_like(parameter))
+            out, states = model.forward(
+                {"obs_flat": episode[:, t], "obs": {"action_mask": action_mask}},
+                states,
+                None,
+            )
+            value = model.value_function()
+
+            stacked_out, _ = model.forward(
+                {
+                    "prev_n_obs": padded_episode[:, t : t + 4].reshape(2, -1),
+                    "obs": {"action_mask": action_mask},
+                },
+                [],
+                None,
+            )
+            assert torch.allclose(out, stacked_out, atol=1e-6)
+            assert torch.allclose(value, model.value_function(), atol=1e-6)
+
+
+def make_snapshots(num_snapshots: int) -> list[TorchFrameStackingModel]:
+    snapshots = [make_model() for _ in range(num_snapshots)]
+    with torch.no_grad():
+        for snapshot in snapshots[1:]:
+            for parameter in snapshot.parameters():
+                parameter.add_(torch.randn_like(parameter))
+    return snapshots
+
+
+def make_league(league_size: int) -> TorchLeagueModel:
+    return TorchLeagueModel(
+        obs_space=gym.spaces.Box(-1, 1, (10,)),
+        action_space=gym.spaces.Discrete(5),
+        num_outputs=5,
+        model_config={},
+        name="league",
+        num_frames=4,
+        league_size=league_size,
+    )
+
+
+def test_league_model():
+    # Every row gets the outputs of the snapshot it plays, with more
+    # snapshots than the league size, also in one batch
+    snapshots = make_snapshots(3)
+    league = make_league(league_size=2)
+    league.set_snapshots(
+        [league.snapshot_layers(snapshot.state_dict()) for snapshot in snapshots]
+    )
+    states = [state.expand(3, *state.shape) for state in league.get_initial_state()]
+
+    # Episode ids where the agent with index 0 plays each snapshot
+    eps_ids = [
+        next(
+            eps_id
+            for eps_id in range(100)
+            if league_snapshot_ids(np.array([eps_id]), np.zeros(1), 3)[0] == i
+        )
+        for i in range(3)
+    ]
+    obs = torch.randn(3, 4 * 10)
+    action_mask = torch.ones(3, 5)
+    with torch.no_grad():
+        for played in [[0, 1, 1], [1, 2, 2], [0, 1, 2], [2, 0, 1], [0, 0, 0]]:
+            out, _ = league(
+                {
+                    "prev_n_obs": obs,
+                    "obs": {"action_mask": action_mask},
+                    "eps_id": torch.tensor([eps_ids[i] for i in played]),
+                    "agent_index": torch.zeros(3, dtype=torch.int64),
+                },
+                states,
+                None,
+            )
+            value = league.value_function()
+
+            for row, snapshot_index in enumerate(played):
+                snapshot = snapshots[snapshot_index]
+                expected_out, _ = snapshot(
+                    {
+                        "prev_n_obs": obs[row : row + 1],
+                        "obs": {"action_mask": action_mask[row : row + 1]},
+                    },
+                    [],
+                    None,
+                )
+                assert torch.allclose(out[row], expected_out[0], atol=1e-6)
+                assert torch.allclose(
+                    value[row], snapshot.value_function()[0], atol=1e-6
+                )
+
+
+def test_league_model_grows():
+    # Agents keep playing their snapshot when snapshots are added during the
+    # episode, the new episodes play them too
+    snapshots = make_snapshots(3)
+    league = make_league(league_size=3)
+    layers = [league.snapshot_layers(snapshot.state_dict()) for snapshot in snapshots]
+    eps_id = next(
+        eps_id
+        for eps_id in range(100)
+        if league_snapshot_ids(np.array([eps_id]), np.zeros(1), 2)[0] == 1
+        and league_snapshot_ids(np.array([eps_id]), np.zeros(1), 3)[0] == 2
+    )
+    input_dict = {
+        "prev_n_obs": torch.randn(1, 4 * 10),
+        "obs": {"action_mask": torch.ones(1, 5)},
+        "eps_id": torch.tensor([eps_id]),
+        "agent_index": torch.zeros(1, dtype=torch.int64),
+    }
+    initial_states = [state[None] for state in league.get_initial_state()]
+
+    def expected_out(snapshot_index: int) -> torch.Tensor:
+        out, _ = snapshots[snapshot_index](input_dict, [], None)
+        return out
+
+    with torch.no_grad():
+        league.set_snapshots(layers[:2])
+        out, states = league(input_dict, initial_states, None)
+        assert torch.allclose(out, expected_out(1), atol=1e-6)
+
+        league.set_snapshots(layers)
+        out, _ = league(input_dict, states, None)
+        assert torch.allclose(out, expected_out(1), atol=1e-6)
+        out, _ = league(input_dict, initial_states, None)
+        assert torch.allclose(out, expected_out(2), atol=1e-6)
@@ -0,0 +1,383 @@
+import os
+import re
+
+import numpy as np
+import pytest
+
+import warlock_rl.envs
+from warlock_rl.envs import (
+    ABILITY_IDS,
+    ACTION_ORDER_TEMPLATES,
+    MOVE_ACTION_TYPE,
+    NUM_PLAYERS,
+    WarlockEnv,
+    action_to_order,
+    actions_to_orders,
+    features_to_all_action_masks,
+    features_to_all_obs,
+    features_to_all_shop_action_masks,
+    features_to_all_shop_obs,
+    state_to_action_mask,
+    state_to_obs,
+    state_to_shop_action_mask,
+    state_to_shop_obs,
+)
+from warlock_rl.game import (
+    FEATURE_ABILITY_FIELDS,
+    FEATURE_HEADER_FIELDS,
+    FEATURE_PLAYER_FIELDS,
+    FEATURE_PROJECTILE_FIELDS,
+    EntityFeatures,
+    Game,
+)
+from warlock_rl.replay_file import write_replay_file
+
+
+def random_actions(obs: dict, rng: np.random.Generator) -> dict:
+    actions = {}
+    for agent_id, agent_obs in obs.items():
+        action_type = int(rng.choice(np.flatnonzero(agent_obs["action_mask"])))
+        if isinstance(agent_id, str):
+            actions[agent_id] = action_type
+        else:
+            actions[agent_id] = {
+                "action_type": action_type,
+                "move_target_location": rng.random(2),
+                "cast_target_location": rng.random(2),
+                "move_target_type": 0,
+                "cast_target_type": 0,
+            }
+    return actions
+
+
+@pytest.fixture
+def played_states():
+    # Yields the env after every step of a few random games
+    env = WarlockEnv()
+    rng = np.random.default_rng(0)
+
+    def play(num_steps: int):
+        obs, _ = env.reset(seed=0)
+        for _ in range(num_steps):
+            obs, _, terminated, _, _ = env.step(random_actions(obs, rng))
+            yield env
+            if terminated["__all__"]:
+                obs, _ = env.reset()
+
+    return play
+
+
+def assert_features_match_state(features: EntityFeatures, state: dict):
+    if state["gameState"]["state"]["type"] == "shop":
+        shop_obs = features_to_all_shop_obs(features)
+        shop_action_masks = features_to_all_shop_action_masks(features)
+        for i in range(NUM_PLAYERS):
+            assert np.array_equal(shop_obs[i], state_to_shop_obs(state, i))
+            assert np.array_equal(
+                shop_action_masks[i], state_to_shop_action_mask(state, i)
+            )
+    else:
+        obs = features_to_all_obs(features)
+        action_masks = features_to_all_action_masks(features)
+        for i in range(NUM_PLAYERS):
+            assert np.array_equal(obs[i], state_to_obs(state, i))
+            assert np.array_equal(action_masks[i], state_to_action_mask(state, i))
+
+
+def test_features_match_state(played_states):
+    for env in played_states(300):
+        state = env._game.state
+        assert_features_match_state(env._game.entity_features, state)
+        assert_features_match_state(
+            EntityFeatures.from_state(state, ABILITY_IDS), state
+        )
+
+
+def make_state(rng: np.random.Generator, projectile_locations: list) -> dict:
+    player_ids = [str(1000 + i) for i in range(NUM_PLAYERS)]
+    projectile_ids = [str(2000 + i) for i in range(len(projectile_locations))]
+
+    def body(location):
+        return {
+            "location": {"e1": location[0], "e2": location[1]},
+            "velocity": {"e1": rng.normal() * 100, "e2": rng.normal() * 100},
+            "facing": rng.random() * 2 * np.pi,
+        }
+
+    return {
+        "gameState": {
+            "frameNumber": 200,
+            "deltaTime": 1 / 30,
+            "state": {"type": "round", "startFrame": 100},
+            "round": 1,
+        },
+        "arena": {"radius": 400},
+        "players": {player_id: {"ready": False} for player_id in player_ids},
+        "bodies": {
+            **{player_id: body(rng.normal(size=2) * 200) for player_id in player_ids},
+            **{
+                projectile_id: body(location)
+                for projectile_id, location in zip(projectile_ids, projectile_locations)
+            },
+        },
+        "healths": {
+            player_id: {"current": rng.random() * 100, "maximum": 100}
+            for player_id in player_ids
+        },
+        "units": {
+            player_id: {
+                "state": {"type": rng.choice(["idle", "moving", "casting"])},
+                "knockbackMultiplier": 1 + rng.random(),
+            }
+            for player_id in player_ids
+        },
+        "shields": {player_ids[0]: {}},
+        "pulls": {player_ids[1]: {}},
+        "shops": {
+            player_id: {"gold": 20, "costs": {"shoot": 5, "teleport": 12}}
+            for player_id in player_ids
+        },
+        "abilities": {
+            player_id: {
+                "shoot": {"cooldown": 4.8, "lastUsedFrame": 150},
+                "scourge": {"cooldown": 3},
+            }
+            for player_id in player_ids
+        },
+        "playerOwneds": {
+            **{
+                player_id: {"owningPlayerId": int(player_id)}
+                for player_id in player_ids
+            },
+            **{
+                projectile_id: {"owningPlayerId": int(player_ids[i % 2])}
+                for i, projectile_id in enumerate(projectile_ids)
+            },
+        },
+        "projectiles": {
+            projectile_id: {"homing": i % 3 == 0, "swap": i % 4 == 0}
+            for i, projectile_id in enumerate(projectile_ids)
+        },
+    }
+
+
+@pytest.mark.parametrize("num_projectiles", [0, 3, 5, 12])
+def test_all_obs_match_state(num_projectiles: int):
+    rng = np.random.default_rng(num_projectiles)
+    state = make_state(rng, list(rng.normal(size=(num_projectiles, 2)) * 200))
+    assert_features_match_state(EntityFeatures.from_state(state, ABILITY_IDS), state)
+
+
+def test_all_obs_nearest_projectile_ties():
+    # Projectiles at the same location (eg. cluster) tie at the cutoff
+    rng = np.random.default_rng(0)
+    state = make_state(rng, [(10.0, 10.0)] * 8 + [(50.0, 50.0)] * 4)
+    assert_features_match_state(EntityFeatures.from_state(state, ABILITY_IDS), state)
+
+
+def test_features_layout(played_states):
+    env = next(played_states(1))
+    features = env._game.entity_features
+    assert features.players.shape[0] == env.num_players
+    assert features.abilities.shape[:2] == (env.num_players, len(ABILITY_IDS))
+
+
+def test_features_offsets(tmp_path):
+    # The simulator packs every field where the Python layout expects it. A
+    # state with a different value in every field is loaded into the
+    # simulator through a replay keyframe.
+    features_ts = os.path.join(
+        os.path.dirname(__file__), "..", "..", "src", "cli", "features.ts"
+    )
+    with open(features_ts, "r") as features_file:
+        source = features_file.read()
+    for name, fields in [
+        ("HEADER_FIELDS", FEATURE_HEADER_FIELDS),
+        ("PLAYER_FIELDS", FEATURE_PLAYER_FIELDS),
+        ("ABILITY_FIELDS", FEATURE_ABILITY_FIELDS),
+        ("PROJECTILE_FIELDS", FEATURE_PROJECTILE_FIELDS),
+    ]:
+        ts_fields = re.search(rf"{name} = \[(.*?)\]", source, re.DOTALL)
+        assert re.findall(r'"(\w+)"', ts_fields.group(1)) == fields, name
+
+    def body(x: float) -> dict:
+        return {
+            "location": {"e1": x + 1, "e2": x + 2},
+            "velocity": {"e1": x + 3, "e2": x + 4},
+            "facing": x + 5,
+        }
+
+    state = {
+        "gameState": {
+            "frameNumber": 200,
+            "deltaTime": 0.5,
+            "state": {"type": "round", "startFrame": 150},
+            "round": 3,
+        },
+        "arena": {"radius": 400},
+        "players": {"1000": {"ready": True}, "1001": {"ready": True}},
+        "bodies": {"1000": body(10), "1001": body(20), "2000": body(30)},
+        "healths": {
+            "1000": {"current": 16, "maximum": 100},
+            "1001": {"current": 26, "maximum": 100},
+        },
+        "units": {
+            "1000": {"state": {"type": "casting"}, "knockbackMultiplier": 1.7},
+            "1001": {"state": {"type": "moving"}, "knockbackMultiplier": 2.7},
+        },
+        "shields": {"1000": {}},
+        "pulls": {"1001": {}},
+        "shops": {
+            "1000": {"gold": 18, "costs": {"shoot": 5, "teleport": 12}},
+            "1001": {"gold": 28, "costs": {"teleport": 13}},
+        },
+        "abilities": {
+            "1000": {"shoot": {"cooldown": 4.8, "lastUsedFrame": 190}},
+            "1001": {"teleport": {"cooldown": 9}},
+        },
+        "playerOwneds": {
+            "1000": {"owningPlayerId": 1},
+            "1001": {"owningPlayerId": 2},
+            "2000": {"owningPlayerId": 1000},
+        },
+        "projectiles": {"2000": {"homing": True, "swap": True, "gravity": True}},
+    }
+    expected = {
+        "header": [[200, 0.5, 400, 0, 150, 3, 2, 1]],
+        "players": [
+            [1000, 1, 11, 12, 13, 14, 15, 16, 1.7, 1, 0, 1, 0, 18],
+            [1001, 2, 21, 22, 23, 24, 25, 26, 2.7, 0, 1, 0, 1, 28],
+        ],
+        "abilities": [
+            [[1, 190, 4.8, 5], [0, np.nan, np.nan, 12]],
+            [[0, np.nan, np.nan, np.nan], [1, np.nan, 9, 13]],
+        ],
+        "projectiles": [[2000, 1000, 31, 32, 33, 34, 1, 0, 1, 1, 0]],
+    }
+
+    replay_path = str(tmp_path / "replay.wrp")
+    write_replay_file(
+        replay_path,
+        {
+            "start": {"seed": 0, "deltaTime": 0.5, "numPlayers": 2},
+            "keyframeInterval": 300,
+            "keyframes": [state],
+            "commands": [],
+            "lastFrame": 200,
+        },
+    )
+    game = Game(feature_ability_ids=["shoot", "teleport"])
+    game.restore_replay_frame(replay_path, 200)
+    try:
+        for features in [
+            game.entity_features,
+            EntityFeatures.from_state(state, ["shoot", "teleport"]),
+        ]:
+            for name, values in expected.items():
+                assert np.array_equal(
+                    np.atleast_2d(getattr(features, name)), values, equal_nan=True
+                ), name
+    finally:
+        game.close()
+
+
+def test_action_to_order():
+    # The orders of every action type, the same as before they were encoded
+    # from tables
+    action = {
+        "move_target_location": [0.75, 0.25],
+        "cast_target_location": [0.625, 0.125],
+    }
+    move_target = {"e1": 500.0, "e2": -500.0}
+    cast_target = {"e1": 250.0, "e2": -750.0}
+    # Teleport and swap targets are scaled by 0.25
+    short_cast_target = {"e1": 62.5, "e2": -187.5}
+
+    def use(ability_id: str, target: dict | None = None) -> dict:
+        order = {"type": "useAbility", "abilityId": ability_id}
+        if target is not None:
+            order["target"] = target
+        return order
+
+    expected_orders = [
+        None,
+        {"type": "stop"},
+        {"type": "move", "target": move_target},
+        use("shoot", cast_target),
+        use("teleport", short_cast_target),
+        use("swap", short_cast_target),
+        use("scourge"),
+        use("homing", cast_target),
+        use("shield"),
+        use("cluster", cast_target),
+        use("gravity", cast_target),
+        use("link", cast_target),
+        use("boomerang", cast_target),
+        use("lightning", cast_target),
+    ]
+    assert len(expected_orders) == len(ACTION_ORDER_TEMPLATES)
+    for action_type, expected_order in enumerate(expected_orders):
+        assert (
+            action_to_order(set(ABILITY_IDS), {**action, "action_type": action_type})
+            == expected_order
+        ), action_type
+        # Abilities that aren't owned do nothing
+        assert action_to_order(set(), {**action, "action_type": action_type}) == (
+            expected_order if action_type <= MOVE_ACTION_TYPE else None
+        ), action_type
+
+    with pytest.raises(ValueError):
+        action_to_order(set(), {**action, "action_type": len(expected_orders)})
+
+
+def test_actions_to_orders():
+    # Stacked actions are encoded the same as single actions
+    rng = np.random.default_rng(0)
+    abilities = [{"shoot", "teleport", "scourge"}, set()] * 14
+    action_types = np.arange(28) // 2
+    move_target_locations = rng.random((28, 2))
+    cast_target_locations = rng.random((28, 2))
+
+    orders = actions_to_orders(
+        abilities, action_types, move_target_locations, cast_target_locations
+    )
+    assert orders == [
+        action_to_order(
+            abilities[i],
+            {
+                "action_type": action_types[i],
+                "move_target_location": move_target_locations[i],
+                "cast_target_location": cast_target_locations[i],
+            },
+        )
+        for i in range(28)
+    ]
+    # Stop and move for both, abilities only if they are owned
+    assert sum(order is not None for order in orders) == 2 * 2 + 3
+
+
+@pytest.mark.parametrize("obs_validation", ["off", "vectorized", "sampled"])
+def test_obs_validation(obs_validation: str, monkeypatch):
+    env = WarlockEnv(
+        {"obs_validation": obs_validation, "obs_validation_sample_rate": 1.0}
+    )
+    _, infos = env.reset(seed=0)
+    if obs_validation == "off":
+        assert infos == {}
+    else:
+        assert infos["shop_0"]["obs_violations"] == 0
+
+    def corrupted_shop_obs(features):
+        obs = features_to_all_shop_obs(features)
+        obs[1, :2] = np.nan
+        return obs
+
+    monkeypatch.setattr(warlock_rl.envs, "features_to_all_shop_obs", corrupted_shop_obs)
+    _, _, _, _, infos = env.step({f"shop_{i}": 0 for i in range(NUM_PLAYERS)})
+    if obs_validation == "off":
+        assert infos == {}
+        assert env.obs_violations == 0
+    else:
+        assert infos["shop_0"]["obs_violations"] == 0
+        assert infos["shop_1"]["obs_violations"] == 2
+        assert env.obs_violations == 2
@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+
+from warlock_rl.envs import NUM_PLAYERS, WarlockEnv
+from warlock_rl.game import Game, SimulatorError
+from warlock_rl.pool import SimulatorPool
+
+
+@pytest.fixture
+def pool():
+    pool = SimulatorPool(size=2)
+    yield pool
+    pool.close()
+
+
+def kill(game: Game):
+    game.simulator._process.kill()
+    game.simulator._process.wait()
+
+
+def test_prewarm(pool: SimulatorPool):
+    assert pool.num_idle == 2
+
+
+def test_lease_release(pool: SimulatorPool):
+    simulator = pool.lease()
+    assert simulator.ping()
+    # Refilled in the background
+    pool.wait_for_refill()
+    assert pool.num_idle == 2
+
+    game = Game(simulator=simulator)
+    game.start(num_players=2, seed=0)
+    game.close()
+    assert simulator.alive
+
+    # The pool is full, the simulator is closed
+    pool.release(simulator)
+    assert pool.num_idle == 2
+    assert not simulator.alive
+
+
+def test_dead_simulator_is_replaced(pool: SimulatorPool):
+    game = Game(simulator=pool.lease())
+    game.start(num_players=2, seed=0)
+    kill(game)
+
+    with pytest.raises(SimulatorError):
+        game.step(1)
+
+    pool.release(game.simulator)
+    assert pool.num_respawned == 1
+    pool.wait_for_refill()
+    assert pool.num_idle == 2
+
+    # Idle simulators that died get replaced when leased
+    for simulator in pool._idle:
+        simulator._process.kill()
+        simulator._process.wait()
+    assert pool.lease().ping()
+    assert pool.num_respawned == 3
+
+
+def test_concurrent_prewarm():
+    pool = SimulatorPool(size=0)
+    pool._size = 2
+    threads = [threading.Thread(target=pool.prewarm) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert pool.num_idle == 2
+    pool.close()
+
+
+def test_env_recovers_from_dead_simulator():
+    env = WarlockEnv()
+    env.reset(seed=0)
+    kill(env._game)
+
+    _, _, terminated, truncated, _ = env.step(
+        {f"shop_{i}": 0 for i in range(NUM_PLAYERS)}
+    )
+    assert truncated["__all__"]
+    assert not terminated["__all__"]
+
+    obs, _ = env.reset(seed=0)
+    assert set(obs.keys()) == {f"shop_{i}" for i in range(NUM_PLAYERS)}
+    env.close()
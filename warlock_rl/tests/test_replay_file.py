@@ -0,0 +1,95 @@
+import pytest
+
+from warlock_rl.replay_file import (
+    ReplayFile,
+    ReplayFileError,
+    ReplayFileWriter,
+    replay_blocks,
+    write_replay_file,
+)
+
+
+def make_replay(num_keyframes: int, keyframe_interval: int = 10) -> dict:
+    return {
+        "start": {"seed": 0, "deltaTime": 0.05, "numPlayers": 2},
+        "keyframeInterval": keyframe_interval,
+        "keyframes": [
+            {"gameState": {"frameNumber": i * keyframe_interval}}
+            for i in range(num_keyframes)
+        ],
+        "commands": [
+            {"frame": frame, "command": {"type": "setReady", "entityId": 0}}
+            for frame in range(0, num_keyframes * keyframe_interval, 3)
+        ],
+        "lastFrame": num_keyframes * keyframe_interval - 1,
+        "roundWinners": [[1000], []],
+    }
+
+
+def test_replay_blocks():
+    replay = make_replay(3)
+    blocks = replay_blocks(replay)
+
+    assert [block["keyframe"] for block in blocks] == replay["keyframes"]
+    assert [
+        [command["frame"] for command in block["commands"]] for block in blocks
+    ] == [
+        [0, 3, 6, 9],
+        [12, 15, 18],
+        [21, 24, 27],
+    ]
+
+
+def test_write_read(tmp_path):
+    path = str(tmp_path / "replay.wrp")
+    replay = make_replay(3)
+    write_replay_file(path, replay)
+
+    with ReplayFile(path) as replay_file:
+        assert replay_file.replay() == replay
+        assert replay_file.num_blocks == 3
+        assert replay_file.block_first_frames == [0, 10, 20]
+        assert replay_file.first_frame == 0
+        assert replay_file.last_frame == 29
+
+        assert replay_file.block_index(0) == 0
+        assert replay_file.block_index(9) == 0
+        assert replay_file.block_index(10) == 1
+        assert replay_file.block_index(29) == 2
+        with pytest.raises(IndexError):
+            replay_file.block_index(30)
+
+        assert replay_file.block(1) == replay_blocks(replay)[1]
+
+
+def test_append(tmp_path):
+    path = str(tmp_path / "replay.wrp")
+    replay = make_replay(4)
+    blocks = replay_blocks(replay)
+
+    writer = ReplayFileWriter(path, replay["start"], replay["keyframeInterval"])
+    writer.append_block(blocks[0], 9)
+    writer.close()
+    with ReplayFile(path) as replay_file:
+        assert replay_file.num_blocks == 1
+        assert replay_file.last_frame == 9
+
+    writer = ReplayFileWriter(path)
+    for block in blocks[1:]:
+        writer.append_block(block, replay["lastFrame"])
+    writer.add_round_winners(replay["roundWinners"])
+    writer.close()
+    with ReplayFile(path) as replay_file:
+        assert replay_file.replay() == replay
+
+
+def test_not_closed(tmp_path):
+    path = str(tmp_path / "replay.wrp")
+    replay = make_replay(1)
+
+    writer = ReplayFileWriter(path, replay["start"], replay["keyframeInterval"])
+    writer.append_block(replay_blocks(replay)[0], replay["lastFrame"])
+    writer._file.close()
+
+    with pytest.raises(ReplayFileError):
+        ReplayFile(path)
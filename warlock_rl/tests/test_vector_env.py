@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+from test_obs import random_actions
+
+from warlock_rl.envs import VectorWarlockEnv, WarlockEnv
+from warlock_rl.game import CLICommandCloseGame, SimulatorCommandError
+
+NUM_ENVS = 3
+
+
+def make_vector_env() -> VectorWarlockEnv:
+    config = {"vector_env": True}
+    vector_env = WarlockEnv(config).to_base_env(
+        make_env=lambda _: WarlockEnv(config), num_envs=NUM_ENVS
+    )
+    assert isinstance(vector_env, VectorWarlockEnv)
+    return vector_env
+
+
+def reset_seeded(reset, seed: int):
+    # The env draws the start gold from the global random state
+    np.random.seed(seed)
+    return reset(seed=seed)
+
+
+def test_vector_env_matches_envs():
+    vector_env = make_vector_env()
+    envs = [WarlockEnv() for _ in range(NUM_ENVS)]
+    rng = np.random.default_rng(0)
+
+    # The first poll resets all sub envs
+    vector_env.poll()
+    for env_id, env in enumerate(envs):
+        env_obs, _ = reset_seeded(env.reset, env_id)
+        vector_obs, _ = reset_seeded(
+            lambda seed: vector_env.try_reset(env_id, seed=seed), env_id
+        )
+        assert env_obs.keys() == vector_obs[env_id].keys()
+
+    games = [env._game for env in vector_env.get_sub_environments()]
+    assert all(game.simulator is vector_env.simulator for game in games)
+
+    for _ in range(300):
+        obs = {env_id: env._last_obs for env_id, env in enumerate(envs)}
+        actions = {env_id: random_actions(obs[env_id], rng) for env_id in obs}
+
+        results = [env.step(actions[env_id]) for env_id, env in enumerate(envs)]
+        vector_env.send_actions(actions)
+        vector_results = vector_env.poll()
+
+        for env_id, (obs, _, terminateds, _, _) in enumerate(results):
+            assert obs.keys() == vector_results[0][env_id].keys()
+            for agent_id, agent_obs in obs.items():
+                assert np.array_equal(
+                    agent_obs["obs"], vector_results[0][env_id][agent_id]["obs"]
+                )
+            assert terminateds["__all__"] == vector_results[2][env_id]["__all__"]
+
+            if terminateds["__all__"]:
+                reset_seeded(envs[env_id].reset, env_id)
+                reset_seeded(
+                    lambda seed: vector_env.try_reset(env_id, seed=seed), env_id
+                )
+
+    vector_env.stop()
+    for env in envs:
+        env.close()
+
+
+def test_vector_env_recovers_from_dead_simulator():
+    vector_env = make_vector_env()
+    obs, _, _, _, _, _ = vector_env.poll()
+    rng = np.random.default_rng(0)
+
+    simulator = vector_env.simulator
+    simulator._process.kill()
+    simulator._process.wait()
+
+    vector_env.send_actions(
+        {env_id: random_actions(obs[env_id], rng) for env_id in obs}
+    )
+    _, _, terminateds, truncateds, _, _ = vector_env.poll()
+    assert all(truncateds[env_id]["__all__"] for env_id in range(NUM_ENVS))
+    assert not any(terminateds[env_id]["__all__"] for env_id in range(NUM_ENVS))
+    assert vector_env.simulator is not simulator
+
+    obs, _ = vector_env.try_reset()
+    assert len(obs) == NUM_ENVS
+    vector_env.send_actions(
+        {env_id: random_actions(obs[env_id], rng) for env_id in obs}
+    )
+    _, _, _, truncateds, _, _ = vector_env.poll()
+    assert not any(truncateds[env_id]["__all__"] for env_id in range(NUM_ENVS))
+
+    vector_env.stop()
+
+
+def test_vector_env_reset_from_snapshot():
+    vector_env = make_vector_env()
+    obs, _, _, _, _, _ = vector_env.poll()
+    rng = np.random.default_rng(0)
+    for _ in range(10):
+        vector_env.send_actions(
+            {env_id: random_actions(obs[env_id], rng) for env_id in obs}
+        )
+        obs, _, _, _, _, _ = vector_env.poll()
+
+    # Fork the other envs from the state of the first one
+    envs = vector_env.get_sub_environments()
+    snapshot = envs[0].snapshot()
+    for env_id in range(1, NUM_ENVS):
+        forked_obs, _ = vector_env.try_reset(env_id, options={"snapshot": snapshot})
+        assert forked_obs[env_id].keys() == obs[0].keys()
+        for agent_id, agent_obs in obs[0].items():
+            assert np.array_equal(agent_obs["obs"], forked_obs[env_id][agent_id]["obs"])
+    envs[0].release_snapshot(snapshot)
+
+    # A released snapshot is the caller's error, the other envs keep going
+    simulator = vector_env.simulator
+    with pytest.raises(SimulatorCommandError):
+        vector_env.try_reset(1, options={"snapshot": snapshot})
+    assert vector_env.simulator is simulator
+    vector_env.send_actions(
+        {env_id: random_actions(obs[env_id], rng) for env_id in obs}
+    )
+    _, _, _, truncateds, _, _ = vector_env.poll()
+    assert not any(truncateds[env_id]["__all__"] for env_id in range(NUM_ENVS))
+
+    vector_env.stop()
+
+
+def test_vector_env_truncates_failed_game():
+    vector_env = make_vector_env()
+    obs, _, _, _, _, _ = vector_env.poll()
+    rng = np.random.default_rng(0)
+
+    # Only the env whose game is gone from the simulator is truncated
+    simulator = vector_env.simulator
+    game = vector_env.get_sub_environments()[1]._game
+    simulator.send_command(CLICommandCloseGame(gameId=game.simulator_game_id))
+    vector_env.send_actions(
+        {env_id: random_actions(obs[env_id], rng) for env_id in obs}
+    )
+    obs, _, _, truncateds, _, _ = vector_env.poll()
+    assert [truncateds[env_id]["__all__"] for env_id in range(NUM_ENVS)] == [
+        False,
+        True,
+        False,
+    ]
+    assert vector_env.simulator is simulator
+
+    obs.update(vector_env.try_reset(1)[0])
+    vector_env.send_actions(
+        {env_id: random_actions(obs[env_id], rng) for env_id in obs}
+    )
+    _, _, _, truncateds, _, _ = vector_env.poll()
+    assert not any(truncateds[env_id]["__all__"] for env_id in range(NUM_ENVS))
+
+    vector_env.stop()
@@ -0,0 +1,130 @@
+import json
+import threading
+
+import pytest
+
+from warlock_rl.replay import load_replay
+from warlock_rl.writer import REPLAY_QUEUE_SIZE, ReplayWriter, get_replay_writer
+
+
+def make_replay(seed: int) -> bytes:
+    keyframe = {"gameState": {"frameNumber": 0}}
+    return json.dumps(
+        {
+            "start": {"seed": seed},
+            "keyframeInterval": 300,
+            "keyframes": [keyframe],
+            "commands": [],
+            "lastFrame": 0,
+        }
+    ).encode()
+
+
+@pytest.fixture
+def blocked_writer(monkeypatch):
+    # Writer that only writes once the returned event is set
+    unblocked = threading.Event()
+    write_file = ReplayWriter._write_file
+
+    def blocked_write_file(self, *args):
+        unblocked.wait()
+        write_file(self, *args)
+
+    monkeypatch.setattr(ReplayWriter, "_write_file", blocked_write_file)
+    return unblocked
+
+
+def test_write(tmp_path):
+    writer = ReplayWriter()
+    paths = [tmp_path / str(i) / "replay.wrp" for i in range(3)]
+    for i, path in enumerate(paths):
+        assert writer.write(str(path), make_replay(i))
+    writer.flush()
+
+    assert writer.num_written == 3
+    for i, path in enumerate(paths):
+        assert load_replay(str(path))["start"] == {"seed": i}
+        assert not path.with_name("replay.wrp.tmp").exists()
+    writer.close()
+
+
+def test_write_invalid(tmp_path):
+    writer = ReplayWriter()
+    assert writer.write(str(tmp_path / "0.wrp"), b"{")
+    assert writer.write(str(tmp_path / "1.wrp"), b"{}")
+    # Still writing after failing
+    assert writer.write(str(tmp_path / "2.wrp"), make_replay(2))
+    writer.flush()
+
+    assert writer.num_written == 1
+    assert writer.num_failed == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["2.wrp"]
+    writer.close()
+
+
+def test_drop_when_full(tmp_path, blocked_writer):
+    writer = ReplayWriter(max_queue_size=1, policy="drop")
+    # The first is taken by the writer thread, the second waits in the queue
+    assert writer.write(str(tmp_path / "0.wrp"), make_replay(0))
+    while writer._queue.qsize() > 0:
+        pass
+    assert writer.write(str(tmp_path / "1.wrp"), make_replay(1))
+    assert not writer.write(str(tmp_path / "2.wrp"), make_replay(2))
+    assert writer.num_dropped == 1
+
+    blocked_writer.set()
+    writer.flush()
+    assert writer.num_written == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["0.wrp", "1.wrp"]
+    writer.close()
+
+
+def test_wait(tmp_path, blocked_writer):
+    writer = ReplayWriter()
+    path = str(tmp_path / "0.wrp")
+    writer.write(path, make_replay(0))
+    assert writer.is_pending(path)
+
+    # Other paths don't wait for the blocked replay
+    writer.wait([str(tmp_path / "1.wrp")])
+    waiting = threading.Thread(target=writer.wait, args=([path],))
+    waiting.start()
+    waiting.join(timeout=0.2)
+    assert waiting.is_alive()
+
+    blocked_writer.set()
+    waiting.join()
+    assert not writer.is_pending(path)
+    assert writer.num_written == 1
+    writer.close()
+
+
+def test_block_when_full(tmp_path, blocked_writer):
+    writer = ReplayWriter(max_queue_size=1, policy="block")
+    writer.write(str(tmp_path / "0.wrp"), make_replay(0))
+    while writer._queue.qsize() > 0:
+        pass
+    writer.write(str(tmp_path / "1.wrp"), make_replay(1))
+
+    blocked_write = threading.Thread(
+        target=writer.write, args=(str(tmp_path / "2.wrp"), make_replay(2))
+    )
+    blocked_write.start()
+    blocked_write.join(timeout=0.2)
+    assert blocked_write.is_alive()
+
+    blocked_writer.set()
+    blocked_write.join()
+    writer.flush()
+    assert writer.num_written == 3
+    assert writer.num_dropped == 0
+    writer.close()
+
+
+def test_get_replay_writer():
+    # Shared by the same config, envs with another config don't change it
+    writer = get_replay_writer(2, "drop")
+    assert get_replay_writer(2, "drop") is writer
+    assert get_replay_writer(3, "drop") is not writer
+    assert (writer.max_queue_size, writer.policy) == (2, "drop")
+    assert get_replay_writer() is get_replay_writer(REPLAY_QUEUE_SIZE, "block")
@@ -0,0 +1,639 @@
+import argparse
+import contextlib
+import os
+import platform
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Literal
+
+import numpy as np
+import ujson as json
+
+from warlock_rl import envs
+from warlock_rl import game as game_module
+from warlock_rl.envs import (
+    ABILITY_IDS,
+    FRAMES_PER_STEP,
+    MAX_ROUNDS,
+    MOVE_ACTION_TYPE,
+    NUM_PLAYERS,
+    OBS_LOC_RANGE,
+    START_GOLD_RANGE,
+    WarlockEnv,
+    actions_to_orders,
+    features_to_all_action_masks,
+    features_to_all_obs,
+)
+from warlock_rl.game import (
+    FEATURE_HEADER,
+    FEATURE_PLAYER,
+    EntityFeatures,
+    Game,
+    Simulator,
+)
+
+# Rollout throughput of Game and WarlockEnv across player counts, frames per
+# step and projectile densities, with where the time of a step goes. Games
+# are driven with random actions or a scripted policy that fires projectile
+# abilities at the nearest enemy at a given rate, which sets how many
+# projectiles are flying.
+# WarlockEnv always has NUM_PLAYERS players, other player counts are only
+# run on a Game (without the observations, which are sized for
+# NUM_PLAYERS).
+#
+# Phases in seconds of the measured steps. Python side, timed by wrapping
+# the functions of the hot path for the duration of a run:
+#   encode: json.dumps of the commands
+#   write: writing the commands to the simulator's stdin
+#   read: reading the responses, includes waiting for the simulator
+#   parse: json.loads of the responses and unpacking the entity features
+#   obs, mask: building the observations and action masks
+#   orders: turning the actions into orders
+#   policy: choosing the actions, only the benchmark's own overhead
+# Simulator side, from its getTimings command (see src/cli/index.ts):
+#   sim_parse, simulate, stringify, features, sim_write
+#
+# python -m warlock_rl.benchmark [--output benchmark.json] [--baseline old.json]
+
+BENCHMARK_STEPS = 500
+WARMUP_STEPS = 100
+PLAYER_COUNTS = [2, NUM_PLAYERS, 8]
+FRAMES_PER_STEPS = [1, FRAMES_PER_STEP, 12]
+SHOOT_RATES = [0.0, 0.2, 1.0]
+
+# Slowdown of steps per second over the baseline that is reported as a
+# regression
+REGRESSION_TOLERANCE = 0.1
+
+# Abilities that fire projectiles, scripted players buy all they can afford
+PROJECTILE_ABILITY_IDS = [
+    "shoot",
+    "homing",
+    "cluster",
+    "gravity",
+    "link",
+    "boomerang",
+    "swap",
+]
+PROJECTILE_ACTION_TYPES = np.array(
+    [3 + ABILITY_IDS.index(ability_id) for ability_id in PROJECTILE_ABILITY_IDS]
+)
+
+PHASES = [
+    "encode",
+    "write",
+    "read",
+    "parse",
+    "obs",
+    "mask",
+    "orders",
+    "policy",
+    "sim_parse",
+    "simulate",
+    "stringify",
+    "features",
+    "sim_write",
+]
+
+Policy = Literal["random", "scripted"]
+
+
+@dataclass
+class Scenario:
+    target: Literal["game", "env"]
+    policy: Policy
+    num_players: int
+    frames_per_step: int
+    # Chance that a scripted player with a projectile ability ready fires it
+    # on a step, None for random actions
+    shoot_rate: float | None = None
+
+    @property
+    def name(self) -> str:
+        name = (
+            f"{self.target}/{self.policy}/players={self.num_players}"
+            f"/frames={self.frames_per_step}"
+        )
+        if self.shoot_rate is not None:
+            name += f"/shoot={self.shoot_rate:g}"
+        return name
+
+
+def make_scenarios(
+    targets: list[str],
+    policies: list[Policy],
+    player_counts: list[int],
+    frames_per_steps: list[int],
+    shoot_rates: list[float],
+) -> list[Scenario]:
+    scenarios = []
+    for target in targets:
+        for num_players in player_counts if target == "game" else [NUM_PLAYERS]:
+            for frames_per_step in frames_per_steps:
+                for policy in policies:
+                    for shoot_rate in shoot_rates if policy == "scripted" else [None]:
+                        scenarios.append(
+                            Scenario(
+                                target, policy, num_players, frames_per_step, shoot_rate
+                            )
+                        )
+    return scenarios
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.seconds: dict[str, float] = {}
+
+    def add(self, phase: str, seconds: float):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def time(self, phase: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start_time)
+
+    def wrap(self, phase: str, function):
+        def timed(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start_time)
+
+        return timed
+
+
+class _TimedJson:
+    # Stands in for the json module of game.py
+    def __init__(self, timer: PhaseTimer):
+        self.dumps = timer.wrap("encode", json.dumps)
+        self.loads = timer.wrap("parse", json.loads)
+
+
+class _TimedPipe:
+    # Forwards to a pipe of the simulator process, with one method timed
+    def __init__(self, pipe, method: str, timed):
+        self._pipe = pipe
+        setattr(self, method, timed)
+
+    def __getattr__(self, name: str):
+        return getattr(self._pipe, name)
+
+
+@contextlib.contextmanager
+def _patched(patches: list[tuple[object, str, object]]):
+    # Sets the attributes and restores them after, read from __dict__ so
+    # static methods stay static
+    originals = [(target, name, vars(target)[name]) for target, name, _ in patches]
+    try:
+        for target, name, value in patches:
+            setattr(target, name, value)
+        yield
+    finally:
+        for target, name, value in originals:
+            setattr(target, name, value)
+
+
+def _hot_path_patches(
+    timer: PhaseTimer, simulator: Simulator, env: bool
+) -> list[tuple[object, str, object]]:
+    process = simulator._process
+    patches = [
+        (game_module, "json", _TimedJson(timer)),
+        (
+            EntityFeatures,
+            "from_buffer",
+            staticmethod(timer.wrap("parse", EntityFeatures.from_buffer)),
+        ),
+        (
+            process,
+            "stdin",
+            _TimedPipe(
+                process.stdin, "write", timer.wrap("write", process.stdin.write)
+            ),
+        ),
+        (
+            process,
+            "stdout",
+            _TimedPipe(
+                process.stdout,
+                "readinto",
+                timer.wrap("read", process.stdout.readinto),
+            ),
+        ),
+    ]
+    if env:
+        # Looked up by WarlockEnv when it's called
+        patches += [
+            (envs, "features_to_all_obs", timer.wrap("obs", features_to_all_obs)),
+            (
+                envs,
+                "features_to_all_action_masks",
+                timer.wrap("mask", features_to_all_action_masks),
+            ),
+            (envs, "action_to_order", timer.wrap("orders", envs.action_to_order)),
+        ]
+    return patches
+
+
+def random_actions(
+    rng: np.random.Generator, features: EntityFeatures, action_masks: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Valid action types and targets anywhere, returns the action types and
+    # move and cast target locations of every player
+    num_players = len(action_masks)
+    action_types = np.array(
+        [rng.choice(np.flatnonzero(action_mask)) for action_mask in action_masks]
+    )
+    return action_types, rng.random((num_players, 2)), rng.random((num_players, 2))
+
+
+def scripted_actions(
+    rng: np.random.Generator,
+    features: EntityFeatures,
+    action_masks: np.ndarray,
+    shoot_rate: float,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Players wander around the center of the arena and fire a random ready
+    # projectile ability at the nearest living enemy with probability
+    # shoot_rate
+    players = features.players
+    num_players = len(players)
+    locations = (
+        players[:, [FEATURE_PLAYER["x"], FEATURE_PLAYER["y"]]] / OBS_LOC_RANGE + 0.5
+    )
+    alive = players[:, FEATURE_PLAYER["health"]] > 0
+
+    # [self, other]
+    distances = np.linalg.norm(locations[None] - locations[:, None], axis=-1)
+    distances[:, ~alive] = np.inf
+    np.fill_diagonal(distances, np.inf)
+    nearest = np.argmin(distances, axis=1)
+
+    ready = action_masks[:, PROJECTILE_ACTION_TYPES] != 0
+    shoot = (
+        ready.any(axis=1)
+        & np.isfinite(distances.min(axis=1))
+        & (rng.random(num_players) < shoot_rate)
+    )
+    action_types = np.where(
+        shoot,
+        PROJECTILE_ACTION_TYPES[np.argmax(rng.random(ready.shape) * ready, axis=1)],
+        np.where(action_masks[:, MOVE_ACTION_TYPE] != 0, MOVE_ACTION_TYPE, 0),
+    )
+    move_target_locations = 0.5 + rng.normal(0, 0.05, (num_players, 2))
+    return action_types, move_target_locations, locations[nearest]
+
+
+class GameRollout:
+    # Plays rounds on a Game like WarlockEnv does, for any number of players.
+    # Players start with the most gold and are ready as soon as the shop
+    # opens, scripted players buy the projectile abilities first.
+
+    def __init__(
+        self,
+        scenario: Scenario,
+        timer: PhaseTimer,
+        rng: np.random.Generator,
+        seed: int,
+    ):
+        self._scenario = scenario
+        self._timer = timer
+        self._rng = rng
+        self._seed = seed
+        self._game = Game(feature_ability_ids=ABILITY_IDS, lazy_state=True)
+        self._start()
+
+    @property
+    def simulator(self) -> Simulator:
+        return self._game.simulator
+
+    def _start(self):
+        self._game.start(
+            num_players=self._scenario.num_players,
+            start_gold=START_GOLD_RANGE[1],
+            seed=self._seed,
+            logging=False,
+        )
+        self._seed += 1
+
+    def step(self) -> tuple[int, int]:
+        # Plays a round step, returns the frames it advanced and the number
+        # of projectiles after it
+        game = self._game
+        while game.view.shopping:
+            if game.view.round >= MAX_ROUNDS:
+                self._start()
+                continue
+            for player_id in game.view.player_ids:
+                if self._scenario.policy == "scripted":
+                    for ability_id in PROJECTILE_ABILITY_IDS:
+                        if ability_id not in game.view.abilities[player_id]:
+                            game.buy_ability(player_id, ability_id)
+                game.set_ready(player_id, True)
+            game.step(1)
+
+        features = game.entity_features
+        if self._scenario.num_players == NUM_PLAYERS:
+            with self._timer.time("obs"):
+                features_to_all_obs(features)
+        with self._timer.time("mask"):
+            action_masks = features_to_all_action_masks(features)
+
+        with self._timer.time("policy"):
+            if self._scenario.policy == "random":
+                actions = random_actions(self._rng, features, action_masks)
+            else:
+                actions = scripted_actions(
+                    self._rng, features, action_masks, self._scenario.shoot_rate
+                )
+
+        with self._timer.time("orders"):
+            view = game.view
+            alive = features.players[:, FEATURE_PLAYER["health"]] > 0
+            orders = actions_to_orders(
+                [view.abilities[player_id] for player_id in view.player_ids],
+                *actions,
+            )
+            for player_id, order, is_alive in zip(view.player_ids, orders, alive):
+                if is_alive and order is not None:
+                    game.order(player_id, order)
+
+        frame = view.frame
+        game.step(self._scenario.frames_per_step, stop_on_state_change=True)
+        return (
+            game.view.frame - frame,
+            int(game.entity_features.header[FEATURE_HEADER["numProjectiles"]]),
+        )
+
+    def close(self):
+        self._game.close()
+
+
+class EnvRollout:
+    # Plays round steps of a WarlockEnv, the random policy also buys
+    # abilities in the shop
+
+    def __init__(
+        self,
+        scenario: Scenario,
+        timer: PhaseTimer,
+        rng: np.random.Generator,
+        seed: int,
+    ):
+        assert scenario.num_players == NUM_PLAYERS
+        self._scenario = scenario
+        self._timer = timer
+        self._rng = rng
+        self._seed = seed
+        self._env = WarlockEnv(
+            {"frames_per_step": scenario.frames_per_step, "log_game_rate": 0}
+        )
+        self._reset()
+
+    @property
+    def simulator(self) -> Simulator:
+        return self._env._game.simulator
+
+    def _reset(self):
+        self._obs, _ = self._env.reset(seed=self._seed)
+        self._seed += 1
+
+    def _env_step(self, actions: dict):
+        self._obs, _, terminated, truncated, _ = self._env.step(actions)
+        return terminated["__all__"] or truncated["__all__"]
+
+    def _shop_action(self, action_mask: np.ndarray) -> int:
+        if self._scenario.policy == "random":
+            return int(self._rng.choice(np.flatnonzero(action_mask)))
+        # The first projectile ability that can be bought, if any
+        for ability_id in PROJECTILE_ABILITY_IDS:
+            if action_mask[1 + ABILITY_IDS.index(ability_id)]:
+                return 1 + ABILITY_IDS.index(ability_id)
+        return 0
+
+    def step(self) -> tuple[int, int]:
+        # Same as GameRollout.step
+        while any(isinstance(agent_id, str) for agent_id in self._obs):
+            with self._timer.time("policy"):
+                actions = {
+                    agent_id: self._shop_action(obs["action_mask"])
+                    for agent_id, obs in self._obs.items()
+                }
+            if self._env_step(actions):
+                self._reset()
+
+        game = self._env._game
+        features = game.entity_features
+        with self._timer.time("policy"):
+            # Dead players have no observation, they do nothing
+            action_masks = np.zeros(
+                (len(features.players), WarlockEnv.action_mask_size), np.int8
+            )
+            action_masks[:, 0] = 1
+            for player_index, obs in self._obs.items():
+                action_masks[player_index] = obs["action_mask"]
+            if self._scenario.policy == "random":
+                action_types, move_targets, cast_targets = random_actions(
+                    self._rng, features, action_masks
+                )
+            else:
+                action_types, move_targets, cast_targets = scripted_actions(
+                    self._rng, features, action_masks, self._scenario.shoot_rate
+                )
+            actions = {
+                player_index: {
+                    "action_type": int(action_types[player_index]),
+                    "move_target_location": move_targets[player_index],
+                    "cast_target_location": cast_targets[player_index],
+                    "move_target_type": 0,
+                    "cast_target_type": 0,
+                }
+                for player_index in self._obs
+            }
+
+        frame = game.view.frame
+        done = self._env_step(actions)
+        result = (
+            game.view.frame - frame,
+            int(game.entity_features.header[FEATURE_HEADER["numProjectiles"]]),
+        )
+        if done:
+            self._reset()
+        return result
+
+    def close(self):
+        self._env.close()
+
+
+def run_scenario(
+    scenario: Scenario,
+    steps: int = BENCHMARK_STEPS,
+    warmup_steps: int = WARMUP_STEPS,
+    seed: int = 0,
+) -> dict:
+    # Plays warmup_steps and then measures steps round steps, returns the
+    # scenario with its results
+    if steps < 1 or warmup_steps < 0:
+        raise ValueError(
+            f"Need steps >= 1 and warmup_steps >= 0, got {steps} and {warmup_steps}"
+        )
+    timer = PhaseTimer()
+    rng = np.random.default_rng(seed)
+    rollout = (GameRollout if scenario.target == "game" else EnvRollout)(
+        scenario, timer, rng, seed
+    )
+    num_frames = 0
+    num_projectiles = 0
+    try:
+        with _patched(
+            _hot_path_patches(timer, rollout.simulator, scenario.target == "env")
+        ):
+            for step in range(warmup_steps + steps):
+                if step == warmup_steps:
+                    # Turns the simulator's timings on, or resets them
+                    rollout.simulator.timings()
+                    timer.seconds = {}
+                    num_frames = 0
+                    num_projectiles = 0
+                    start_time = time.perf_counter()
+                step_frames, step_projectiles = rollout.step()
+                num_frames += step_frames
+                num_projectiles += step_projectiles
+            seconds = time.perf_counter() - start_time
+            phases = dict(timer.seconds)
+            simulator_phases = rollout.simulator.timings()
+    finally:
+        rollout.close()
+
+    for phase, phase_seconds in simulator_phases.items():
+        phases[f"sim_{phase}" if phase in ("parse", "write") else phase] = phase_seconds
+    return {
+        "name": scenario.name,
+        **asdict(scenario),
+        "steps": steps,
+        "frames": num_frames,
+        "seconds": seconds,
+        "steps_per_second": steps / seconds,
+        "frames_per_second": num_frames / seconds,
+        "mean_projectiles": num_projectiles / steps,
+        "phases": {phase: phases.get(phase, 0.0) for phase in PHASES},
+    }
+
+
+def run_benchmark(
+    scenarios: list[Scenario],
+    steps: int = BENCHMARK_STEPS,
+    warmup_steps: int = WARMUP_STEPS,
+    seed: int = 0,
+) -> dict:
+    results = []
+    for scenario in scenarios:
+        results.append(run_scenario(scenario, steps, warmup_steps, seed))
+        print(format_result(results[-1]))
+    return {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "steps": steps,
+        "warmup_steps": warmup_steps,
+        "seed": seed,
+        "results": results,
+    }
+
+
+def format_result(result: dict) -> str:
+    # Summary line and microseconds per step of every phase
+    phases = " ".join(
+        f"{phase} {seconds / result['steps'] * 1e6:.0f}"
+        for phase, seconds in result["phases"].items()
+    )
+    return (
+        f"{result['name']}: {result['steps_per_second']:.0f} steps/s, "
+        f"{result['frames_per_second']:.0f} frames/s, "
+        f"{result['mean_projectiles']:.1f} projectiles\n"
+        f"  us/step: {phases}"
+    )
+
+
+def find_regressions(
+    benchmark: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE
+) -> list[str]:
+    # Scenarios that ran in both with steps per second more than tolerance
+    # below the baseline
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in benchmark["results"]:
+        baseline_result = baseline_results.get(result["name"])
+        if baseline_result is None:
+            continue
+        ratio = result["steps_per_second"] / baseline_result["steps_per_second"]
+        if ratio < 1 - tolerance:
+            regressions.append(
+                f"{result['name']}: {result['steps_per_second']:.0f} steps/s, "
+                f"{baseline_result['steps_per_second']:.0f} in the baseline "
+                f"({ratio - 1:+.0%})"
+            )
+    return regressions
+
+
+def _parse_list(type_):
+    def parse(value: str) -> list:
+        return [type_(item) for item in value.split(",")]
+
+    return parse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rollout throughput")
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="results to compare with, exits with 1 on regressions",
+    )
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--steps", type=int, default=BENCHMARK_STEPS)
+    parser.add_argument("--warmup-steps", type=int, default=WARMUP_STEPS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--targets", type=_parse_list(str), default=["game", "env"])
+    parser.add_argument(
+        "--policies", type=_parse_list(str), default=["random", "scripted"]
+    )
+    parser.add_argument("--players", type=_parse_list(int), default=PLAYER_COUNTS)
+    parser.add_argument(
+        "--frames-per-step", type=_parse_list(int), default=FRAMES_PER_STEPS
+    )
+    parser.add_argument("--shoot-rates", type=_parse_list(float), default=SHOOT_RATES)
+    args = parser.parse_args()
+
+    scenarios = make_scenarios(
+        args.targets,
+        args.policies,
+        args.players,
+        args.frames_per_step,
+        args.shoot_rates,
+    )
+    benchmark = run_benchmark(scenarios, args.steps, args.warmup_steps, args.seed)
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(benchmark, output_file, indent=2)
+        print("Wrote", len(benchmark["results"]), "results to", args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(benchmark, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
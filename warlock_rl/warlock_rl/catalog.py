@@ -0,0 +1,234 @@
+import argparse
+import os
+import sqlite3
+from collections import Counter
+from dataclasses import dataclass
+
+import ujson as json
+
+from warlock_rl.replay_file import REPLAY_FILE_NAME, ReplayFile, ReplayFileError
+
+# SQLite index of the logged games in a log directory so the latest game
+# or games by outcome can be found without listing and reading every log.
+# Games are added by the replay writer once their replay is written (see
+# Game.log_game), older logs can be added with
+#
+# python -m warlock_rl.catalog [--log-dir ../logs]
+#
+# The replay server (src/serve.ts) reads it too.
+
+LOG_DIR = os.path.join("..", "logs")
+CATALOG_FILE_NAME = "catalog.sqlite3"
+
+# Other processes might be writing, wait for them instead of failing
+CATALOG_TIMEOUT = 30.0
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    name TEXT PRIMARY KEY,
+    game_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    seed INTEGER,
+    num_players INTEGER,
+    num_frames INTEGER,
+    num_rounds INTEGER,
+    winners TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS games_timestamp ON games (timestamp);
+CREATE INDEX IF NOT EXISTS games_game_id ON games (game_id);
+CREATE TABLE IF NOT EXISTS game_winners (
+    player_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (player_id, timestamp, name)
+);
+"""
+
+# Logs from before replay files
+STATE_HISTORY_FILE_NAMES = ("state_history.json", "state_history.json.gz")
+
+
+@dataclass
+class CatalogEntry:
+    # Name of the game's directory in the log directory
+    name: str
+    game_id: str
+    # time.time_ns() when the game was logged
+    timestamp: int
+    # Log file relative to the log directory
+    path: str
+    # Unknown for logs without a replay
+    seed: int | None
+    num_players: int | None
+    num_frames: int | None
+    num_rounds: int | None
+    # Players that won the most rounds
+    winners: list[int]
+
+
+def game_winners(round_winners: list[list[int]]) -> list[int]:
+    num_wins = Counter(player_id for winners in round_winners for player_id in winners)
+    if not num_wins:
+        return []
+    most_wins = max(num_wins.values())
+    return sorted(
+        player_id for player_id, wins in num_wins.items() if wins == most_wins
+    )
+
+
+def _parse_log_name(name: str) -> tuple[int, str]:
+    # Game log directories are named {time.time_ns()}_{game id}
+    timestamp, _, game_id = name.partition("_")
+    return int(timestamp), game_id
+
+
+class ReplayCatalog:
+    def __init__(self, log_dir: str = LOG_DIR):
+        self._log_dir = log_dir
+        os.makedirs(log_dir, exist_ok=True)
+        self._connection = sqlite3.connect(
+            os.path.join(log_dir, CATALOG_FILE_NAME), timeout=CATALOG_TIMEOUT
+        )
+        # Lets the server read while games are being added
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(CATALOG_SCHEMA)
+
+    @property
+    def log_dir(self) -> str:
+        return self._log_dir
+
+    def add(self, path: str, replay: dict | None = None):
+        # Adds the game logged to the path, a file in the game's directory.
+        # Without the replay only the name and path are known.
+        path = os.path.relpath(path, self._log_dir)
+        name = os.path.dirname(path)
+        timestamp, game_id = _parse_log_name(name)
+
+        winners = []
+        values = (None, None, None, None)
+        if replay is not None:
+            winners = game_winners(replay.get("roundWinners", []))
+            values = (
+                replay["start"].get("seed"),
+                replay["start"].get("numPlayers"),
+                replay["lastFrame"],
+                len(replay.get("roundWinners", [])),
+            )
+
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, game_id, timestamp, path, *values, json.dumps(winners)),
+            )
+            self._connection.execute("DELETE FROM game_winners WHERE name = ?", (name,))
+            self._connection.executemany(
+                "INSERT INTO game_winners VALUES (?, ?, ?)",
+                [(player_id, timestamp, name) for player_id in winners],
+            )
+
+    def latest(self) -> CatalogEntry | None:
+        entries = self.find(limit=1)
+        return entries[0] if entries else None
+
+    def get(self, game_id: str) -> CatalogEntry | None:
+        row = self._connection.execute(
+            "SELECT * FROM games WHERE game_id = ?", (game_id,)
+        ).fetchone()
+        return None if row is None else self._make_entry(row)
+
+    def find(
+        self,
+        winner: int | None = None,
+        seed: int | None = None,
+        limit: int | None = None,
+    ) -> list[CatalogEntry]:
+        # Newest first
+        query = "SELECT games.* FROM games"
+        conditions = []
+        parameters = []
+        if winner is not None:
+            query += " JOIN game_winners USING (name, timestamp)"
+            conditions.append("game_winners.player_id = ?")
+            parameters.append(winner)
+        if seed is not None:
+            conditions.append("games.seed = ?")
+            parameters.append(seed)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY games.timestamp DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+
+        return [
+            self._make_entry(row)
+            for row in self._connection.execute(query, parameters).fetchall()
+        ]
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def index_logs(self) -> int:
+        # Adds the logs in the log directory that are missing, returns how
+        # many were added
+        names = {row[0] for row in self._connection.execute("SELECT name FROM games")}
+        num_added = 0
+        for name in sorted(os.listdir(self._log_dir)):
+            game_dir = os.path.join(self._log_dir, name)
+            if name in names or not os.path.isdir(game_dir):
+                continue
+
+            replay_path = os.path.join(game_dir, REPLAY_FILE_NAME)
+            if os.path.exists(replay_path):
+                try:
+                    # Only reads the index of the replay file
+                    with ReplayFile(replay_path) as replay_file:
+                        replay = {
+                            "start": replay_file.start,
+                            "lastFrame": replay_file.last_frame,
+                            "roundWinners": replay_file.round_winners,
+                        }
+                except (OSError, ReplayFileError) as e:
+                    print("Failed to read", replay_path, e)
+                    continue
+                self.add(replay_path, replay)
+                num_added += 1
+                continue
+
+            for file_name in STATE_HISTORY_FILE_NAMES:
+                if os.path.exists(os.path.join(game_dir, file_name)):
+                    self.add(os.path.join(game_dir, file_name))
+                    num_added += 1
+                    break
+        return num_added
+
+    def _make_entry(self, row: tuple) -> CatalogEntry:
+        *values, winners = row
+        return CatalogEntry(*values, winners=json.loads(winners))
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self) -> "ReplayCatalog":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add logged games to the catalog")
+    parser.add_argument("--log-dir", default=LOG_DIR)
+    args = parser.parse_args()
+
+    with ReplayCatalog(args.log_dir) as catalog:
+        num_added = catalog.index_logs()
+        print(f"Added {num_added} games, {len(catalog)} in the catalog")
+        latest = catalog.latest()
+        if latest is not None:
+            print("Latest", latest.path)
+
+
+if __name__ == "__main__":
+    main()
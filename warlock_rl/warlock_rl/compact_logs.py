@@ -0,0 +1,226 @@
+import argparse
+import gzip
+import lzma
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import iglob
+from typing import Literal
+
+import ujson as json
+
+from warlock_rl.replay_file import REPLAY_FILE_NAME, write_replay_file
+
+# Compacts the game logs: compresses state histories and other JSON logs
+# and converts replays saved as JSON into replay files (see
+# replay_file.py). Files are compacted in parallel into temporary files
+# that are renamed when done, and the original files are removed
+# afterwards. A manifest in the log directory records every compacted
+# file so runs can be interrupted and continued.
+#
+# python -m warlock_rl.compact_logs [--codec xz] [--keep] [--replays]
+
+LOG_DIR = os.path.join("..", "logs")
+MANIFEST_FILE_NAME = "compaction_manifest.jsonl"
+
+# gzip can be read by the replay server, xz is denser but only for archiving
+Codec = Literal["gzip", "xz"]
+CODEC_EXTENSIONS: dict[Codec, str] = {"gzip": ".gz", "xz": ".xz"}
+
+# Replays saved as JSON before replay files existed
+JSON_REPLAY_FILE_NAMES = ("replay.json", "replay.json.gz")
+
+
+def _read_log(path: str) -> bytes:
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as log_file:
+            return log_file.read()
+    with open(path, "rb") as log_file:
+        return log_file.read()
+
+
+def _output_path(path: str, codec: Codec, replays: bool) -> str:
+    if replays and os.path.basename(path) in JSON_REPLAY_FILE_NAMES:
+        return os.path.join(os.path.dirname(path), REPLAY_FILE_NAME)
+    return path.removesuffix(".gz") + CODEC_EXTENSIONS[codec]
+
+
+def compact_file(path: str, codec: Codec, replays: bool, keep: bool) -> str:
+    # Returns the path of the compacted file, runs in the worker processes
+    output_path = _output_path(path, codec, replays)
+    temp_path = f"{output_path}.tmp"
+    data = _read_log(path)
+
+    try:
+        if os.path.basename(output_path) == REPLAY_FILE_NAME:
+            write_replay_file(temp_path, json.loads(data))
+        elif codec == "xz":
+            with lzma.open(temp_path, "wb") as output_file:
+                output_file.write(data)
+        else:
+            with gzip.open(temp_path, "wb") as output_file:
+                output_file.write(data)
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    if not keep:
+        os.remove(path)
+    return output_path
+
+
+def find_logs(log_dir: str, codec: Codec, replays: bool) -> list[str]:
+    # Logs that aren't compacted with the codec yet
+    paths = []
+    for path in iglob(os.path.join(log_dir, "**", "*.json*"), recursive=True):
+        if path.endswith(".json"):
+            paths.append(path)
+        elif path.endswith(".json.gz") and (
+            codec != "gzip"
+            or (replays and os.path.basename(path) in JSON_REPLAY_FILE_NAMES)
+        ):
+            paths.append(path)
+    paths.sort()
+    return paths
+
+
+class Manifest:
+    # Compacted files by path, with the size and modification time they
+    # had so files that changed since get compacted again
+
+    def __init__(self, log_dir: str):
+        self._path = os.path.join(log_dir, MANIFEST_FILE_NAME)
+        self._entries: dict[str, dict] = {}
+        if os.path.exists(self._path):
+            with open(self._path, "r") as manifest_file:
+                for line in manifest_file:
+                    # The last line might be incomplete if a run was killed
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._entries[entry["path"]] = entry
+        self._file = open(self._path, "a")
+
+    def contains(self, path: str, stat: os.stat_result) -> bool:
+        entry = self._entries.get(path)
+        return (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime"] == stat.st_mtime_ns
+        )
+
+    def add(self, path: str, stat: os.stat_result, output_path: str):
+        entry = {
+            "path": path,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "output": output_path,
+        }
+        self._entries[path] = entry
+        # Flushed for every file so an interrupted run loses nothing
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def compact_logs(
+    log_dir: str = LOG_DIR,
+    codec: Codec = "gzip",
+    replays: bool = False,
+    keep: bool = False,
+    num_workers: int | None = None,
+) -> dict:
+    # Returns stats about the compacted files
+    manifest = Manifest(log_dir)
+    found_paths = find_logs(log_dir, codec, replays)
+    paths = []
+    stats = {}
+    for path in found_paths:
+        stat = os.stat(path)
+        if not manifest.contains(os.path.relpath(path, log_dir), stat):
+            paths.append(path)
+            stats[path] = stat
+
+    num_compacted = 0
+    num_failed = 0
+    bytes_in = 0
+    bytes_out = 0
+    start_time = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = {
+                executor.submit(compact_file, path, codec, replays, keep): path
+                for path in paths
+            }
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    output_path = future.result()
+                # Truncated gzip logs raise EOFError
+                except (OSError, EOFError, ValueError, KeyError, lzma.LZMAError) as e:
+                    num_failed += 1
+                    print("Failed to compact", path, e)
+                    continue
+
+                num_compacted += 1
+                bytes_in += stats[path].st_size
+                bytes_out += os.path.getsize(output_path)
+                manifest.add(
+                    os.path.relpath(path, log_dir),
+                    stats[path],
+                    os.path.relpath(output_path, log_dir),
+                )
+    finally:
+        manifest.close()
+
+    seconds = time.perf_counter() - start_time
+    return {
+        "num_compacted": num_compacted,
+        "num_failed": num_failed,
+        "num_skipped": len(found_paths) - len(paths),
+        "bytes_in": bytes_in,
+        "bytes_out": bytes_out,
+        "seconds": seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact the game logs")
+    parser.add_argument("--log-dir", default=LOG_DIR)
+    parser.add_argument("--codec", choices=CODEC_EXTENSIONS.keys(), default="gzip")
+    parser.add_argument(
+        "--replays",
+        action="store_true",
+        help="convert replays saved as JSON into replay files",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the original files")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="defaults to the number of CPUs"
+    )
+    args = parser.parse_args()
+
+    stats = compact_logs(
+        args.log_dir, args.codec, args.replays, args.keep, args.workers
+    )
+
+    seconds = max(stats["seconds"], 1e-9)
+    megabytes_in = stats["bytes_in"] / 1e6
+    megabytes_out = stats["bytes_out"] / 1e6
+    print(
+        f"Compacted {stats['num_compacted']} files "
+        f"({stats['num_failed']} failed, {stats['num_skipped']} skipped) "
+        f"in {seconds:.1f}s"
+    )
+    print(
+        f"{megabytes_in:.1f} MB -> {megabytes_out:.1f} MB, "
+        f"{stats['num_compacted'] / seconds:.1f} files/s, "
+        f"{megabytes_in / seconds:.1f} MB/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
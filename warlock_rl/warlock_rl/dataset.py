@@ -0,0 +1,361 @@
+import argparse
+import gzip
+import lzma
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable
+
+import numpy as np
+import ujson as json
+
+from warlock_rl.catalog import LOG_DIR, CatalogEntry, ReplayCatalog
+from warlock_rl.envs import (
+    ABILITY_IDS,
+    ABILITY_TARGET_SCALES,
+    FRAMES_PER_STEP,
+    OBS_LOC_RANGE,
+    WarlockEnv,
+    features_to_all_action_masks,
+    features_to_all_obs,
+)
+from warlock_rl.game import FEATURE_PLAYER, EntityFeatures, Game
+from warlock_rl.replay import ReplayReader
+from warlock_rl.replay_file import REPLAY_FILE_NAME
+
+# Exports the round steps of logged games as an offline dataset with the
+# observations, action masks, rewards and dones the players got from
+# WarlockEnv and the actions they took. Shards are directories with a .npy
+# file per column so they can be memory mapped, see load_dataset. Games
+# are taken from the replay catalog (see catalog.py). Replays are rebuilt
+# through a simulator, state histories of older logs are read directly.
+#
+# python -m warlock_rl.dataset OUTPUT_DIR [--winner 1000] [--limit 1000]
+
+DATASET_FILE_NAME = "dataset.json"
+GAMES_PER_SHARD = 64
+
+# Columns with their type and shape of a row
+DATASET_COLUMNS: dict[str, tuple[type, tuple[int, ...]]] = {
+    "obs": (np.float32, (WarlockEnv.round_num_obs,)),
+    "action_mask": (np.int8, (WarlockEnv.action_mask_size,)),
+    # Reward of the step, 1 for the winners when the round is over
+    "reward": (np.float32, ()),
+    # Whether the round was over after the step
+    "done": (np.bool_, ()),
+    # Action type and target location (see action_to_order), the target is
+    # nan for orders without one
+    "action_type": (np.int8, ()),
+    "action_target": (np.float32, (2,)),
+    "player": (np.int8, ()),
+    "frame": (np.int32, ()),
+    # Index of the game in the shard's games
+    "game": (np.int32, ()),
+}
+
+# State histories don't have the orders
+UNKNOWN_ACTION = -1
+
+
+def _read_state_history(path: str) -> list[dict]:
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as log_file:
+            return json.loads(log_file.read())
+    if path.endswith(".xz"):
+        with lzma.open(path, "rb") as log_file:
+            return json.loads(log_file.read())
+    with open(path, "rb") as log_file:
+        return json.loads(log_file.read())
+
+
+def order_to_action(order: dict) -> tuple[int, list[float]]:
+    # Inverse of action_to_order, returns the action type and target
+    match order["type"]:
+        case "stop":
+            action_type = 1
+        case "move":
+            action_type = 2
+        case "useAbility":
+            action_type = 3 + ABILITY_IDS.index(order["abilityId"])
+        case _:
+            raise ValueError(f"Unhandled order {order}")
+
+    if "target" not in order:
+        return action_type, [np.nan, np.nan]
+    scale = ABILITY_TARGET_SCALES.get(order.get("abilityId"), 1.0)
+    return action_type, [
+        order["target"]["e1"] / scale / OBS_LOC_RANGE + 0.5,
+        order["target"]["e2"] / scale / OBS_LOC_RANGE + 0.5,
+    ]
+
+
+def game_steps(
+    states: Iterable[dict],
+    orders: dict[tuple[int, int], dict] | None,
+    frames_per_step: int = FRAMES_PER_STEP,
+) -> dict[str, list]:
+    # Rows of every living player on every round step, the steps are the
+    # same as WarlockEnv's with frames_per_step. `orders` are the orders set
+    # by frame and player entity id, None if they are unknown.
+    rows = {name: [] for name in DATASET_COLUMNS if name != "game"}
+    # Last row of every player that had a step in the round, gets the
+    # reward when the round is over
+    last_rows: dict[int, int] = {}
+
+    for state in states:
+        for event in state["gameEvents"]["events"]:
+            if event["type"] == "roundOver":
+                for entity_id, row in last_rows.items():
+                    rows["reward"][row] = 1 if entity_id in event["winners"] else 0
+                    rows["done"][row] = True
+                last_rows = {}
+
+        # The round starts while stepping its start frame, the first step
+        # is on the frame after it
+        game_state = state["gameState"]
+        if (
+            game_state["state"]["type"] != "round"
+            or (game_state["frameNumber"] - game_state["state"]["startFrame"] - 1)
+            % frames_per_step
+            != 0
+        ):
+            continue
+
+        features = EntityFeatures.from_state(state, ABILITY_IDS)
+        obs = features_to_all_obs(features)
+        action_masks = features_to_all_action_masks(features)
+        for player_index, player in enumerate(features.players):
+            if player[FEATURE_PLAYER["health"]] <= 0:
+                continue
+
+            entity_id = int(player[FEATURE_PLAYER["entityId"]])
+            if orders is None:
+                action = UNKNOWN_ACTION, [np.nan, np.nan]
+            elif (game_state["frameNumber"], entity_id) in orders:
+                action = order_to_action(orders[game_state["frameNumber"], entity_id])
+            else:
+                # No order is the "nothing" action
+                action = 0, [np.nan, np.nan]
+
+            last_rows[entity_id] = len(rows["obs"])
+            rows["obs"].append(obs[player_index])
+            rows["action_mask"].append(action_masks[player_index])
+            rows["reward"].append(0)
+            rows["done"].append(False)
+            rows["action_type"].append(action[0])
+            rows["action_target"].append(action[1])
+            rows["player"].append(player_index)
+            rows["frame"].append(game_state["frameNumber"])
+
+    return rows
+
+
+def _replay_orders(commands: list[dict]) -> dict[tuple[int, int], dict]:
+    orders = {}
+    for command in commands:
+        if command["command"]["type"] == "setOrder":
+            entity_id = int(command["command"]["entityId"])
+            orders[command["frame"], entity_id] = command["command"]["order"]
+    return orders
+
+
+def export_shard(
+    log_dir: str, entries: list[CatalogEntry], shard_dir: str
+) -> tuple[int, int, list[str]]:
+    # Writes the rows of the games into the shard directory, returns the
+    # number of rows and frames and the names of the exported games. Games
+    # that fail are left out. Runs in the worker processes.
+    rows = {name: [] for name in DATASET_COLUMNS}
+    num_frames = 0
+    game_names = []
+    # Only started for replays, rebuilding frames sends the state deltas
+    game: Game | None = None
+    try:
+        for entry in entries:
+            path = os.path.join(log_dir, entry.path)
+            try:
+                if os.path.basename(path) == REPLAY_FILE_NAME:
+                    if game is None:
+                        game = Game(delta_state=True)
+                    reader = ReplayReader(path, game=game)
+                    try:
+                        # Replays recorded before framesPerStep used the default
+                        game_rows = game_steps(
+                            reader.frames(),
+                            _replay_orders(reader.commands()),
+                            reader.start.get("framesPerStep", FRAMES_PER_STEP),
+                        )
+                    finally:
+                        reader.close()
+                    game_frames = reader.num_frames
+                else:
+                    states = _read_state_history(path)
+                    game_rows = game_steps(states, None)
+                    game_frames = len(states)
+            except Exception as e:
+                print("Failed to export", entry.name, e)
+                # The simulator might be in any state
+                if game is not None:
+                    game.close()
+                    game = None
+                continue
+
+            num_frames += game_frames
+            for name, values in game_rows.items():
+                rows[name] += values
+            rows["game"] += [len(game_names)] * len(game_rows["obs"])
+            game_names.append(entry.name)
+    finally:
+        if game is not None:
+            game.close()
+
+    # Written to a temporary directory first so readers never see a
+    # partial shard
+    temp_dir = f"{shard_dir}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    for name, (dtype, shape) in DATASET_COLUMNS.items():
+        np.save(
+            os.path.join(temp_dir, f"{name}.npy"),
+            np.array(rows[name], dtype).reshape(-1, *shape),
+        )
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.replace(temp_dir, shard_dir)
+    return len(rows["obs"]), num_frames, game_names
+
+
+def export_dataset(
+    output_dir: str,
+    log_dir: str = LOG_DIR,
+    winner: int | None = None,
+    limit: int | None = None,
+    games_per_shard: int = GAMES_PER_SHARD,
+    num_workers: int | None = None,
+) -> dict:
+    # Exports the newest games in the catalog, returns stats about them.
+    # Games and shards that fail are left out of the dataset and counted in
+    # the stats.
+    with ReplayCatalog(log_dir) as catalog:
+        entries = catalog.find(winner=winner, limit=limit)
+    # Oldest first
+    entries.reverse()
+    shards = [
+        entries[i : i + games_per_shard]
+        for i in range(0, len(entries), games_per_shard)
+    ]
+
+    os.makedirs(output_dir, exist_ok=True)
+    dataset = {"columns": list(DATASET_COLUMNS), "shards": []}
+    num_rows = 0
+    num_frames = 0
+    num_failed_shards = 0
+    num_failed_games = 0
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(num_workers) as executor:
+        futures = {
+            executor.submit(
+                export_shard,
+                log_dir,
+                shard_entries,
+                os.path.join(output_dir, f"shard_{i:05d}"),
+            ): i
+            for i, shard_entries in enumerate(shards)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            shard_dir = os.path.join(output_dir, f"shard_{i:05d}")
+            try:
+                shard_rows, shard_frames, game_names = future.result()
+            except Exception as e:
+                num_failed_shards += 1
+                num_failed_games += len(shards[i])
+                print(f"Failed to export shard_{i:05d}", e)
+                # Also the shard of an earlier export to this directory, it
+                # isn't in the dataset
+                shutil.rmtree(f"{shard_dir}.tmp", ignore_errors=True)
+                shutil.rmtree(shard_dir, ignore_errors=True)
+                continue
+
+            num_rows += shard_rows
+            num_frames += shard_frames
+            num_failed_games += len(shards[i]) - len(game_names)
+            dataset["shards"].append(
+                {
+                    "name": f"shard_{i:05d}",
+                    "num_rows": shard_rows,
+                    "games": game_names,
+                }
+            )
+
+    dataset["shards"].sort(key=lambda shard: shard["name"])
+    with open(os.path.join(output_dir, DATASET_FILE_NAME), "w") as dataset_file:
+        json.dump(dataset, dataset_file, indent=2)
+
+    return {
+        "num_games": len(entries) - num_failed_games,
+        "num_shards": len(shards) - num_failed_shards,
+        "num_failed_games": num_failed_games,
+        "num_failed_shards": num_failed_shards,
+        "num_rows": num_rows,
+        "num_frames": num_frames,
+        "seconds": time.perf_counter() - start_time,
+    }
+
+
+def load_dataset(path: str) -> list[dict[str, np.ndarray]]:
+    # Columns of every shard, memory mapped
+    with open(os.path.join(path, DATASET_FILE_NAME), "r") as dataset_file:
+        dataset = json.load(dataset_file)
+    return [
+        {
+            name: np.load(
+                os.path.join(path, shard["name"], f"{name}.npy"), mmap_mode="r"
+            )
+            for name in dataset["columns"]
+        }
+        for shard in dataset["shards"]
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export logged games as a dataset")
+    parser.add_argument("output_dir")
+    parser.add_argument("--log-dir", default=LOG_DIR)
+    parser.add_argument(
+        "--winner", type=int, default=None, help="only games won by the player"
+    )
+    parser.add_argument("--limit", type=int, default=None, help="only the newest games")
+    parser.add_argument("--games-per-shard", type=int, default=GAMES_PER_SHARD)
+    parser.add_argument(
+        "--workers", type=int, default=None, help="defaults to the number of CPUs"
+    )
+    args = parser.parse_args()
+
+    stats = export_dataset(
+        args.output_dir,
+        args.log_dir,
+        args.winner,
+        args.limit,
+        args.games_per_shard,
+        args.workers,
+    )
+
+    seconds = max(stats["seconds"], 1e-9)
+    print(
+        f"Exported {stats['num_rows']} rows of {stats['num_games']} games "
+        f"into {stats['num_shards']} shards in {seconds:.1f}s"
+    )
+    if stats["num_failed_games"]:
+        print(
+            f"Failed to export {stats['num_failed_games']} games "
+            f"({stats['num_failed_shards']} whole shards)"
+        )
+    print(
+        f"{stats['num_games'] / seconds:.1f} games/s, "
+        f"{stats['num_frames'] / seconds:.0f} frames/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
-from typing import Any, Sequence, SupportsFloat
+from typing import Any, Callable, Container, Literal, Sequence, SupportsFloat
 
 import gymnasium as gym
 import numpy as np
-from ray.rllib.env.multi_agent_env import MultiAgentEnv
-
-from warlock_rl.game import Game
+from ray.rllib.env.base_env import BaseEnv
+from ray.rllib.env.multi_agent_env import MultiAgentEnv, MultiAgentEnvWrapper
+from ray.rllib.utils.typing import EnvID, MultiEnvDict
+
+from warlock_rl.game import (
+    FEATURE_ABILITY,
+    FEATURE_HEADER,
+    FEATURE_PLAYER,
+    FEATURE_PROJECTILE,
+    EntityFeatures,
+    Game,
+    Simulator,
+    SimulatorCommandError,
+    SimulatorError,
+    StepAllError,
+    step_all,
+)
+from warlock_rl.pool import get_simulator_pool
+from warlock_rl.writer import get_replay_writer
 
 NUM_PLAYERS = 4
 FRAMES_PER_STEP = 6
@@ -19,6 +35,9 @@ PROJECTILE_OBS_SIZE = 13
 MAX_ARENA_RADIUS = 32 * 15
 START_GOLD_RANGE = (10, 80)
 SHOP_FRAMES = 5
+OBS_VALIDATION_SAMPLE_RATE = 0.01
+# Fraction of games that are logged
+LOG_GAME_RATE = 0.03
 
 index_to_entity_id = {i: str(i + 1000) for i in range(NUM_PLAYERS)}
 index_to_entity_id.update({f"shop_{i}": str(i + 1000) for i in range(NUM_PLAYERS)})
@@ -37,6 +56,41 @@ ABILITY_IDS = [
     "lightning",
 ]
 
+# Abilities that are used without a target
+UNTARGETED_ABILITY_IDS = {"scourge", "shield"}
+# Targets of short range abilities are scaled down so the whole target
+# location range is useful
+ABILITY_TARGET_SCALES = {"teleport": 0.25, "swap": 0.25}
+
+# Orders of the action types without their target, in the same order as the
+# action mask! None for doing nothing.
+MOVE_ACTION_TYPE = 2
+ACTION_ORDER_TEMPLATES: list[dict | None] = [
+    None,
+    {"type": "stop"},
+    {"type": "move"},
+    *({"type": "useAbility", "abilityId": ability_id} for ability_id in ABILITY_IDS),
+]
+# Ability the player has to own for the order by action type
+ACTION_ABILITY_IDS: list[str | None] = [None, None, None, *ABILITY_IDS]
+# Scale of the target by action type, None for orders without a target
+ACTION_TARGET_SCALES: list[float | None] = [
+    None,
+    None,
+    1.0,
+    *(
+        (
+            None
+            if ability_id in UNTARGETED_ABILITY_IDS
+            else ABILITY_TARGET_SCALES.get(ability_id, 1.0)
+        )
+        for ability_id in ABILITY_IDS
+    ),
+]
+_ACTION_TARGET_SCALE_ARRAY = np.array(
+    [np.nan if scale is None else scale for scale in ACTION_TARGET_SCALES]
+)
+
 
 # TODO: make work for arbitrary number of players
 def state_to_obs(state: dict, self_player_index: int) -> np.ndarray:
@@ -180,7 +234,6 @@ def state_to_obs(state: dict, self_player_index: int) -> np.ndarray:
         obs.shape,
         WarlockEnv.round_observation_space["obs"].shape,
     )
-    assert all(0 <= o <= 1 for o in obs), obs
 
     return obs
 
@@ -215,7 +268,6 @@ def state_to_action_mask(state: dict, self_player_index: int) -> np.ndarray:
 
     # assert action_mask.shape == WarlockEnv.round_action_space.shape
     assert action_mask.shape[0] == WarlockEnv.action_mask_size
-    assert all(0 <= o <= 1 for o in action_mask), action_mask
 
     return action_mask
 
@@ -256,151 +308,309 @@ def state_to_shop_action_mask(state: dict, self_player_index: int) -> np.ndarray
         action_mask.shape,
         WarlockEnv.shop_action_space.n,
     )
-    assert all(0 <= o <= 1 for o in action_mask), action_mask
 
     return action_mask
 
 
+# off: never check the observations
+# vectorized: check all observations on every step
+# sampled: check all observations on a random fraction of the steps
+ObsValidation = Literal["off", "vectorized", "sampled"]
+
+
+def count_obs_violations(obs: np.ndarray) -> np.ndarray:
+    # Number of values outside of [0, 1] (including NaN) per row
+    return np.count_nonzero(~((obs >= 0) & (obs <= 1)), axis=-1)
+
+
+# Row i is player index i followed by the other players in order
+PLAYER_ORDERS = np.array(
+    [[i] + [j for j in range(NUM_PLAYERS) if j != i] for i in range(NUM_PLAYERS)]
+)
+
+
+def nearest_projectiles(distance_squared: np.ndarray) -> np.ndarray:
+    # Indices of the NUM_PROJECTILES nearest projectiles for every agent
+    # sorted by distance, with ties in entity order like a stable sort.
+    if distance_squared.shape[1] <= NUM_PROJECTILES:
+        return np.argsort(distance_squared, axis=1, kind="stable")
+
+    nearest = np.argpartition(distance_squared, NUM_PROJECTILES - 1, axis=1)[
+        :, :NUM_PROJECTILES
+    ]
+
+    # argpartition isn't stable so with ties at the cutoff it can pick other
+    # projectiles than the stable sort would, use the sort for those agents.
+    cutoff = np.take_along_axis(distance_squared, nearest, 1).max(axis=1)
+    ties = (distance_squared <= cutoff[:, None]).sum(axis=1) > NUM_PROJECTILES
+    if ties.any():
+        nearest[ties] = np.argsort(distance_squared[ties], axis=1, kind="stable")[
+            :, :NUM_PROJECTILES
+        ]
+
+    order = np.lexsort(
+        (nearest, np.take_along_axis(distance_squared, nearest, 1)), axis=1
+    )
+    return np.take_along_axis(nearest, order, 1)
+
+
+def features_to_all_obs(features: EntityFeatures) -> np.ndarray:
+    # Same as state_to_obs but for all players at once using the packed entity
+    # features. Player rows are in entity id order, so row i is player index i.
+    # Returns [players, obs].
+    header = features.header
+    players = features.players
+    abilities = features.abilities
+    projectiles = features.projectiles
+
+    frame_number = header[FEATURE_HEADER["frameNumber"]]
+    delta_time = header[FEATURE_HEADER["deltaTime"]]
+
+    x = players[:, FEATURE_PLAYER["x"]]
+    y = players[:, FEATURE_PLAYER["y"]]
+    facing = players[:, FEATURE_PLAYER["facing"]]
+
+    # [self, other]
+    dx = x[None, :] - x[:, None]
+    dy = y[None, :] - y[:, None]
+
+    owned = abilities[..., FEATURE_ABILITY["owned"]]
+    last_used_frame = abilities[..., FEATURE_ABILITY["lastUsedFrame"]]
+    cooldown = abilities[..., FEATURE_ABILITY["cooldown"]]
+    remaining_cooldown = (
+        np.maximum(
+            0.0,
+            last_used_frame * delta_time + cooldown - frame_number * delta_time,
+        )
+        / cooldown
+    )
+    relative_cooldowns = np.where(
+        owned == 0, 1, np.where(np.isnan(last_used_frame), 0.0, remaining_cooldown)
+    )
+
+    # [players, PLAYER_OBS_SIZE + abilities], relative columns are filled in
+    # per agent below
+    player_obs = np.concatenate(
+        [
+            np.stack(
+                [
+                    players[:, FEATURE_PLAYER["health"]] / 100,
+                    players[:, FEATURE_PLAYER["knockbackMultiplier"]] / 3.0,
+                    x / OBS_LOC_RANGE + 0.5,
+                    y / OBS_LOC_RANGE + 0.5,
+                    np.zeros_like(x),
+                    np.zeros_like(x),
+                    players[:, FEATURE_PLAYER["vx"]] / OBS_VELOCITY_RANGE + 0.5,
+                    players[:, FEATURE_PLAYER["vy"]] / OBS_VELOCITY_RANGE + 0.5,
+                    np.zeros_like(x),
+                    np.cos(facing) * 0.5 + 0.5,
+                    np.sin(facing) * 0.5 + 0.5,
+                    players[:, FEATURE_PLAYER["casting"]],
+                    players[:, FEATURE_PLAYER["moving"]],
+                    players[:, FEATURE_PLAYER["shielded"]],
+                    players[:, FEATURE_PLAYER["linked"]],
+                    np.sqrt(x * x + y * y) / (2 * MAX_ARENA_RADIUS),
+                ],
+                axis=-1,
+            ),
+            relative_cooldowns,
+        ],
+        axis=-1,
+    )
+
+    # [self, other, PLAYER_OBS_SIZE + abilities]
+    relative_player_obs = np.repeat(player_obs[None], len(players), axis=0)
+    relative_player_obs[..., 4] = dx / OBS_RELATIVE_LOC_RANGE + 0.5
+    relative_player_obs[..., 5] = dy / OBS_RELATIVE_LOC_RANGE + 0.5
+    relative_player_obs[..., 8] = np.sqrt(dx * dx + dy * dy) / OBS_RELATIVE_LOC_RANGE
+    relative_player_obs = np.take_along_axis(
+        relative_player_obs, PLAYER_ORDERS[..., None], 1
+    )
+
+    # [self, projectile]
+    projectile_dx = projectiles[None, :, FEATURE_PROJECTILE["x"]] - x[:, None]
+    projectile_dy = projectiles[None, :, FEATURE_PROJECTILE["y"]] - y[:, None]
+    projectile_distance_squared = (
+        projectile_dx * projectile_dx + projectile_dy * projectile_dy
+    )
+    nearest = nearest_projectiles(projectile_distance_squared)
+    nearest_dx = np.take_along_axis(projectile_dx, nearest, 1)
+    nearest_dy = np.take_along_axis(projectile_dy, nearest, 1)
+    nearest_projectile_features = projectiles[nearest]
+    self_owner = players[:, FEATURE_PLAYER["owningPlayerId"]]
+
+    # [self, NUM_PROJECTILES, PROJECTILE_OBS_SIZE]
+    projectile_obs = np.full((len(players), NUM_PROJECTILES, PROJECTILE_OBS_SIZE), 0.5)
+    projectile_obs[:, : nearest.shape[1]] = np.stack(
+        [
+            nearest_projectile_features[..., FEATURE_PROJECTILE["x"]] / OBS_LOC_RANGE
+            + 0.5,
+            nearest_projectile_features[..., FEATURE_PROJECTILE["y"]] / OBS_LOC_RANGE
+            + 0.5,
+            nearest_dx / OBS_RELATIVE_LOC_RANGE + 0.5,
+            nearest_dy / OBS_RELATIVE_LOC_RANGE + 0.5,
+            nearest_projectile_features[..., FEATURE_PROJECTILE["vx"]]
+            / OBS_VELOCITY_RANGE
+            + 0.5,
+            nearest_projectile_features[..., FEATURE_PROJECTILE["vy"]]
+            / OBS_VELOCITY_RANGE
+            + 0.5,
+            np.sqrt(np.take_along_axis(projectile_distance_squared, nearest, 1))
+            / OBS_RELATIVE_LOC_RANGE,
+            nearest_projectile_features[..., FEATURE_PROJECTILE["homing"]],
+            nearest_projectile_features[..., FEATURE_PROJECTILE["boomerang"]],
+            nearest_projectile_features[..., FEATURE_PROJECTILE["swap"]],
+            nearest_projectile_features[..., FEATURE_PROJECTILE["gravity"]],
+            nearest_projectile_features[..., FEATURE_PROJECTILE["link"]],
+            nearest_projectile_features[..., FEATURE_PROJECTILE["owningPlayerId"]]
+            != self_owner[:, None],
+        ],
+        axis=-1,
+    )
+
+    observations = np.concatenate(
+        [
+            np.full(
+                (len(players), 1),
+                header[FEATURE_HEADER["arenaRadius"]] / MAX_ARENA_RADIUS,
+            ),
+            relative_player_obs.reshape(len(players), -1),
+            projectile_obs.reshape(len(players), -1),
+        ],
+        axis=-1,
+    )
+
+    obs = np.clip(observations.astype(np.float32), 0, 1, dtype=np.float32)
+
+    assert obs.shape[1:] == WarlockEnv.round_observation_space["obs"].shape, (
+        obs.shape,
+        WarlockEnv.round_observation_space["obs"].shape,
+    )
+
+    return obs
+
+
+def features_to_all_action_masks(features: EntityFeatures) -> np.ndarray:
+    # Same as state_to_action_mask for all players using the packed entity
+    # features. Returns [players, action mask].
+    frame_number = features.header[FEATURE_HEADER["frameNumber"]]
+    delta_time = features.header[FEATURE_HEADER["deltaTime"]]
+    abilities = features.abilities
+    last_used_frame = abilities[..., FEATURE_ABILITY["lastUsedFrame"]]
+    ready_time = (
+        last_used_frame * delta_time + abilities[..., FEATURE_ABILITY["cooldown"]]
+    )
+    can_use = (abilities[..., FEATURE_ABILITY["owned"]] != 0) & (
+        np.isnan(last_used_frame) | (frame_number * delta_time >= ready_time)
+    )
+
+    # First 3 are nothing, stop, move. Casting players can only do nothing
+    # or stop.
+    casting = features.players[:, FEATURE_PLAYER["casting"]] != 0
+    action_masks = np.ones((len(abilities), WarlockEnv.action_mask_size), np.int8)
+    action_masks[:, 2] = ~casting
+    action_masks[:, 3:] = can_use & ~casting[:, None]
+
+    return action_masks
+
+
+def features_to_all_shop_obs(features: EntityFeatures) -> np.ndarray:
+    # Same as state_to_shop_obs for all players using the packed entity
+    # features. Returns [players, shop obs].
+    gold = features.players[:, FEATURE_PLAYER["gold"]]
+    owned = features.abilities[..., FEATURE_ABILITY["owned"]]
+    return np.clip(
+        np.concatenate([gold[:, None] / 50, owned], axis=-1),
+        0,
+        1,
+        dtype=np.float32,
+    )
+
+
+def features_to_all_shop_action_masks(features: EntityFeatures) -> np.ndarray:
+    # Same as state_to_shop_action_mask for all players using the packed
+    # entity features. Returns [players, shop action mask].
+    gold = features.players[:, FEATURE_PLAYER["gold"]]
+    abilities = features.abilities
+    cost = abilities[..., FEATURE_ABILITY["cost"]]
+    # NaN costs (not buyable) compare as False
+    can_buy = (abilities[..., FEATURE_ABILITY["owned"]] == 0) & (gold[:, None] >= cost)
+
+    return np.concatenate(
+        [np.ones((len(abilities), 1), np.float32), can_buy.astype(np.float32)],
+        axis=-1,
+    )
+
+
 def action_to_order(
-    player_index: int, state: dict, action: dict[str, int | Sequence[float]]
+    abilities: Container[str], action: dict[str, int | Sequence[float]]
 ) -> dict | None:
-    player_entity_id = index_to_entity_id[player_index]
-
-    # Chosen action
+    # `abilities` are the ids of the abilities the player owns
     action_type = action["action_type"]
+    if not 0 <= action_type < len(ACTION_ORDER_TEMPLATES):
+        raise ValueError(f"Unhandled action {action=} {action_type=}")
+
+    template = ACTION_ORDER_TEMPLATES[action_type]
+    ability_id = ACTION_ABILITY_IDS[action_type]
+    if template is None or (ability_id is not None and ability_id not in abilities):
+        return None
+
+    # TODO: Targets offset from an enemy (move_target_type/cast_target_type)
+    order = template.copy()
+    scale = ACTION_TARGET_SCALES[action_type]
+    if scale is not None:
+        location = action[
+            (
+                "move_target_location"
+                if action_type == MOVE_ACTION_TYPE
+                else "cast_target_location"
+            )
+        ]
+        order["target"] = {
+            "e1": scale * (OBS_LOC_RANGE * (location[0] - 0.5)),
+            "e2": scale * (OBS_LOC_RANGE * (location[1] - 0.5)),
+        }
+    return order
+
+
+def actions_to_orders(
+    abilities: Sequence[Container[str]],
+    action_types: np.ndarray,
+    move_target_locations: np.ndarray,
+    cast_target_locations: np.ndarray,
+) -> list[dict | None]:
+    # Same as action_to_order for the stacked actions of several players,
+    # the targets of all of them are computed at once
+    action_types = np.asarray(action_types)
+    if np.any((action_types < 0) | (action_types >= len(ACTION_ORDER_TEMPLATES))):
+        raise ValueError(f"Unhandled action types {action_types}")
+
+    locations = np.where(
+        (action_types == MOVE_ACTION_TYPE)[:, None],
+        move_target_locations,
+        cast_target_locations,
+    )
+    targets = _ACTION_TARGET_SCALE_ARRAY[action_types, None] * (
+        OBS_LOC_RANGE * (locations - 0.5)
+    )
 
-    # Target location
-    move_target = {
-        "e1": OBS_LOC_RANGE * (action["move_target_location"][0] - 0.5),
-        "e2": OBS_LOC_RANGE * (action["move_target_location"][1] - 0.5),
-    }
-    cast_target = {
-        "e1": OBS_LOC_RANGE * (action["cast_target_location"][0] - 0.5),
-        "e2": OBS_LOC_RANGE * (action["cast_target_location"][1] - 0.5),
-    }
-    target = move_target if action_type == 2 else cast_target
-
-    # Add enemy location to target.
-    # Also make the offset much smaller.
-    # TODO: Make this work for multiple enemies
-    # move_is_target_offset_from_enemy = action["move_target_type"] == 1
-    # cast_is_target_offset_from_enemy = action["cast_target_type"] == 1
-    # if (move_is_target_offset_from_enemy and action_type == 2) or (
-    #     cast_is_target_offset_from_enemy and action_type != 2
-    # ):
-    #     enemy_index = 1 - player_index  # TODO
-    #     enemy_entity_id = index_to_entity_id[enemy_index]
-    #     enemy_location = state["bodies"][enemy_entity_id]["location"]
-    #     target["e1"] * 0.2
-    #     target["e2"] * 0.2
-    #     target["e1"] += enemy_location["e1"]
-    #     target["e2"] += enemy_location["e2"]
-
-    # This needs to be in the same order as the action mask!
-    match action_type:
-        case 0:
-            return None
-        case 1:
-            return {
-                "type": "stop",
-            }
-        case 2:
-            return {
-                "type": "move",
-                "target": target,
-            }
-        case 3:
-            if "shoot" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "shoot",
-                "target": target,
-            }
-        case 4:
-            if "teleport" not in state["abilities"][player_entity_id]:
-                return None
-            target["e1"] *= 0.25
-            target["e2"] *= 0.25
-            return {
-                "type": "useAbility",
-                "abilityId": "teleport",
-                "target": target,
-            }
-        case 5:
-            if "swap" not in state["abilities"][player_entity_id]:
-                return None
-            target["e1"] *= 0.25
-            target["e2"] *= 0.25
-            return {
-                "type": "useAbility",
-                "abilityId": "swap",
-                "target": target,
-            }
-        case 6:
-            if "scourge" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "scourge",
-            }
-        case 7:
-            if "homing" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "homing",
-                "target": target,
-            }
-        case 8:
-            if "shield" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "shield",
-            }
-        case 9:
-            if "cluster" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "cluster",
-                "target": target,
-            }
-        case 10:
-            if "gravity" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "gravity",
-                "target": target,
-            }
-        case 11:
-            if "link" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "link",
-                "target": target,
-            }
-        case 12:
-            if "boomerang" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "boomerang",
-                "target": target,
-            }
-        case 13:
-            if "lightning" not in state["abilities"][player_entity_id]:
-                return None
-            return {
-                "type": "useAbility",
-                "abilityId": "lightning",
-                "target": target,
-            }
-
-    raise ValueError(f"Unhandled action {action=} {action_type=}")
+    orders = []
+    for player_abilities, action_type, target in zip(
+        abilities, action_types.tolist(), targets.tolist()
+    ):
+        template = ACTION_ORDER_TEMPLATES[action_type]
+        ability_id = ACTION_ABILITY_IDS[action_type]
+        if template is None or (
+            ability_id is not None and ability_id not in player_abilities
+        ):
+            orders.append(None)
+            continue
+
+        order = template.copy()
+        if ACTION_TARGET_SCALES[action_type] is not None:
+            order["target"] = {"e1": target[0], "e2": target[1]}
+        orders.append(order)
+    return orders
 
 
 class WarlockEnv(MultiAgentEnv):
@@ -444,15 +654,41 @@ class WarlockEnv(MultiAgentEnv):
     )
     # shop_observation_space = gym.spaces.Box(0, 1, (shop_num_obs,))
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, config: dict | None = None, *args, **kwargs) -> None:
+        config = config or {}
+        self._config = config
+
         self._num_players = NUM_PLAYERS
+        # Frames the game advances per round step
+        self._frames_per_step = config.get("frames_per_step", FRAMES_PER_STEP)
+        self._log_game_rate = config.get("log_game_rate", LOG_GAME_RATE)
+
+        self._obs_validation: ObsValidation = config.get("obs_validation", "off")
+        self._obs_validation_sample_rate = config.get(
+            "obs_validation_sample_rate", OBS_VALIDATION_SAMPLE_RATE
+        )
+        assert self._obs_validation in ("off", "vectorized", "sampled")
+        # Total number of invalid observation values seen by this env
+        self._obs_violations = 0
+        self._infos = {}
 
         self._agent_ids = set(
             list(range(self.num_players))
             + [f"shop_{i}" for i in range(self.num_players)]
         )
 
-        self._game = Game()
+        # Simulator processes are leased from a pool shared by the envs of
+        # this process, unless the game is hosted by the simulator of a
+        # VectorWarlockEnv. The game is made on the first reset.
+        self._simulator_pool = get_simulator_pool(config.get("simulator_pool_size", 0))
+        self._vector_env: VectorWarlockEnv | None = None
+
+        # Logged games are written in the background, "replay_queue_policy"
+        # is "block" or "drop" for when "replay_queue_size" replays wait
+        self._replay_writer = get_replay_writer(
+            config.get("replay_queue_size"), config.get("replay_queue_policy")
+        )
+        self._last_obs = {}
 
         super().__init__()
 
@@ -460,60 +696,185 @@ class WarlockEnv(MultiAgentEnv):
     def num_players(self):
         return self._num_players
 
+    def _make_game(self) -> Game:
+        return Game(
+            simulator=(
+                self._simulator_pool.lease()
+                if self._vector_env is None
+                else self._vector_env.simulator
+            ),
+            feature_ability_ids=ABILITY_IDS,
+            lazy_state=True,
+            replay_writer=self._replay_writer,
+        )
+
+    def _replace_game(self):
+        if self._vector_env is not None:
+            # Replaces the games of all envs hosted by the simulator
+            self._vector_env.replace_simulator()
+            return
+
+        print("Simulator failed, replacing it")
+        self._simulator_pool.release(self._game.simulator)
+        self._game = self._make_game()
+
+    def _set_vector_env(self, vector_env: "VectorWarlockEnv | None"):
+        # Moves the game to the simulator of the vector env, the previous
+        # game is dropped
+        if self._game is not None and self._vector_env is None:
+            self._simulator_pool.release(self._game.simulator)
+        self._vector_env = vector_env
+        self._game = self._make_game()
+
+    def to_base_env(
+        self,
+        make_env: Callable[[int], Any] | None = None,
+        num_envs: int = 1,
+        remote_envs: bool = False,
+        remote_env_batch_wait_ms: int = 0,
+        restart_failed_sub_environments: bool = False,
+    ) -> BaseEnv:
+        # Called by RLlib to vectorize the envs of a rollout worker
+        if remote_envs or not self._config.get("vector_env", False):
+            return super().to_base_env(
+                make_env=make_env,
+                num_envs=num_envs,
+                remote_envs=remote_envs,
+                remote_env_batch_wait_ms=remote_env_batch_wait_ms,
+                restart_failed_sub_environments=restart_failed_sub_environments,
+            )
+        return VectorWarlockEnv(
+            make_env=make_env,
+            existing_envs=[self],
+            num_envs=num_envs,
+            restart_failed_sub_environments=restart_failed_sub_environments,
+        )
+
+    @property
+    def obs_violations(self) -> int:
+        return self._obs_violations
+
+    def _validate_obs(self, agent_ids: list, *observations: np.ndarray):
+        # Checks the [players, X] observations and action masks and reports
+        # the violations of the agents in the info dict
+        self._infos = {}
+        if self._obs_validation == "off" or (
+            self._obs_validation == "sampled"
+            and np.random.random() >= self._obs_validation_sample_rate
+        ):
+            return
+
+        violations = sum(count_obs_violations(obs) for obs in observations)
+        self._obs_violations += int(violations.sum())
+        self._infos = {
+            agent_id: {
+                "obs_violations": int(violations[i]),
+                "total_obs_violations": self._obs_violations,
+            }
+            for i, agent_id in enumerate(agent_ids)
+        }
+
     def _make_round_obs(self):
         assert not self.shopping
 
+        features = self._game.entity_features
+        obs = features_to_all_obs(features)
+        action_masks = features_to_all_action_masks(features)
+        self._validate_obs(list(range(self.num_players)), obs, action_masks)
         return {
             i: {
-                "obs": state_to_obs(self._game.state, i),
-                "action_mask": state_to_action_mask(self._game.state, i),
+                "obs": obs[i],
+                "action_mask": action_masks[i],
             }
             for i in range(self.num_players)
-            if self._game.state["healths"][index_to_entity_id[i]]["current"] > 0
+            if features.players[i, FEATURE_PLAYER["health"]] > 0
         }
 
     def _make_shop_obs(self):
         assert self.shopping
+        features = self._game.entity_features
+        obs = features_to_all_shop_obs(features)
+        action_masks = features_to_all_shop_action_masks(features)
+        self._validate_obs(
+            [f"shop_{i}" for i in range(self.num_players)], obs, action_masks
+        )
         return {
             f"shop_{i}": {
-                "obs": state_to_shop_obs(self._game.state, i),
-                "action_mask": state_to_shop_action_mask(self._game.state, i),
+                "obs": obs[i],
+                "action_mask": action_masks[i],
             }
             for i in range(self.num_players)
         }
 
     def _make_obs(self):
-        return self._make_shop_obs() if self.shopping else self._make_round_obs()
+        self._last_obs = (
+            self._make_shop_obs() if self.shopping else self._make_round_obs()
+        )
+        return self._last_obs
+
+    def _make_infos(self, obs: dict) -> dict:
+        # Infos can only be given for agents that have an observation
+        return {
+            agent_id: info for agent_id, info in self._infos.items() if agent_id in obs
+        }
 
     @property
     def shopping(self) -> bool:
-        return self._game.state["gameState"]["state"]["type"] == "shop"
+        return self._game.view.shopping
 
     @property
-    def shop_frames(self) -> bool:
-        assert self.shopping
-        return (
-            self._game.state["gameState"]["frameNumber"]
-            - self._game.state["gameState"]["state"]["startFrame"]
-        )
+    def shop_frames(self) -> int:
+        view = self._game.view
+        assert view.shopping
+        return view.frame - view.state_start_frame
 
     def reset(
         self, *, seed: int | None = None, options: dict[str, Any] | None = None
     ) -> dict[str, np.ndarray]:
         super().reset(seed=seed, options=options)
 
-        if self._game.started and self._game.logging:
-            self._game.log_game()
-
+        if self._game is None:
+            self._game = self._make_game()
+
+        try:
+            if self._game.started and self._game.logging:
+                self._game.log_game()
+
+            # Continue from a snapshot (see snapshot()) instead of starting
+            # a new game
+            if options is not None and "snapshot" in options:
+                self._game.restore(options["snapshot"])
+            else:
+                self._start_game(seed)
+        except SimulatorCommandError:
+            # Eg. an unknown snapshot, the simulator is fine
+            raise
+        except SimulatorError:
+            # Snapshots are lost with the simulator
+            self._replace_game()
+            self._start_game(seed)
+
+        obs = self._make_obs()
+        return obs, self._make_infos(obs)
+
+    def snapshot(self) -> str:
+        # Handle of a snapshot of the current game that can be passed to
+        # reset(options={"snapshot": handle}) of this env or any other env
+        # hosted by the same simulator (eg. in a VectorWarlockEnv)
+        return self._game.snapshot()
+
+    def release_snapshot(self, handle: str):
+        self._game.release_snapshot(handle)
+
+    def _start_game(self, seed: int | None):
         self._game.start(
             num_players=self.num_players,
             start_gold=np.random.randint(*START_GOLD_RANGE),
             seed=seed,
-            logging=np.random.random() < 0.03,
+            logging=np.random.random() < self._log_game_rate,
+            frames_per_step=self._frames_per_step,
         )
 
-        return self._make_obs(), {}
-
     def _constant_agent_dict(self, constant, with_all: bool) -> dict:
         d = {i: constant for i in range(self.num_players)}
         d.update({f"shop_{i}": constant for i in range(self.num_players)})
@@ -525,6 +886,36 @@ class WarlockEnv(MultiAgentEnv):
         self,
         actions: dict[int | str, dict[str, int | Sequence[float]] | int],
     ) -> tuple[Any, SupportsFloat, bool, bool, dict[str, Any]]:
+        try:
+            return self._step(actions)
+        except SimulatorCommandError as e:
+            # The simulator is fine, only this episode can't go on
+            print("Command failed, truncating the episode:", e)
+            return self._truncated_result()
+        except SimulatorError:
+            # Truncate the episode, the next reset starts a new game on a new
+            # simulator
+            self._replace_game()
+            return self._truncated_result()
+
+    def _step(
+        self,
+        actions: dict[int | str, dict[str, int | Sequence[float]] | int],
+    ) -> tuple[Any, SupportsFloat, bool, bool, dict[str, Any]]:
+        shopping = self.shopping
+        self._game.step(steps=self._send_actions(actions), stop_on_state_change=True)
+        if self._send_ready():
+            self._game.step(1)
+        return self._step_result(shopping, actions)
+
+    # A step is split up into sending the actions, stepping the game and
+    # making the result so VectorWarlockEnv can step all of its games at once
+
+    def _send_actions(
+        self,
+        actions: dict[int | str, dict[str, int | Sequence[float]] | int],
+    ) -> int:
+        # Sends the actions and returns how many frames to step the game
         if self.shopping:
             assert set(actions.keys()) == set(
                 f"shop_{i}" for i in range(self.num_players)
@@ -538,53 +929,53 @@ class WarlockEnv(MultiAgentEnv):
                     )
 
             # Step game one frame so buys go through
-            self._game.step(1)
-            assert self.shopping
-
-            # Set ready after a few shop frames
-            if self.shop_frames >= SHOP_FRAMES:
-                for player_id in self._game.state["players"].keys():
-                    self._game.set_ready(player_id, True)
-                self._game.step(1)
-                assert not self.shopping
-
-            return (
-                self._make_obs(),
-                self._constant_agent_dict(0, False),
-                self._constant_agent_dict(False, True),
-                self._constant_agent_dict(False, True),
-                {},
-            )
+            return 1
         else:
             #assert set(actions.keys()) == set(range(self.num_players))
-            # Set player orders
-            # TODO: Do this in one batch call
+            # Set player orders, these are sent in one batch with the step
+            abilities = self._game.view.abilities
             for player_index, action in actions.items():
                 order = action_to_order(
-                    player_index=player_index, state=self._game.state, action=action
+                    abilities=abilities[index_to_entity_id[player_index]],
+                    action=action,
                 )
                 if order is not None:
                     self._game.order(
                         entity_id=index_to_entity_id[player_index], order=order
                     )
 
-            # Advance the game, check for termination on every frame
-            terminated = False
-            for _ in range(FRAMES_PER_STEP):
-                self._game.step(steps=1)
-                new_state = self._game.state
+            # Advance the game, stops early when the round is over
+            return self._frames_per_step
 
-                terminated = (
-                    new_state["gameState"]["round"] == MAX_ROUNDS and self.shopping
-                )
-                if terminated or self.shopping:
-                    break
-
-            # Check for round over and give reward to winners
-            winners = []
-            for event in new_state["gameEvents"]["events"]:
-                if event["type"] == "roundOver":
-                    winners += event["winners"]
+    def _send_ready(self) -> bool:
+        # Set ready after a few shop frames, returns whether the game has to
+        # be stepped again for it
+        if not self.shopping or self.shop_frames < SHOP_FRAMES:
+            return False
+        for player_id in self._game.view.player_ids:
+            self._game.set_ready(player_id, True)
+        return True
+
+    def _step_result(
+        self,
+        shopping: bool,
+        actions: dict[int | str, dict[str, int | Sequence[float]] | int],
+    ) -> tuple[Any, SupportsFloat, bool, bool, dict[str, Any]]:
+        if shopping:
+            obs = self._make_obs()
+            return (
+                obs,
+                self._constant_agent_dict(0, False),
+                self._constant_agent_dict(False, True),
+                self._constant_agent_dict(False, True),
+                self._make_infos(obs),
+            )
+        else:
+            view = self._game.view
+            terminated = view.round == MAX_ROUNDS and view.shopping
+
+            # Give reward to the winners if the round is over
+            winners = view.round_winners
             rewards = {
                 i: 1 if int(index_to_entity_id[i]) in winners else 0
                 for i in range(self.num_players)
@@ -593,10 +984,143 @@ class WarlockEnv(MultiAgentEnv):
             for k, v in rewards.copy().items():
                 rewards[f"shop_{k}"] = v
 
+            obs = self._make_obs()
             return (
-                self._make_obs(),
+                obs,
                 rewards,
                 self._constant_agent_dict(terminated, True),
                 self._constant_agent_dict(False, True),
-                {},
+                self._make_infos(obs),
             )
+
+    def _truncated_result(
+        self,
+    ) -> tuple[Any, SupportsFloat, bool, bool, dict[str, Any]]:
+        # Result that ends the episode when the simulator or its game failed
+        return (
+            self._last_obs,
+            {agent_id: 0 for agent_id in self._last_obs},
+            self._constant_agent_dict(False, True),
+            self._constant_agent_dict(True, True),
+            {},
+        )
+
+    def close(self):
+        if self._game is None:
+            return
+        try:
+            self._game.close()
+        except SimulatorError:
+            pass
+        if self._vector_env is None:
+            self._simulator_pool.release(self._game.simulator)
+
+
+class VectorWarlockEnv(MultiAgentEnvWrapper):
+    # Vectorized WarlockEnvs whose games are all hosted by one simulator
+    # process. All sub envs that get actions are stepped together with
+    # step_all() so a step costs one or two round trips to the simulator
+    # however many envs there are. Enabled with the "vector_env" env config.
+
+    def __init__(
+        self,
+        make_env: Callable[[int], WarlockEnv],
+        existing_envs: list[WarlockEnv],
+        num_envs: int,
+        restart_failed_sub_environments: bool = False,
+    ):
+        self._simulator_pool = get_simulator_pool()
+        self._simulator = self._simulator_pool.lease()
+
+        super().__init__(
+            make_env=make_env,
+            existing_envs=existing_envs,
+            num_envs=num_envs,
+            restart_failed_sub_environments=restart_failed_sub_environments,
+        )
+        for env in self.envs:
+            env._set_vector_env(self)
+
+    @property
+    def simulator(self) -> Simulator:
+        return self._simulator
+
+    def replace_simulator(self):
+        # Moves all games to a new simulator and truncates the episodes that
+        # were running on the failed one
+        print("Simulator failed, replacing it")
+        self._simulator_pool.release(self._simulator)
+        self._simulator = self._simulator_pool.lease()
+
+        for env_id, (env, env_state) in enumerate(zip(self.envs, self.env_states)):
+            env._set_vector_env(self)
+            if (
+                env_state.initialized
+                and env_id not in self.terminateds
+                and env_id not in self.truncateds
+            ):
+                self.truncateds.add(env_id)
+                env_state.observe(*env._truncated_result())
+
+    def try_restart(self, env_id: EnvID | None = None) -> None:
+        super().try_restart(env_id)
+        for env in self.envs:
+            if env._vector_env is None:
+                env._set_vector_env(self)
+
+    def send_actions(self, action_dict: MultiEnvDict) -> None:
+        for env_id in action_dict:
+            if env_id in self.terminateds or env_id in self.truncateds:
+                raise ValueError(
+                    f"Env {env_id} is already done and cannot accept new actions"
+                )
+
+        envs = {env_id: self.envs[env_id] for env_id in action_dict}
+        try:
+            shopping = {env_id: env.shopping for env_id, env in envs.items()}
+            steps = [
+                env._send_actions(action_dict[env_id]) for env_id, env in envs.items()
+            ]
+            failed_env_ids = self._step_all(
+                envs, steps=steps, stop_on_state_change=True
+            )
+            ready_envs = {
+                env_id: env
+                for env_id, env in envs.items()
+                if env_id not in failed_env_ids and env._send_ready()
+            }
+            failed_env_ids |= self._step_all(ready_envs, steps=1)
+            results = {
+                env_id: env._step_result(shopping[env_id], action_dict[env_id])
+                for env_id, env in envs.items()
+                if env_id not in failed_env_ids
+            }
+        except SimulatorError:
+            # Only a failed simulator takes down the other envs
+            self.replace_simulator()
+            return
+
+        for env_id in failed_env_ids:
+            self.truncateds.add(env_id)
+            self.env_states[env_id].observe(*envs[env_id]._truncated_result())
+        for env_id, result in results.items():
+            _, _, terminateds, truncateds, _ = result
+            if terminateds["__all__"]:
+                self.terminateds.add(env_id)
+            if truncateds["__all__"]:
+                self.truncateds.add(env_id)
+            self.env_states[env_id].observe(*result)
+
+    def _step_all(self, envs: dict[EnvID, WarlockEnv], **kwargs) -> set[EnvID]:
+        # Steps the games of the envs, returns the envs whose games failed.
+        # Their episodes are truncated like in WarlockEnv.step.
+        try:
+            step_all([env._game for env in envs.values()], **kwargs)
+        except StepAllError as e:
+            print("Commands failed, truncating the episodes:", e)
+            return {env_id for env_id, env in envs.items() if env._game in e.errors}
+        return set()
+
+    def stop(self) -> None:
+        super().stop()
+        self._simulator_pool.release(self._simulator)
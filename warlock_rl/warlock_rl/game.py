@@ -1,14 +1,20 @@
-import gzip
 import os
+import select
+import struct
 import subprocess
 import time
 import uuid
 from dataclasses import dataclass
-from typing import Literal
+from typing import Container, Literal
 
+import numpy as np
 import ujson as json
 from dataclasses_json import dataclass_json
 
+from warlock_rl.catalog import LOG_DIR
+from warlock_rl.replay_file import REPLAY_FILE_NAME
+from warlock_rl.writer import ReplayWriter, get_replay_writer
+
 
 @dataclass_json
 @dataclass
@@ -32,6 +38,10 @@ class CLICommandStartGame:
     seed: int | None = None
     deltaTime: float | None = None
     startGold: int | None = None
+    recordReplay: bool = False
+    keyframeInterval: int | None = None
+    framesPerStep: int | None = None
+    gameId: str | None = None
 
 
 @dataclass_json
@@ -39,6 +49,8 @@ class CLICommandStartGame:
 class CLICommandStep:
     type: Literal["step"] = "step"
     steps: int = 1
+    stopOnStateChange: bool = False
+    gameId: str | None = None
 
 
 @dataclass_json
@@ -47,6 +59,7 @@ class CLICommandSetOrder:
     entityId: int
     order: dict
     type: Literal["setOrder"] = "setOrder"
+    gameId: str | None = None
 
 
 @dataclass_json
@@ -55,6 +68,7 @@ class CLICommandSetReady:
     entityId: int
     ready: bool
     type: Literal["setReady"] = "setReady"
+    gameId: str | None = None
 
 
 @dataclass_json
@@ -63,20 +77,408 @@ class CLICommandBuyAbility:
     entityId: int
     abilityId: int
     type: Literal["buyAbility"] = "buyAbility"
+    gameId: str | None = None
 
 
 @dataclass_json
 @dataclass
 class CLICommandGetComponents:
     type: Literal["getComponents"] = "getComponents"
+    delta: bool = False
+    componentNames: list[str] | None = None
+    gameId: str | None = None
+
+
+@dataclass_json
+@dataclass
+class CLICommandGetEntityFeatures:
+    abilityIds: list[str]
+    type: Literal["getEntityFeatures"] = "getEntityFeatures"
+    gameId: str | None = None
+
+
+@dataclass_json
+@dataclass
+class CLICommandGetReplay:
+    type: Literal["getReplay"] = "getReplay"
+    gameId: str | None = None
+
+
+@dataclass_json
+@dataclass
+class CLICommandReplayFrame:
+    path: str
+    frame: int
+    type: Literal["replayFrame"] = "replayFrame"
+    gameId: str | None = None
+
+
+@dataclass_json
+@dataclass
+class CLICommandStepAll:
+    gameIds: list[str]
+    type: Literal["stepAll"] = "stepAll"
+    steps: int | list[int] = 1
+    stopOnStateChange: bool = False
+    delta: bool = False
+    componentNames: list[str] | None = None
+
+
+@dataclass_json
+@dataclass
+class CLICommandCloseGame:
+    type: Literal["closeGame"] = "closeGame"
+    gameId: str | None = None
+
+
+@dataclass_json
+@dataclass
+class CLICommandSnapshot:
+    handle: str
+    type: Literal["snapshot"] = "snapshot"
+    gameId: str | None = None
+
+
+@dataclass_json
+@dataclass
+class CLICommandRestore:
+    handle: str
+    type: Literal["restore"] = "restore"
+    gameId: str | None = None
+
+
+@dataclass_json
+@dataclass
+class CLICommandReleaseSnapshot:
+    handle: str
+    type: Literal["releaseSnapshot"] = "releaseSnapshot"
+
+
+@dataclass_json
+@dataclass
+class CLICommandPing:
+    type: Literal["ping"] = "ping"
+
+
+@dataclass_json
+@dataclass
+class CLICommandGetTimings:
+    type: Literal["getTimings"] = "getTimings"
+
+
+@dataclass_json
+@dataclass
+class CLICommandBatch:
+    commands: list[dict]
+    type: Literal["batch"] = "batch"
+
+
+RESPONSE_HEADER = struct.Struct("<I")
+# Set in the header of responses that are the error of a failed command,
+# {"gameId", "message", "response"} (see src/cli/index.ts)
+RESPONSE_ERROR_FLAG = 1 << 31
+INITIAL_READ_BUFFER_SIZE = 128_000
 
 
 CLICommand = (
-    CLICommandStartGame | CLICommandStep | CLICommandSetOrder | CLICommandGetComponents
+    CLICommandBatch
+    | CLICommandStartGame
+    | CLICommandStep
+    | CLICommandSetOrder
+    | CLICommandSetReady
+    | CLICommandBuyAbility
+    | CLICommandGetComponents
+    | CLICommandGetEntityFeatures
+    | CLICommandGetReplay
+    | CLICommandReplayFrame
+    | CLICommandStepAll
+    | CLICommandCloseGame
+    | CLICommandSnapshot
+    | CLICommandRestore
+    | CLICommandReleaseSnapshot
+    | CLICommandPing
+    | CLICommandGetTimings
 )
 
+# Layout of the getEntityFeatures response, has to match src/cli/features.ts
+FEATURE_HEADER_FIELDS = [
+    "frameNumber",
+    "deltaTime",
+    "arenaRadius",
+    "shop",
+    "stateStartFrame",
+    "round",
+    "numPlayers",
+    "numProjectiles",
+]
+FEATURE_PLAYER_FIELDS = [
+    "entityId",
+    "owningPlayerId",
+    "x",
+    "y",
+    "vx",
+    "vy",
+    "facing",
+    "health",
+    "knockbackMultiplier",
+    "casting",
+    "moving",
+    "shielded",
+    "linked",
+    "gold",
+]
+FEATURE_ABILITY_FIELDS = [
+    "owned",
+    "lastUsedFrame",
+    "cooldown",
+    "cost",
+]
+FEATURE_PROJECTILE_FIELDS = [
+    "entityId",
+    "owningPlayerId",
+    "x",
+    "y",
+    "vx",
+    "vy",
+    "homing",
+    "boomerang",
+    "swap",
+    "gravity",
+    "link",
+]
+FEATURE_HEADER = {name: i for i, name in enumerate(FEATURE_HEADER_FIELDS)}
+FEATURE_PLAYER = {name: i for i, name in enumerate(FEATURE_PLAYER_FIELDS)}
+FEATURE_ABILITY = {name: i for i, name in enumerate(FEATURE_ABILITY_FIELDS)}
+FEATURE_PROJECTILE = {name: i for i, name in enumerate(FEATURE_PROJECTILE_FIELDS)}
+
+
+# Components read on every step by games with lazy_state, everything
+# else comes from the entity features
+LAZY_STATE_COMPONENT_NAMES = ["gameEvents"]
+
+
+class StateView:
+    # The parts of a state that are read on every env step, parsed once
+    # per read state (see Game.view)
+
+    __slots__ = (
+        "frame",
+        "round",
+        "shopping",
+        "state_start_frame",
+        "player_ids",
+        "abilities",
+        "round_winners",
+    )
+
+    def __init__(
+        self,
+        frame: int,
+        round: int,
+        shopping: bool,
+        state_start_frame: int,
+        player_ids: list[str],
+        abilities: dict[str, Container[str]],
+        round_winners: list[int],
+    ):
+        self.frame = frame
+        self.round = round
+        self.shopping = shopping
+        self.state_start_frame = state_start_frame
+        self.player_ids = player_ids
+        # Ids of the owned abilities by entity id
+        self.abilities = abilities
+        # Winners of the round that ended on this frame, if one did
+        self.round_winners = round_winners
+
+    @staticmethod
+    def from_state(state: dict) -> "StateView":
+        game_state = state["gameState"]
+        return StateView(
+            frame=game_state["frameNumber"],
+            round=game_state["round"],
+            shopping=game_state["state"]["type"] == "shop",
+            state_start_frame=game_state["state"]["startFrame"],
+            player_ids=list(state["players"]),
+            # The dicts of the state so only valid until the next read
+            abilities=state["abilities"],
+            round_winners=_round_winners(state["gameEvents"]),
+        )
+
+    @staticmethod
+    def from_features(
+        features: "EntityFeatures", ability_ids: list[str], game_events: dict
+    ) -> "StateView":
+        # Abilities are only known if they are in the features
+        header = features.header
+        player_ids = [
+            str(int(entity_id))
+            for entity_id in features.players[:, FEATURE_PLAYER["entityId"]]
+        ]
+        owned = features.abilities[..., FEATURE_ABILITY["owned"]] > 0
+        return StateView(
+            frame=int(header[FEATURE_HEADER["frameNumber"]]),
+            round=int(header[FEATURE_HEADER["round"]]),
+            shopping=bool(header[FEATURE_HEADER["shop"]]),
+            state_start_frame=int(header[FEATURE_HEADER["stateStartFrame"]]),
+            player_ids=player_ids,
+            abilities={
+                player_id: {
+                    ability_id
+                    for ability_id, is_owned in zip(ability_ids, player_owned)
+                    if is_owned
+                }
+                for player_id, player_owned in zip(player_ids, owned)
+            },
+            round_winners=_round_winners(game_events),
+        )
+
+
+def _round_winners(game_events: dict) -> list[int]:
+    return [
+        winner
+        for event in game_events["events"]
+        if event["type"] == "roundOver"
+        for winner in event["winners"]
+    ]
+
+
+@dataclass
+class EntityFeatures:
+    # [header fields]
+    header: np.ndarray
+    # [players, player fields]
+    players: np.ndarray
+    # [players, abilities, ability fields]
+    abilities: np.ndarray
+    # [projectiles, projectile fields]
+    projectiles: np.ndarray
+
+    @staticmethod
+    def from_buffer(buffer, num_abilities: int) -> "EntityFeatures":
+        # Views into the buffer without copying
+        features = np.frombuffer(buffer, dtype="<f8")
+        header = features[: len(FEATURE_HEADER_FIELDS)]
+        num_players = int(header[FEATURE_HEADER["numPlayers"]])
+        num_projectiles = int(header[FEATURE_HEADER["numProjectiles"]])
+
+        player_size = len(FEATURE_PLAYER_FIELDS) + num_abilities * len(
+            FEATURE_ABILITY_FIELDS
+        )
+        players_end = len(header) + num_players * player_size
+        players = features[len(header) : players_end].reshape(num_players, player_size)
+        projectiles = features[players_end:].reshape(
+            num_projectiles, len(FEATURE_PROJECTILE_FIELDS)
+        )
+
+        return EntityFeatures(
+            header=header,
+            players=players[:, : len(FEATURE_PLAYER_FIELDS)],
+            abilities=players[:, len(FEATURE_PLAYER_FIELDS) :].reshape(
+                num_players, num_abilities, len(FEATURE_ABILITY_FIELDS)
+            ),
+            projectiles=projectiles,
+        )
+
+    @staticmethod
+    def from_state(state: dict, ability_ids: list[str]) -> "EntityFeatures":
+        # Same as the getEntityFeatures response but extracted from a state dict
+        game_state = state["gameState"]
+        player_ids = list(state["players"].keys())
+        projectile_ids = list(state["projectiles"].keys())
+
+        header = np.array(
+            [
+                game_state["frameNumber"],
+                game_state["deltaTime"],
+                state["arena"]["radius"],
+                1 if game_state["state"]["type"] == "shop" else 0,
+                game_state["state"]["startFrame"],
+                game_state["round"],
+                len(player_ids),
+                len(projectile_ids),
+            ],
+            dtype=np.float64,
+        )
+
+        players = np.empty((len(player_ids), len(FEATURE_PLAYER_FIELDS)))
+        abilities = np.empty(
+            (len(player_ids), len(ability_ids), len(FEATURE_ABILITY_FIELDS))
+        )
+        for i, player_id in enumerate(player_ids):
+            body = state["bodies"][player_id]
+            unit = state["units"][player_id]
+            shop = state["shops"][player_id]
+            players[i] = [
+                int(player_id),
+                state["playerOwneds"][player_id]["owningPlayerId"],
+                body["location"]["e1"],
+                body["location"]["e2"],
+                body["velocity"]["e1"],
+                body["velocity"]["e2"],
+                body["facing"],
+                state["healths"][player_id]["current"],
+                unit["knockbackMultiplier"],
+                1 if unit["state"]["type"] == "casting" else 0,
+                1 if unit["state"]["type"] == "moving" else 0,
+                1 if player_id in state["shields"] else 0,
+                1 if player_id in state["pulls"] else 0,
+                shop["gold"],
+            ]
+            for j, ability_id in enumerate(ability_ids):
+                ability = state["abilities"][player_id].get(ability_id)
+                abilities[i, j] = [
+                    0 if ability is None else 1,
+                    np.nan if ability is None else ability.get("lastUsedFrame", np.nan),
+                    np.nan if ability is None else ability["cooldown"],
+                    shop["costs"].get(ability_id, np.nan),
+                ]
+
+        projectiles = np.empty((len(projectile_ids), len(FEATURE_PROJECTILE_FIELDS)))
+        for i, projectile_id in enumerate(projectile_ids):
+            body = state["bodies"][projectile_id]
+            projectile = state["projectiles"][projectile_id]
+            projectiles[i] = [
+                int(projectile_id),
+                state["playerOwneds"][projectile_id]["owningPlayerId"],
+                body["location"]["e1"],
+                body["location"]["e2"],
+                body["velocity"]["e1"],
+                body["velocity"]["e2"],
+                1 if projectile.get("homing", False) else 0,
+                1 if projectile.get("boomerang", False) else 0,
+                1 if projectile.get("swap", False) else 0,
+                1 if projectile.get("gravity", False) else 0,
+                1 if projectile.get("link", False) else 0,
+            ]
+
+        return EntityFeatures(
+            header=header,
+            players=players,
+            abilities=abilities,
+            projectiles=projectiles,
+        )
+
+
+class SimulatorError(RuntimeError):
+    pass
+
+
+class SimulatorCommandError(SimulatorError):
+    # A command failed but the simulator and its other games are fine
+    pass
+
+
+class StepAllError(SimulatorCommandError):
+    # Some games of a step_all failed, the others were stepped
+    def __init__(self, errors: dict["Game", SimulatorCommandError]):
+        super().__init__("; ".join(str(error) for error in errors.values()))
+        self.errors = errors
+
+
+class Simulator:
+    # A simulator process (src/cli/index.ts) and the protocol to talk to it
 
-class Game:
     def __init__(self):
         self._process = subprocess.Popen(
             ["bun", "run", os.path.join("src", "cli", "index.ts")],
@@ -86,36 +488,271 @@ class Game:
             bufsize=0,
         )
 
-        self._state_history = []
+        # Responses are read into this buffer which grows when needed
+        self._read_buffer = bytearray(INITIAL_READ_BUFFER_SIZE)
+        self._header_buffer = bytearray(RESPONSE_HEADER.size)
+
+        # Commands are queued and written in one batch before the next read
+        self._pending_commands: list[dict] = []
+
+        # Errors of commands without a response by game id, read along with
+        # the responses until their game takes them (see Game)
+        self._command_errors: dict[str | None, list[str]] = {}
+
+    @property
+    def alive(self) -> bool:
+        return self._process.poll() is None
+
+    def ping(self, timeout: float | None = None) -> bool:
+        # Checks that the simulator is running and responding
+        if not self.alive:
+            return False
+        try:
+            self.send_command(CLICommandPing())
+            self.flush()
+            if timeout is not None:
+                readable, _, _ = select.select([self._process.stdout], [], [], timeout)
+                if not readable:
+                    return False
+            return bytes(self.read_response()) == b"pong"
+        except SimulatorError:
+            return False
+
+    def timings(self) -> dict[str, float]:
+        # Seconds the simulator spent parsing commands, simulating, serializing
+        # components, packing entity features and writing responses since the
+        # last call. They are only measured after the first call.
+        self.send_command(CLICommandGetTimings())
+        return json.loads(self.read_response())
+
+    def _read_into(self, buffer: memoryview):
+        while buffer:
+            num_read = self._process.stdout.readinto(buffer)
+            if not num_read:
+                raise SimulatorError("Simulator process closed its output")
+            buffer = buffer[num_read:]
+
+    def read_response(self) -> memoryview:
+        # Returns a view into the read buffer, only valid until the next read.
+        # Raises the error of the command if it failed.
+        self.flush()
+        while True:
+            self._read_into(memoryview(self._header_buffer))
+            (length,) = RESPONSE_HEADER.unpack(self._header_buffer)
+            is_error = length & RESPONSE_ERROR_FLAG
+            length &= ~RESPONSE_ERROR_FLAG
+            if length > len(self._read_buffer):
+                self._read_buffer = bytearray(max(length, 2 * len(self._read_buffer)))
+            response = memoryview(self._read_buffer)[:length]
+            self._read_into(response)
+            if not is_error:
+                return response
+
+            error = json.loads(response)
+            if error["response"]:
+                raise SimulatorCommandError(error["message"])
+            self._command_errors.setdefault(error["gameId"], []).append(
+                error["message"]
+            )
+
+    def pop_command_errors(self, game_id: str | None) -> list[str]:
+        # Errors of the game's commands without a response read so far
+        return self._command_errors.pop(game_id, [])
+
+    def send_command(self, command: CLICommand):
+        # The commands are flat dataclasses so their __dict__ can be encoded
+        # directly which is much faster than to_json()
+        self._pending_commands.append(command.__dict__)
+
+    def flush(self):
+        if not self._pending_commands:
+            return
+
+        if len(self._pending_commands) == 1:
+            (command,) = self._pending_commands
+        else:
+            command = CLICommandBatch(commands=self._pending_commands).__dict__
+        self._pending_commands = []
+        try:
+            self._process.stdin.write(f"{json.dumps(command)}\n".encode("utf-8"))
+        except (BrokenPipeError, ValueError) as e:
+            raise SimulatorError("Simulator process closed its input") from e
+
+    def close(self):
+        try:
+            self.flush()
+            self._process.stdin.close()
+        except (SimulatorError, BrokenPipeError):
+            pass
+        self._process.terminate()
+        self._process.wait()
+
+
+class Game:
+    def __init__(
+        self,
+        simulator: Simulator | None = None,
+        delta_state: bool = False,
+        feature_ability_ids: list[str] | None = None,
+        replay_writer: ReplayWriter | None = None,
+        lazy_state: bool = False,
+    ):
+        # Games started this way own their simulator, otherwise it is
+        # managed by whoever passed it in (eg. a SimulatorPool) and may host
+        # other games too
+        self._owns_simulator = simulator is None
+        self._simulator = Simulator() if simulator is None else simulator
+
+        # Identifies this game in the simulator for all of its episodes
+        self._simulator_game_id = uuid.uuid4().hex
+
+        # Only receive changed components and patch them into the state
+        self._delta_state = delta_state
+
+        # Also read the packed entity features whenever the state is read
+        self._feature_ability_ids = feature_ability_ids
+        self._entity_features = None
+
+        # Only read the entity features and game events on every step, the
+        # state is read when it is first used after a step
+        assert not lazy_state or (feature_ability_ids is not None and not delta_state)
+        self._lazy_state = lazy_state
+        self._game_events = None
+
+        # Logged games are written by a background writer, by default the
+        # one shared by all games of this process
+        self._replay_writer = (
+            get_replay_writer() if replay_writer is None else replay_writer
+        )
+
         self._logging = False
+        # Logged replays of this game that may still be queued in the writer
+        self._replay_paths: list[str] = []
         self._state = None
+        self._view = None
         self._game_id = None
 
     def start(
         self,
         num_players: int,
-        start_gold: int | None,
-        seed: int | None,
+        start_gold: int | None = None,
+        seed: int | None = None,
         logging: bool = True,
+        keyframe_interval: int | None = None,
+        frames_per_step: int | None = None,
     ):
-        if self._game_id is not None:
-            self._state_history.clear()
+        # frames_per_step is only recorded in the replay for its readers
         self._logging = logging
 
         self._game_id = str(uuid.uuid4())
         print("Starting game", self._game_id, "with seed", seed)
 
+        # The simulator sends everything in the first delta after starting
+        self._state = {}
+
         self._send_command(
-            CLICommandStartGame(seed=seed, numPlayers=num_players, startGold=start_gold)
+            CLICommandStartGame(
+                seed=seed,
+                numPlayers=num_players,
+                startGold=start_gold,
+                recordReplay=logging,
+                keyframeInterval=keyframe_interval,
+                framesPerStep=frames_per_step,
+                gameId=self._simulator_game_id,
+            )
         )
 
         # Read initial state
         self._read_state()
 
+    def snapshot(self) -> str:
+        # Copies the full game state in the simulator and returns the handle
+        # to restore it with. Snapshots stay in the simulator until released
+        # and can be restored into any game hosted by it.
+        handle = uuid.uuid4().hex
+        self._send_command(
+            CLICommandSnapshot(handle=handle, gameId=self._simulator_game_id)
+        )
+        return handle
+
+    def restore(self, handle: str):
+        # Continues the game from a snapshot, works without starting first.
+        # The game is unchanged if the snapshot is unknown.
+        game_id, state = self._game_id, self._state
+        if self._game_id is None:
+            self._game_id = str(uuid.uuid4())
+
+        # The simulator sends everything in the first delta after restoring
+        self._state = {}
+
+        self._send_command(
+            CLICommandRestore(handle=handle, gameId=self._simulator_game_id)
+        )
+        try:
+            self._read_state()
+        except SimulatorCommandError:
+            self._game_id, self._state = game_id, state
+            raise
+
+    def restore_replay_frame(self, path: str, frame: int):
+        # Continues the game from a frame of a saved replay, works without
+        # starting first. The simulator rebuilds the frame from the closest
+        # keyframe before it.
+        if self._game_id is None:
+            self._game_id = str(uuid.uuid4())
+        self._logging = False
+
+        self._state = {}
+
+        self._send_command(
+            CLICommandReplayFrame(
+                path=os.path.abspath(path),
+                frame=frame,
+                gameId=self._simulator_game_id,
+            )
+        )
+        self._read_state()
+
+    def release_snapshot(self, handle: str):
+        self._send_command(CLICommandReleaseSnapshot(handle=handle))
+
+    @property
+    def simulator(self) -> Simulator:
+        return self._simulator
+
     @property
     def state(self):
+        if self._state is None and self._game_events is not None:
+            # Lazy state, this is the state as it is in the simulator now
+            self._send_command(CLICommandGetComponents(gameId=self._simulator_game_id))
+            self._state = json.loads(self._simulator.read_response())
+            self._raise_command_errors()
         return self._state
 
+    @property
+    def view(self) -> StateView:
+        # Built on first use after every read of the state
+        if self._view is None:
+            if self._lazy_state:
+                self._view = StateView.from_features(
+                    self._entity_features,
+                    self._feature_ability_ids,
+                    self._game_events,
+                )
+            else:
+                self._view = StateView.from_state(self._state)
+        return self._view
+
+    @property
+    def simulator_game_id(self) -> str:
+        return self._simulator_game_id
+
+    @property
+    def entity_features(self) -> EntityFeatures | None:
+        # Views into the read buffer, only valid until the next read from
+        # the simulator (by any game it hosts). Copied for lazy states.
+        return self._entity_features
+
     @property
     def logging(self):
         return self._logging
@@ -124,42 +761,125 @@ class Game:
     def started(self):
         return self._game_id is not None
 
-    def log_game(self):
+    def log_game(self) -> bool:
+        # Returns whether the replay was queued, see ReplayWriter
         assert self.logging
 
         # "/mnt", "e", "warlock_rl_logs",
-        game_log_dir = os.path.join("..", "logs", f"{time.time_ns()}_{self._game_id}")
+        game_log_dir = os.path.join(LOG_DIR, f"{time.time_ns()}_{self._game_id}")
         print("Logging game to", os.path.abspath(game_log_dir))
-        os.makedirs(game_log_dir, exist_ok=True)
-        with gzip.open(
-            os.path.join(game_log_dir, "state_history.json.gz"), "wt", encoding="utf-8"
-        ) as state_history_file:
-            json.dump(self._state_history, state_history_file)
 
-        self._state_history.clear()
+        # The simulator only sends the replay JSON, compressing and writing
+        # it happens in the background. See warlock_rl.replay to read it.
+        self._send_command(CLICommandGetReplay(gameId=self._simulator_game_id))
+        replay = bytes(self._simulator.read_response())
         self._logging = False
 
+        path = os.path.abspath(os.path.join(game_log_dir, REPLAY_FILE_NAME))
+        queued = self._replay_writer.write(
+            path, replay, catalog_dir=os.path.abspath(LOG_DIR)
+        )
+        if queued:
+            self._replay_paths = [
+                replay_path
+                for replay_path in self._replay_paths
+                if self._replay_writer.is_pending(replay_path)
+            ] + [path]
+        return queued
+
     def _read_state(self):
-        self._send_command(CLICommandGetComponents())
-        output_raw = self._process.stdout.read(128_000)
-        self._state = json.loads(output_raw)
-        if self._logging:
-            self._state_history.append(self._state)
+        self._send_command(
+            CLICommandGetComponents(
+                delta=self._delta_state,
+                componentNames=(
+                    LAZY_STATE_COMPONENT_NAMES if self._lazy_state else None
+                ),
+                gameId=self._simulator_game_id,
+            )
+        )
+        self._request_entity_features()
+
+        # Every response is read even if one fails so the next reads get
+        # their own
+        error = None
+        try:
+            self._set_state(json.loads(self._simulator.read_response()))
+        except SimulatorCommandError as e:
+            error = e
+        try:
+            self._read_entity_features()
+        except SimulatorCommandError as e:
+            error = error or e
+        self._raise_command_errors(error)
+
+    def _raise_command_errors(self, error: SimulatorCommandError | None = None):
+        # The commands of this game without a response that failed before a
+        # read report it after the read, before the error of the read itself
+        errors = self._simulator.pop_command_errors(self._simulator_game_id)
+        if errors:
+            raise SimulatorCommandError("; ".join(errors)) from error
+        if error is not None:
+            raise error
+
+    def _set_state(self, state: dict):
+        self._view = None
+        if self._lazy_state:
+            self._game_events = state["gameEvents"]
+            self._state = None
+        elif self._delta_state:
+            self._apply_state_delta(state)
+        else:
+            self._state = state
+
+    def _request_entity_features(self):
+        if self._feature_ability_ids is not None:
+            self._send_command(
+                CLICommandGetEntityFeatures(
+                    abilityIds=self._feature_ability_ids,
+                    gameId=self._simulator_game_id,
+                )
+            )
+
+    def _read_entity_features(self, copy: bool = False):
+        if self._feature_ability_ids is not None:
+            response = self._simulator.read_response()
+            # Reading a lazy state would overwrite the buffer
+            self._entity_features = EntityFeatures.from_buffer(
+                bytes(response) if copy or self._lazy_state else response,
+                len(self._feature_ability_ids),
+            )
+
+    def _apply_state_delta(self, delta: dict):
+        # Singleton components are sent whole, entity components only for the
+        # entities that changed, with None for removed entities.
+        self._state.update(delta["singletons"])
+        for component_name, changed in delta["entities"].items():
+            components = self._state.setdefault(component_name, {})
+            for entity_id, component in changed.items():
+                if component is None:
+                    del components[entity_id]
+                else:
+                    components[entity_id] = component
 
     def _send_command(self, command: CLICommand):
-        self._process.stdin.write(f"{command.to_json()}\n".encode("utf-8"))
+        self._simulator.send_command(command)
 
     def order(self, entity_id: int, order: dict):
         self._send_command(
             CLICommandSetOrder(
                 entityId=entity_id,
                 order=order,
+                gameId=self._simulator_game_id,
             )
         )
 
     def buy_ability(self, entity_id: int, ability_id: str):
         self._send_command(
-            CLICommandBuyAbility(entityId=entity_id, abilityId=ability_id)
+            CLICommandBuyAbility(
+                entityId=entity_id,
+                abilityId=ability_id,
+                gameId=self._simulator_game_id,
+            )
         )
 
     def set_ready(self, entity_id: int, ready: bool):
@@ -167,19 +887,90 @@ class Game:
             CLICommandSetReady(
                 entityId=entity_id,
                 ready=ready,
+                gameId=self._simulator_game_id,
             )
         )
 
-    def step(self, steps: int):
-        # Step for some frames, done this way so we record hgistory
-        # TODO: dont record all frames but make sure we can step forward
-        # with gameSystem properly
-        for _ in range(steps):
-            self._send_command(CLICommandStep(steps=1))
-            # Read new state
-            self._read_state()
+    def step(self, steps: int, stop_on_state_change: bool = False):
+        # Step all frames in one command and only read the final state.
+        # With stop_on_state_change the simulator stops early on the frame
+        # the round ends or the shop closes.
+        self._send_command(
+            CLICommandStep(
+                steps=steps,
+                stopOnStateChange=stop_on_state_change,
+                gameId=self._simulator_game_id,
+            )
+        )
+        self._read_state()
 
     def close(self):
-        self._process.stdin.close()
-        self._process.terminate()
-        self._process.wait()
+        # Logged games have to be written before the process exits. Only
+        # waits for this game's replays, the writer is shared by the games
+        # of the process and flushed when it exits (see get_replay_writer).
+        self._replay_writer.wait(self._replay_paths)
+        self._replay_paths = []
+
+        if self._owns_simulator:
+            self._simulator.close()
+        else:
+            # Free the game in the simulator, it keeps hosting the others
+            self._send_command(CLICommandCloseGame(gameId=self._simulator_game_id))
+            self._simulator.flush()
+
+
+def step_all(
+    games: list[Game], steps: int | list[int], stop_on_state_change: bool = False
+):
+    # Steps games hosted by the same simulator with a single command and
+    # reads all of their states in a single response, so K games cost one
+    # round trip instead of K. Same as calling step() on every game, steps
+    # can be given per game.
+    if not games:
+        return
+
+    simulator = games[0].simulator
+    delta_state = games[0]._delta_state
+    lazy_state = games[0]._lazy_state
+    assert all(game.simulator is simulator for game in games)
+    assert all(game._delta_state == delta_state for game in games)
+    assert all(game._lazy_state == lazy_state for game in games)
+
+    simulator.send_command(
+        CLICommandStepAll(
+            gameIds=[game.simulator_game_id for game in games],
+            steps=steps,
+            stopOnStateChange=stop_on_state_change,
+            delta=delta_state,
+            componentNames=LAZY_STATE_COMPONENT_NAMES if lazy_state else None,
+        )
+    )
+    for game in games:
+        game._request_entity_features()
+
+    # Games that fail don't stop the others, they are raised together after
+    # every response was read
+    errors: dict[Game, SimulatorCommandError] = {}
+    try:
+        states = json.loads(simulator.read_response())
+    except SimulatorCommandError as e:
+        states = {game.simulator_game_id: {"error": str(e)} for game in games}
+    for game in games:
+        state = states[game.simulator_game_id]
+        if "error" in state:
+            errors[game] = SimulatorCommandError(state["error"])
+        else:
+            game._set_state(state)
+    # Every game reads its features from the same buffer so they are copied
+    for game in games:
+        try:
+            game._read_entity_features(copy=len(games) > 1)
+        except SimulatorCommandError as e:
+            errors.setdefault(game, e)
+    for game in games:
+        try:
+            game._raise_command_errors(errors.get(game))
+        except SimulatorCommandError as e:
+            errors[game] = e
+    if errors:
+        raise StepAllError(errors)
@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+import ray
+from ray.rllib.algorithms.ppo.ppo_torch_policy import PPOTorchPolicy
+from ray.rllib.examples.policy.random_policy import RandomPolicy
+
+# Self-play league of frozen snapshots of the main policies. The snapshots
+# are played by the league policies, which compute them all in one
+# TorchLeagueModel (see models.py), so the rollout workers run one forward
+# pass per policy per step however many snapshots there are. RLlib already
+# batches the agents of every env of a worker that are mapped to the same
+# policy into one call.
+#
+# The snapshots are stored once in the object store as the layers the model
+# uses, in float16 by default. The workers get the references and load only
+# the snapshots their agents play, so their memory doesn't grow with the
+# league and adding a snapshot doesn't sync any weights. The league isn't
+# saved in checkpoints, a restored run starts without snapshots.
+
+LEAGUE_POLICY_IDS = {"main": "league", "main_shop": "league_shop"}
+
+
+class InferenceTimingMixin:
+    # Counts the compute_actions calls of a policy with their rows and
+    # time, reported as episode custom metrics by inference_metrics
+
+    inference_calls = 0
+    inference_rows = 0
+    inference_seconds = 0.0
+
+    def compute_actions_from_input_dict(self, input_dict, *args, **kwargs):
+        start_time = time.perf_counter()
+        results = super().compute_actions_from_input_dict(input_dict, *args, **kwargs)
+        self.inference_seconds += time.perf_counter() - start_time
+        self.inference_calls += 1
+        self.inference_rows += len(input_dict)
+        return results
+
+
+class TimedPPOTorchPolicy(InferenceTimingMixin, PPOTorchPolicy):
+    pass
+
+
+class TimedRandomPolicy(InferenceTimingMixin, RandomPolicy):
+    pass
+
+
+def inference_metrics(policies) -> dict[str, float]:
+    # Mean time and rows per call of the timed policies since the last call
+    metrics = {}
+    for policy_id, policy in policies.items():
+        if not getattr(policy, "inference_calls", 0):
+            continue
+        metrics[f"inference_ms/{policy_id}"] = (
+            policy.inference_seconds / policy.inference_calls * 1000
+        )
+        metrics[f"inference_rows/{policy_id}"] = (
+            policy.inference_rows / policy.inference_calls
+        )
+        policy.inference_calls = 0
+        policy.inference_rows = 0
+        policy.inference_seconds = 0.0
+    return metrics
+
+
+class LeagueStore:
+    # Snapshots by id in the object store, shared by the workers of a node
+
+    def __init__(self, dtype: str = "float16"):
+        self.dtype = dtype
+        self.refs: list[ray.ObjectRef] = []
+
+    def add(self, layers: dict[str, np.ndarray]) -> int:
+        # Returns the snapshot id
+        self.refs.append(
+            ray.put({name: value.astype(self.dtype) for name, value in layers.items()})
+        )
+        return len(self.refs) - 1
+
+    def __len__(self) -> int:
+        return len(self.refs)
+
+    def __getitem__(self, snapshot_id: int) -> dict[str, np.ndarray]:
+        return ray.get(self.refs[snapshot_id])
+
+
+def num_snapshots(policy) -> int:
+    # Snapshots in the league of a league policy
+    return len(policy.model.snapshots)
+
+
+def add_snapshot(algorithm, store: LeagueStore, league_policy_id: str, policy_id: str):
+    # Adds the current weights of the policy to the store and gives it to the
+    # league policy of every worker
+    league_policy = algorithm.get_policy(league_policy_id)
+    store.add(
+        league_policy.model.snapshot_layers(
+            algorithm.get_policy(policy_id).get_weights()
+        )
+    )
+
+    def set_snapshots(worker):
+        worker.policy_map[league_policy_id].model.set_snapshots(store)
+
+    for workers in [algorithm.workers, algorithm.evaluation_workers]:
+        if workers is not None:
+            workers.foreach_worker(set_snapshots)
@@ -1,6 +1,12 @@
+from collections import OrderedDict
+from typing import Sequence
+
 import gymnasium as gym
+import numpy as np
 from ray.rllib.models.torch.misc import SlimFC, normc_initializer
 from ray.rllib.models.torch.torch_modelv2 import TorchModelV2
+from ray.rllib.models.utils import get_activation_fn
+from ray.rllib.policy.sample_batch import SampleBatch
 from ray.rllib.policy.view_requirement import ViewRequirement
 from ray.rllib.utils.framework import try_import_torch
 from ray.rllib.utils.torch_utils import FLOAT_MIN
@@ -17,6 +23,8 @@ class TorchFrameStackingModel(TorchModelV2, nn.Module):
         model_config: dict,
         name: str,
         num_frames: int = 3,
+        incremental_inference: bool = False,
+        hidden_activation: str = "tanh",
     ):
         nn.Module.__init__(self)
         super(TorchFrameStackingModel, self).__init__(
@@ -26,6 +34,11 @@ class TorchFrameStackingModel(TorchModelV2, nn.Module):
         self.num_frames = num_frames
         self.num_outputs = num_outputs
 
+        # Keep the last observations in the state when computing actions
+        # instead of having RLlib stack them for every step. Training still
+        # uses the stacked frames.
+        self.incremental_inference = incremental_inference
+
         # Construct actual (very simple) FC model.
         assert len(obs_space.shape) == 1
         in_size = self.num_frames + obs_space.shape[0]
@@ -33,10 +46,17 @@ class TorchFrameStackingModel(TorchModelV2, nn.Module):
         hidden_initializer = normc_initializer(1)
         output_initializer = normc_initializer(0.01)
 
+        # The first layers are fused in forward, with their activation applied
+        # there
+        activation_class = get_activation_fn(hidden_activation, "torch")
+        self._hidden_activation = (
+            nn.Identity() if activation_class is None else activation_class()
+        )
+
         self.layer1 = SlimFC(
             in_size=in_size,
             out_size=64,
-            activation_fn="tanh",
+            activation_fn=hidden_activation,
             initializer=hidden_initializer,
         )
         self.out = SlimFC(
@@ -49,7 +69,7 @@ class TorchFrameStackingModel(TorchModelV2, nn.Module):
         self.value_layer1 = SlimFC(
             in_size=in_size,
             out_size=64,
-            activation_fn="tanh",
+            activation_fn=hidden_activation,
             initializer=hidden_initializer,
         )
         self.values = SlimFC(
@@ -62,38 +82,100 @@ class TorchFrameStackingModel(TorchModelV2, nn.Module):
         self._last_value = None
 
         self.view_requirements["prev_n_obs"] = ViewRequirement(
-            data_col="obs", shift="-{}:0".format(num_frames - 1), space=obs_space
+            data_col="obs",
+            shift="-{}:0".format(num_frames - 1),
+            space=obs_space,
+            used_for_compute_actions=not incremental_inference,
         )
 
         self.view_requirements["action_mask"] = ViewRequirement(
             data_col="action_mask", space=action_space
         )
 
-    def forward(self, input_dict, states, seq_lens):
-        obs = input_dict["prev_n_obs"]
-        action_mask = input_dict["obs"]["action_mask"]
+        # The state is only needed for computing actions, not for training
+        for i, state in enumerate(self.get_initial_state()):
+            space = gym.spaces.Box(-np.inf, np.inf, state.shape)
+            self.view_requirements[f"state_in_{i}"] = ViewRequirement(
+                f"state_out_{i}", shift=-1, space=space, used_for_training=False
+            )
+            self.view_requirements[f"state_out_{i}"] = ViewRequirement(
+                space=space, used_for_training=False
+            )
 
-        # [..., F, X]
-        obs = torch.reshape(obs, [-1, self.num_frames, self.obs_space.shape[0]])
+    def _first_layers(self) -> tuple["torch.Tensor", "torch.Tensor"]:
+        # layer1 and value_layer1 fused into one weight for the observations
+        # and a bias per frame. The first layers get a one-hot frame index
+        # besides the observation, which only adds the weight of that index.
+        linears = [self.layer1._model[0], self.value_layer1._model[0]]
+        obs_size = self.obs_space.shape[0]
 
-        # [..., F, F]
-        frame_indices = torch.tile(
-            torch.eye(self.num_frames),
-            [*obs.shape[:-2], 1, 1],
-        )
+        # [2H, X + F], [2H]
+        weight = torch.concat([linear.weight for linear in linears])
+        bias = torch.concat([linear.bias for linear in linears])
 
-        # [..., F, X + F]
-        obs = torch.concat([obs, frame_indices], dim=-1)
+        # [2H, X], [F, 2H]
+        return weight[:, :obs_size], weight[:, obs_size:].T + bias
 
-        self._last_obs = obs
+    def _output_layers(
+        self,
+    ) -> tuple["torch.Tensor", "torch.Tensor", "torch.Tensor", "torch.Tensor"]:
+        # [O, H], [O], [1, H], [1]
+        out, values = self.out._model[0], self.values._model[0]
+        return out.weight, out.bias, values.weight, values.bias
+
+    def _linear(
+        self, x: "torch.Tensor", weight: "torch.Tensor", bias: "torch.Tensor" = None
+    ) -> "torch.Tensor":
+        return nn.functional.linear(x, weight, bias)
 
-        features = self.layer1(obs)
+    def get_initial_state(self):
+        if not self.incremental_inference:
+            return []
+        # The observations of the frames before the newest one, and whether
+        # there was a frame yet. Not the first layers' outputs, which would
+        # go stale when the weights are synced during the episode.
+        weight = self.layer1._model[0].weight
+        return [
+            weight.new_zeros(self.num_frames - 1, self.obs_space.shape[0]),
+            weight.new_zeros(1),
+        ]
+
+    def forward(self, input_dict, states, seq_lens):
+        action_mask = input_dict["obs"]["action_mask"]
+        obs_weight, frame_bias = self._first_layers()
+
+        if "prev_n_obs" in input_dict:
+            # [..., F, X]
+            obs = torch.reshape(
+                input_dict["prev_n_obs"], [-1, self.num_frames, self.obs_space.shape[0]]
+            )
+        else:
+            # [..., X]
+            new_obs = input_dict["obs_flat"]
+            previous_obs, has_frames = states
+            # [..., F, X]
+            obs = torch.concat([previous_obs, new_obs[..., None, :]], -2)
+            # The frames before the first one are the same as the first one,
+            # like the stacked frames
+            if not torch.all(has_frames > 0):
+                obs = torch.where(has_frames[..., None] > 0, obs, new_obs[..., None, :])
 
-        # [..., F, O]
-        out = self.out(features)
+        # [..., F, 2H]
+        frame_outputs = self._linear(obs, obs_weight)
+        features = self._hidden_activation(frame_outputs + frame_bias)
+
+        # The output layers are linear so they can be applied to the mean of
+        # the frames instead of every frame
+        # [..., H]
+        policy_features, value_features = torch.mean(features, -2).chunk(2, -1)
+
+        out_weight, out_bias, value_weight, value_bias = self._output_layers()
+        self._last_value = torch.squeeze(
+            self._linear(value_features, value_weight, value_bias), -1
+        )
 
         # [..., O]
-        out = torch.mean(out, -2)
+        out = self._linear(policy_features, out_weight, out_bias)
 
         inf_mask = torch.clamp(torch.log(action_mask), min=FLOAT_MIN)
 
@@ -102,9 +184,210 @@ class TorchFrameStackingModel(TorchModelV2, nn.Module):
         else:
             out += inf_mask
 
-        return out, []
+        # No state for training, which doesn't get one
+        if not states:
+            return out, []
+        return out, [obs[..., 1:, :], obs.new_ones(obs.shape[0], 1)]
 
     def value_function(self):
-        return torch.squeeze(
-            torch.mean(self.values(self.value_layer1(self._last_obs)), -2), -1
+        return self._last_value
+
+
+class TorchLeagueModel(TorchFrameStackingModel):
+    # Frozen snapshots of a TorchFrameStackingModel in one model so the
+    # opponents playing any of them are computed in a single forward pass
+    # per step instead of one per snapshot policy. The snapshots are kept in
+    # a league store (see league.py), each agent plays one picked by its
+    # episode id and index among the snapshots there were when its episode
+    # started, which is kept in the state. Only the snapshots being played
+    # are loaded, into league_size slots that are reused least recently used
+    # first. A batch playing more snapshots than that goes through them
+    # league_size at a time.
+
+    LAYER_NAMES = [
+        "obs_weights",
+        "frame_biases",
+        "out_weights",
+        "out_biases",
+        "value_weights",
+        "value_biases",
+    ]
+
+    def __init__(
+        self,
+        obs_space: gym.spaces.Space,
+        action_space: gym.spaces.Space,
+        num_outputs: int,
+        model_config: dict,
+        name: str,
+        num_frames: int = 3,
+        incremental_inference: bool = False,
+        hidden_activation: str = "tanh",
+        league_size: int = 16,
+    ):
+        super().__init__(
+            obs_space,
+            action_space,
+            num_outputs,
+            model_config,
+            name,
+            num_frames=num_frames,
+            incremental_inference=incremental_inference,
+            hidden_activation=hidden_activation,
+        )
+        self.league_size = league_size
+
+        # The layers of the loaded snapshots, not part of the weights so they
+        # aren't synced with them. The inherited layers are only used for
+        # making snapshots.
+        for buffer_name, tensor in zip(
+            self.LAYER_NAMES, [*super()._first_layers(), *super()._output_layers()]
+        ):
+            self.register_buffer(
+                buffer_name,
+                tensor.new_zeros(league_size, *tensor.shape).detach(),
+                persistent=False,
+            )
+
+        # Layers of every snapshot by id
+        self.snapshots: Sequence[dict[str, np.ndarray]] = []
+        # Slots of the loaded snapshots by id, least recently used first
+        self._slots: OrderedDict[int, int] = OrderedDict()
+
+    @torch.no_grad()
+    def snapshot_layers(self, state_dict: dict) -> dict[str, np.ndarray]:
+        # The layers of a TorchFrameStackingModel to add to the league, from
+        # its state_dict or its policy's get_weights
+        self.load_state_dict(
+            {name: torch.as_tensor(value) for name, value in state_dict.items()}
+        )
+        return {
+            name: tensor.numpy().copy()
+            for name, tensor in zip(
+                self.LAYER_NAMES,
+                [*super()._first_layers(), *super()._output_layers()],
+            )
+        }
+
+    def set_snapshots(self, snapshots: Sequence[dict[str, np.ndarray]]):
+        # Snapshots can only be added, the loaded ones stay valid
+        self.snapshots = snapshots
+
+    def get_initial_state(self):
+        # Plus the number of snapshots when the agent's first action was
+        # computed, 0 before it
+        weight = self.layer1._model[0].weight
+        return [*super().get_initial_state(), weight.new_zeros(1)]
+
+    def _load_snapshots(self, snapshot_ids: np.ndarray) -> "torch.Tensor":
+        # Slots of the snapshots, loading the missing ones. There can't be
+        # more different snapshots than slots.
+        played = dict.fromkeys(snapshot_ids.tolist())
+        missing = []
+        for snapshot_id in played:
+            if snapshot_id in self._slots:
+                self._slots.move_to_end(snapshot_id)
+            else:
+                missing.append(snapshot_id)
+
+        for snapshot_id in missing:
+            if len(self._slots) < self.league_size:
+                slot = len(self._slots)
+            else:
+                # The played snapshots were moved to the end
+                _, slot = self._slots.popitem(last=False)
+            for name, value in self.snapshots[snapshot_id].items():
+                # Read only from the object store, and maybe float16
+                getattr(self, name)[slot] = torch.from_numpy(value.astype(np.float32))
+            self._slots[snapshot_id] = slot
+
+        return torch.tensor(
+            [self._slots[snapshot_id] for snapshot_id in snapshot_ids.tolist()],
+            device=self.obs_weights.device,
         )
+
+    def forward(self, input_dict, states, seq_lens):
+        # Read even without snapshots, RLlib only keeps the columns read from
+        # the dummy batch in the batches for computing actions
+        eps_id = input_dict[SampleBatch.EPS_ID]
+        agent_index = input_dict[SampleBatch.AGENT_INDEX]
+        *states, num_snapshots = states
+        if not self.snapshots:
+            # Only the dummy batches of the policy come before any snapshot
+            self._indices = torch.zeros_like(eps_id, dtype=torch.int64)
+            self._num_active = max(len(self._slots), 1)
+            out, states = super().forward(input_dict, states, seq_lens)
+            return out, [*states, num_snapshots]
+
+        # Snapshots added during the episode aren't played by it so the agent
+        # keeps its snapshot
+        num_snapshots = torch.where(
+            num_snapshots > 0, num_snapshots, float(len(self.snapshots))
+        )
+        snapshot_ids = league_snapshot_ids(
+            eps_id.cpu().numpy(),
+            agent_index.cpu().numpy(),
+            num_snapshots[:, 0].cpu().numpy().astype(np.int64),
+        )
+
+        # Through league_size of the played snapshots at a time, the other
+        # rows play the first of them and their outputs are dropped
+        played = np.unique(snapshot_ids)
+        for start in range(0, len(played), self.league_size):
+            chunk = played[start : start + self.league_size]
+            rows = np.isin(snapshot_ids, chunk)
+            self._indices = self._load_snapshots(np.where(rows, snapshot_ids, chunk[0]))
+            self._num_active = len(self._slots)
+            chunk_out, states_out = super().forward(input_dict, states, seq_lens)
+            if start == 0:
+                out, value = chunk_out, self._last_value
+            else:
+                rows = torch.from_numpy(rows).to(out.device)
+                out = torch.where(rows[:, None], chunk_out, out)
+                value = torch.where(rows, self._last_value, value)
+        self._last_value = value
+        return out, [*states_out, num_snapshots]
+
+    def _first_layers(self):
+        # [S, 2H, X], [B, F, 2H]
+        return (
+            self.obs_weights[: self._num_active],
+            self.frame_biases[self._indices],
+        )
+
+    def _output_layers(self):
+        # [S, O, H], [S, O], [S, 1, H], [S, 1]
+        return tuple(
+            getattr(self, name)[: self._num_active] for name in self.LAYER_NAMES[2:]
+        )
+
+    def _linear(
+        self, x: "torch.Tensor", weight: "torch.Tensor", bias: "torch.Tensor" = None
+    ) -> "torch.Tensor":
+        # Through the layers of every snapshot at once, which is faster than
+        # gathering a weight per row, then the output of the row's snapshot
+        # [B, ..., S, O]
+        num_snapshots, out_size, in_size = weight.shape
+        out = nn.functional.linear(
+            x,
+            weight.reshape(-1, in_size),
+            None if bias is None else bias.reshape(-1),
+        ).unflatten(-1, (num_snapshots, out_size))
+        indices = self._indices.view(-1, *[1] * (out.dim() - 1))
+        return torch.take_along_dim(out, indices, -2).squeeze(-2)
+
+
+def league_snapshot_ids(
+    eps_id: np.ndarray, agent_index: np.ndarray, num_snapshots: int | np.ndarray
+) -> np.ndarray:
+    # The snapshot every agent plays among the first num_snapshots, random
+    # but fixed for the agent in the episode as long as num_snapshots is
+    # (splitmix64 of the episode id and agent index)
+    with np.errstate(over="ignore"):
+        x = eps_id.astype(np.uint64) + (
+            agent_index.astype(np.uint64) + np.uint64(1)
+        ) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x ^= x >> np.uint64(31)
+    return (x % np.asarray(num_snapshots).astype(np.uint64)).astype(np.int64)
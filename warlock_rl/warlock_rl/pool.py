@@ -0,0 +1,135 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from warlock_rl.game import Simulator, SimulatorError
+
+# The first ping also waits for Bun to start and compile the CLI
+PING_TIMEOUT = 30.0
+
+
+class SimulatorPool:
+    # Keeps `size` simulator processes started and idle so envs can lease
+    # them without waiting for Bun to start. Simulators are health checked
+    # when leased and dead ones get replaced. The pool is refilled in the
+    # background after leases and releases.
+
+    def __init__(self, size: int = 0, ping_timeout: float = PING_TIMEOUT):
+        self._size = size
+        self._ping_timeout = ping_timeout
+        self._idle: list[Simulator] = []
+        self._lock = threading.Lock()
+        self._num_respawned = 0
+        # Started by prewarm but not idle yet
+        self._num_starting = 0
+
+        # One refill at a time, each starts all missing processes at once
+        self._refill_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="simulator_pool"
+        )
+        self._last_refill: Future | None = None
+
+        self.prewarm()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @size.setter
+    def size(self, size: int):
+        self._size = size
+        self.prewarm()
+
+    @property
+    def num_idle(self) -> int:
+        return len(self._idle)
+
+    @property
+    def num_respawned(self) -> int:
+        # Number of dead simulators that were replaced
+        return self._num_respawned
+
+    def prewarm(self):
+        # Start all missing processes first so they start up in parallel.
+        # Processes that are still starting count as idle so concurrent
+        # calls don't start more than `size`.
+        with self._lock:
+            num_missing = self._size - len(self._idle) - self._num_starting
+            simulators = [Simulator() for _ in range(num_missing)]
+            self._num_starting += len(simulators)
+
+        for simulator in simulators:
+            started = simulator.ping(self._ping_timeout)
+            with self._lock:
+                self._num_starting -= 1
+                if started:
+                    self._idle.append(simulator)
+            if not started:
+                simulator.close()
+
+    def _refill(self):
+        self._last_refill = self._refill_executor.submit(self.prewarm)
+
+    def wait_for_refill(self):
+        # Waits until the pool is refilled after the last lease or release
+        if self._last_refill is not None:
+            self._last_refill.result()
+
+    def lease(self) -> Simulator:
+        while True:
+            with self._lock:
+                simulator = self._idle.pop() if self._idle else None
+            self._refill()
+
+            if simulator is None:
+                simulator = Simulator()
+                if not simulator.ping(self._ping_timeout):
+                    simulator.close()
+                    raise SimulatorError("Failed to start simulator")
+                return simulator
+
+            if simulator.ping(self._ping_timeout):
+                return simulator
+
+            # Dead or unresponsive, replace it
+            simulator.close()
+            with self._lock:
+                self._num_respawned += 1
+
+    def release(self, simulator: Simulator):
+        with self._lock:
+            alive = simulator.alive
+            keep = alive and len(self._idle) < self._size
+            if keep:
+                self._idle.append(simulator)
+            elif not alive:
+                self._num_respawned += 1
+
+        if not keep:
+            simulator.close()
+            # Keep the pool warm without blocking the env that replaces a
+            # failed simulator
+            self._refill()
+
+    def close(self):
+        self._refill_executor.shutdown()
+        with self._lock:
+            simulators, self._idle = self._idle, []
+        for simulator in simulators:
+            simulator.close()
+
+
+_simulator_pool: SimulatorPool | None = None
+_simulator_pool_lock = threading.Lock()
+
+
+def get_simulator_pool(size: int = 0) -> SimulatorPool:
+    # The pool shared by all envs of this process, grown to the largest
+    # requested size
+    global _simulator_pool
+
+    with _simulator_pool_lock:
+        if _simulator_pool is None:
+            _simulator_pool = SimulatorPool(size)
+        elif size > _simulator_pool.size:
+            _simulator_pool.size = size
+        return _simulator_pool
@@ -0,0 +1,101 @@
+from warlock_rl.game import Game
+from warlock_rl.replay_file import ReplayFile
+
+# Replays (see src/cli/replay.ts) store the start options, the commands with
+# the frame they were applied on and a keyframe every `keyframeInterval`
+# frames instead of the state of every frame. They are stored in replay
+# files (see replay_file.py).
+
+
+def load_replay(path: str) -> dict:
+    with ReplayFile(path) as replay_file:
+        return replay_file.replay()
+
+
+class ReplayReader:
+    # Rebuilds frames of a replay on demand through a simulator
+
+    def __init__(self, path: str, game: Game | None = None):
+        self._path = path
+        # Blocks are only read for their commands, when stepping through the
+        # frames or listing the commands
+        self._replay_file = ReplayFile(path)
+        # Commands of the blocks read so far by block index, the keyframes
+        # are restored by the simulator
+        self._block_commands: dict[int, list[dict]] = {}
+        self._owns_game = game is None
+        self._game = Game() if game is None else game
+
+    @property
+    def start(self) -> dict:
+        return self._replay_file.start
+
+    @property
+    def first_frame(self) -> int:
+        return self._replay_file.first_frame
+
+    @property
+    def last_frame(self) -> int:
+        return self._replay_file.last_frame
+
+    @property
+    def num_frames(self) -> int:
+        return self.last_frame - self.first_frame + 1
+
+    def block_commands(self, block_index: int) -> list[dict]:
+        # Each block is only decompressed once
+        if block_index not in self._block_commands:
+            block = self._replay_file.block(block_index)
+            self._block_commands[block_index] = block["commands"]
+        return self._block_commands[block_index]
+
+    def commands(self) -> list[dict]:
+        # Every command of the replay with the frame it was applied on
+        return [
+            command
+            for block_index in range(self._replay_file.num_blocks)
+            for command in self.block_commands(block_index)
+        ]
+
+    def frame(self, frame: int) -> dict:
+        # The state is the same as the one read right after stepping to the
+        # frame when the replay was recorded
+        self._game.restore_replay_frame(self._path, frame)
+        return self._game.state
+
+    def frames(self):
+        # Yields the state of every frame. Only the first frame is rebuilt,
+        # the others are stepped to by replaying the commands of each block.
+        yield self.frame(self.first_frame)
+
+        frame = self.first_frame
+        end_frames = self._replay_file.block_first_frames[1:] + [self.last_frame]
+        for block_index, end_frame in enumerate(end_frames):
+            commands = self.block_commands(block_index)
+            command_index = 0
+            while frame < end_frame:
+                while (
+                    command_index < len(commands)
+                    and commands[command_index]["frame"] == frame
+                ):
+                    self._apply_command(commands[command_index]["command"])
+                    command_index += 1
+                self._game.step(1)
+                frame += 1
+                yield self._game.state
+
+    def _apply_command(self, command: dict):
+        match command["type"]:
+            case "setOrder":
+                self._game.order(command["entityId"], command["order"])
+            case "setReady":
+                self._game.set_ready(command["entityId"], command["ready"])
+            case "buyAbility":
+                self._game.buy_ability(command["entityId"], command["abilityId"])
+            case _:
+                raise ValueError(f"Unhandled replay command {command}")
+
+    def close(self):
+        self._replay_file.close()
+        if self._owns_game:
+            self._game.close()
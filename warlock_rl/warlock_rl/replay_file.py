@@ -0,0 +1,212 @@
+import bisect
+import gzip
+import os
+import struct
+
+import ujson as json
+
+# Replay container, has to match src/cli/replay.ts:
+# - header: magic and version
+# - blocks: each one a gzipped JSON {"keyframe": ..., "commands": [...]}
+#   with the commands from the keyframe up to the next block
+# - index: JSON {"start", "keyframeInterval", "lastFrame", "roundWinners",
+#   "blocks"} with the offset, size and first frame of every block
+# - trailer: index size and magic
+# Blocks are compressed independently so any frame can be read by only
+# decompressing the block it is in, and blocks can be appended by
+# rewriting the index.
+
+REPLAY_FILE_NAME = "replay.wrp"
+REPLAY_FILE_VERSION = 1
+REPLAY_FILE_HEADER = struct.Struct("<4sI")
+REPLAY_FILE_TRAILER = struct.Struct("<I4s")
+REPLAY_FILE_MAGIC = b"WRPL"
+REPLAY_INDEX_MAGIC = b"WRPI"
+REPLAY_COMPRESS_LEVEL = 6
+
+
+class ReplayFileError(ValueError):
+    pass
+
+
+def replay_blocks(replay: dict) -> list[dict]:
+    # Splits a replay (see src/cli/replay.ts) into blocks at its keyframes
+    keyframes = replay["keyframes"]
+    commands = replay["commands"]
+    blocks = []
+    command_index = 0
+    for i, keyframe in enumerate(keyframes):
+        end_frame = (
+            keyframes[i + 1]["gameState"]["frameNumber"]
+            if i + 1 < len(keyframes)
+            else None
+        )
+        block_commands = []
+        while command_index < len(commands) and (
+            end_frame is None or commands[command_index]["frame"] < end_frame
+        ):
+            block_commands.append(commands[command_index])
+            command_index += 1
+        blocks.append({"keyframe": keyframe, "commands": block_commands})
+    return blocks
+
+
+def _read_index(replay_file) -> tuple[dict, int]:
+    # Returns the index and its offset
+    replay_file.seek(0, os.SEEK_END)
+    file_size = replay_file.tell()
+    if file_size < REPLAY_FILE_HEADER.size + REPLAY_FILE_TRAILER.size:
+        raise ReplayFileError("Replay file too small")
+
+    replay_file.seek(0)
+    magic, version = REPLAY_FILE_HEADER.unpack(
+        replay_file.read(REPLAY_FILE_HEADER.size)
+    )
+    if magic != REPLAY_FILE_MAGIC or version != REPLAY_FILE_VERSION:
+        raise ReplayFileError(f"Not a version {REPLAY_FILE_VERSION} replay file")
+
+    replay_file.seek(file_size - REPLAY_FILE_TRAILER.size)
+    index_size, index_magic = REPLAY_FILE_TRAILER.unpack(
+        replay_file.read(REPLAY_FILE_TRAILER.size)
+    )
+    if index_magic != REPLAY_INDEX_MAGIC:
+        raise ReplayFileError("Replay file has no index, it was not closed")
+
+    index_offset = file_size - REPLAY_FILE_TRAILER.size - index_size
+    replay_file.seek(index_offset)
+    return json.loads(replay_file.read(index_size)), index_offset
+
+
+class ReplayFileWriter:
+    # Appends blocks to a new or existing replay file, the index is written
+    # on close
+
+    def __init__(
+        self,
+        path: str,
+        start: dict | None = None,
+        keyframe_interval: int | None = None,
+    ):
+        if os.path.exists(path):
+            self._file = open(path, "r+b")
+            self._index, index_offset = _read_index(self._file)
+            self._index.setdefault("roundWinners", [])
+            # The index gets written again after the new blocks
+            self._file.seek(index_offset)
+            self._file.truncate()
+        else:
+            assert start is not None and keyframe_interval is not None
+            self._file = open(path, "wb")
+            self._file.write(
+                REPLAY_FILE_HEADER.pack(REPLAY_FILE_MAGIC, REPLAY_FILE_VERSION)
+            )
+            self._index = {
+                "start": start,
+                "keyframeInterval": keyframe_interval,
+                "lastFrame": None,
+                "roundWinners": [],
+                "blocks": [],
+            }
+
+    def append_block(self, block: dict, last_frame: int):
+        # `last_frame` is the last frame of the replay with this block
+        data = gzip.compress(
+            json.dumps(block).encode("utf-8"), compresslevel=REPLAY_COMPRESS_LEVEL
+        )
+        self._index["blocks"].append(
+            {
+                "offset": self._file.tell(),
+                "size": len(data),
+                "firstFrame": block["keyframe"]["gameState"]["frameNumber"],
+            }
+        )
+        self._index["lastFrame"] = last_frame
+        self._file.write(data)
+
+    def add_round_winners(self, round_winners: list[list[int]]):
+        self._index["roundWinners"] += round_winners
+
+    def close(self):
+        index = json.dumps(self._index).encode("utf-8")
+        self._file.write(index)
+        self._file.write(REPLAY_FILE_TRAILER.pack(len(index), REPLAY_INDEX_MAGIC))
+        self._file.close()
+
+
+def write_replay_file(path: str, replay: dict):
+    writer = ReplayFileWriter(path, replay["start"], replay["keyframeInterval"])
+    for block in replay_blocks(replay):
+        writer.append_block(block, replay["lastFrame"])
+    writer.add_round_winners(replay.get("roundWinners", []))
+    writer.close()
+
+
+class ReplayFile:
+    # Reads blocks of a replay file on demand
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._index, _ = _read_index(self._file)
+        self._first_frames = [block["firstFrame"] for block in self._index["blocks"]]
+
+    @property
+    def start(self) -> dict:
+        return self._index["start"]
+
+    @property
+    def keyframe_interval(self) -> int:
+        return self._index["keyframeInterval"]
+
+    @property
+    def first_frame(self) -> int:
+        return self._first_frames[0]
+
+    @property
+    def last_frame(self) -> int:
+        return self._index["lastFrame"]
+
+    @property
+    def round_winners(self) -> list[list[int]]:
+        return self._index.get("roundWinners", [])
+
+    @property
+    def num_blocks(self) -> int:
+        return len(self._first_frames)
+
+    @property
+    def block_first_frames(self) -> list[int]:
+        return list(self._first_frames)
+
+    def block_index(self, frame: int) -> int:
+        # Index of the block with the frame
+        if not self.first_frame <= frame <= self.last_frame:
+            raise IndexError(
+                f"Frame {frame} not in replay ({self.first_frame} to {self.last_frame})"
+            )
+        return bisect.bisect_right(self._first_frames, frame) - 1
+
+    def block(self, index: int) -> dict:
+        block = self._index["blocks"][index]
+        self._file.seek(block["offset"])
+        return json.loads(gzip.decompress(self._file.read(block["size"])))
+
+    def replay(self) -> dict:
+        # The whole replay as recorded by the simulator
+        blocks = [self.block(i) for i in range(self.num_blocks)]
+        return {
+            "start": self.start,
+            "keyframeInterval": self.keyframe_interval,
+            "keyframes": [block["keyframe"] for block in blocks],
+            "commands": [command for block in blocks for command in block["commands"]],
+            "lastFrame": self.last_frame,
+            "roundWinners": self.round_winners,
+        }
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> "ReplayFile":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
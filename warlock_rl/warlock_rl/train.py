@@ -1,6 +1,5 @@
 import os
 
-import numpy as np
 from ray import air, tune
 from ray.air.integrations.wandb import WandbLoggerCallback
 from ray.rllib.algorithms.algorithm import Algorithm
@@ -8,22 +7,39 @@ from ray.rllib.algorithms.callbacks import DefaultCallbacks
 from ray.rllib.algorithms.ppo import PPOConfig
 from ray.rllib.core.rl_module.marl_module import MultiAgentRLModuleSpec
 from ray.rllib.core.rl_module.rl_module import SingleAgentRLModuleSpec
-from ray.rllib.examples.policy.random_policy import RandomPolicy
 from ray.rllib.examples.rl_module.random_rl_module import RandomRLModule
 from ray.rllib.models.catalog import ModelCatalog
 from ray.rllib.policy.policy import PolicySpec
 from ray.tune import CLIReporter
 
 from warlock_rl.envs import MAX_ROUNDS, WarlockEnv
-from warlock_rl.models import TorchFrameStackingModel
+from warlock_rl.league import (
+    LEAGUE_POLICY_IDS,
+    LeagueStore,
+    TimedPPOTorchPolicy,
+    TimedRandomPolicy,
+    add_snapshot,
+    inference_metrics,
+    num_snapshots,
+)
+from warlock_rl.models import TorchFrameStackingModel, TorchLeagueModel
 
 WIN_RATE_THRESHOLD = 0.95
 RANDOM_SHOP = False
+# Snapshots loaded at once on every worker, the least recently played are
+# unloaded. The league keeps all snapshots in the object store.
+LEAGUE_SIZE = 16
+LEAGUE_DTYPE = "float16"
 
 ModelCatalog.register_custom_model(
     "frame_stack_model",
     TorchFrameStackingModel,
 )
+ModelCatalog.register_custom_model("league_model", TorchLeagueModel)
+
+CUSTOM_MODEL_CONFIG = {
+    "num_frames": 16,
+}
 
 
 class SelfPlayCallback(DefaultCallbacks):
@@ -33,6 +49,11 @@ class SelfPlayCallback(DefaultCallbacks):
         # 2=2nd main policy snapshot, etc..
         self.current_opponent = 0
         self.last_changed_iter = 0
+        # Snapshots of the main policies, only used on the driver and not
+        # checkpointed (see league.py)
+        self.league_stores = {
+            policy_id: LeagueStore(LEAGUE_DTYPE) for policy_id in LEAGUE_POLICY_IDS
+        }
 
     def on_train_result(self, *, algorithm, result, **kwargs):
         result["league_size"] = self.current_opponent + 2
@@ -59,90 +80,58 @@ class SelfPlayCallback(DefaultCallbacks):
         ):
             self.last_changed_iter = algorithm.iteration
             self.current_opponent += 1
-            new_pol_id = f"main_v{self.current_opponent}"
-            print(f"adding new opponent to the mix ({new_pol_id}).")
+            print(f"adding snapshot main_v{self.current_opponent} to the league.")
 
-            # Re-define the mapping function, such that "main" is forced
-            # to play against any of the previously played policies
-            # (excluding "random").
-            def policy_mapping_fn(agent_id, episode, worker, **kwargs):
-                if isinstance(agent_id, int):
-                    return (
-                        "main"
-                        if agent_id == 0
-                        else "main_v{}".format(
-                            np.random.choice(list(range(1, self.current_opponent + 1)))
-                        )
-                    )
-                return (
-                    "main_shop"
-                    if agent_id == "shop_0" or RANDOM_SHOP
-                    else "main_v{}_shop".format(
-                        np.random.choice(list(range(1, self.current_opponent + 1)))
-                    )
-                )
-
-            main_policy = algorithm.get_policy("main")
-            main_shop_policy = algorithm.get_policy("main_shop")
-            if algorithm.config._enable_learner_api:
-                new_policy = algorithm.add_policy(
-                    policy_id=new_pol_id,
-                    policy_cls=type(main_policy),
-                    policy_mapping_fn=policy_mapping_fn,
-                    module_spec=SingleAgentRLModuleSpec.from_module(main_policy.model),
-                    action_space=WarlockEnv.round_action_space,
-                    observation_space=WarlockEnv.round_observation_space,
+            # Add the current weights of the main policies to the league,
+            # which the opponents play from now on instead of "random" (see
+            # policy_mapping_fn). The league keeps the snapshots fixed and
+            # only the "main" policies keep improving.
+            for policy_id, league_policy_id in LEAGUE_POLICY_IDS.items():
+                if policy_id == "main_shop" and RANDOM_SHOP:
+                    continue
+                add_snapshot(
+                    algorithm,
+                    self.league_stores[policy_id],
+                    league_policy_id,
+                    policy_id,
                 )
-                if not RANDOM_SHOP:
-                    new_shop_policy = algorithm.add_policy(
-                        policy_id=new_pol_id + "_shop",
-                        policy_cls=type(main_shop_policy),
-                        policy_mapping_fn=policy_mapping_fn,
-                        module_spec=SingleAgentRLModuleSpec.from_module(
-                            main_shop_policy.model
-                        ),
-                        action_space=WarlockEnv.shop_action_space,
-                        observation_space=WarlockEnv.shop_observation_space,
-                    )
-            else:
-                new_policy = algorithm.add_policy(
-                    policy_id=new_pol_id,
-                    policy_cls=type(main_policy),
-                    policy_mapping_fn=policy_mapping_fn,
-                    action_space=WarlockEnv.round_action_space,
-                    observation_space=WarlockEnv.round_observation_space,
-                )
-                if not RANDOM_SHOP:
-                    new_shop_policy = algorithm.add_policy(
-                        policy_id=new_pol_id + "_shop",
-                        policy_cls=type(main_shop_policy),
-                        policy_mapping_fn=policy_mapping_fn,
-                        action_space=WarlockEnv.shop_action_space,
-                        observation_space=WarlockEnv.shop_observation_space,
-                    )
-
-            # Set the weights of the new policy to the main policy.
-            # We'll keep training the main policy, whereas `new_pol_id` will
-            # remain fixed.
-            main_state = main_policy.get_state()
-            new_policy.set_state(main_state)
-            if not RANDOM_SHOP:
-                main_shop_state = main_shop_policy.get_state()
-                new_shop_policy.set_state(main_shop_state)
-            # We need to sync the just copied local weights (from main policy)
-            # to all the remote workers as well.
-            print("good enough; updating model ...")
-            algorithm.workers.sync_weights(timeout_seconds=10)
-            algorithm.evaluation_workers.sync_weights(timeout_seconds=10)
             print("updated!")
         else:
             print("not good enough; will keep learning ...")
 
+    def on_episode_end(self, *, worker, episode, **kwargs):
+        # Time spent computing actions per policy on the worker
+        episode.custom_metrics.update(inference_metrics(worker.policy_map))
+
 
 def policy_mapping_fn(agent_id, episode, worker, **kwargs):
+    # The opponents play the snapshots of "main" in the league once there
+    # are any, "random" before
+    league = num_snapshots(worker.policy_map["league"]) > 0
     if isinstance(agent_id, int):
-        return "main" if agent_id == 0 else "random"
-    return "main_shop" if agent_id == "shop_0" else "random_shop"
+        if agent_id == 0:
+            return "main"
+        return "league" if league else "random"
+    if agent_id == "shop_0" or (league and RANDOM_SHOP):
+        return "main_shop"
+    return "league_shop" if league else "random_shop"
+
+
+def league_policy_spec(action_space, observation_space) -> PolicySpec:
+    return PolicySpec(
+        policy_class=TimedPPOTorchPolicy,
+        action_space=action_space,
+        observation_space=observation_space,
+        config={
+            "model": {
+                "custom_model": "league_model",
+                "custom_model_config": {
+                    **CUSTOM_MODEL_CONFIG,
+                    "league_size": LEAGUE_SIZE,
+                },
+            },
+        },
+    )
 
 
 algo = (
@@ -181,9 +170,7 @@ algo = (
             # "max_seq_len": 16,
 
             "custom_model": "frame_stack_model",
-            "custom_model_config": {
-                "num_frames": 16,
-            },
+            "custom_model_config": CUSTOM_MODEL_CONFIG,
             #"vf_share_layers": True,
         },
         sgd_minibatch_size=64,
@@ -206,27 +193,37 @@ algo = (
     .multi_agent(
         policies={
             "main": PolicySpec(
+                policy_class=TimedPPOTorchPolicy,
                 action_space=WarlockEnv.round_action_space,
                 observation_space=WarlockEnv.round_observation_space,
             ),
             "main_shop": PolicySpec(
-                policy_class=RandomPolicy,
+                policy_class=TimedRandomPolicy,
                 action_space=WarlockEnv.shop_action_space,
                 observation_space=WarlockEnv.shop_observation_space,
             ) if RANDOM_SHOP else PolicySpec(
+                policy_class=TimedPPOTorchPolicy,
                 action_space=WarlockEnv.shop_action_space,
                 observation_space=WarlockEnv.shop_observation_space,
             ),
             "random": PolicySpec(
-                policy_class=RandomPolicy,
+                policy_class=TimedRandomPolicy,
                 action_space=WarlockEnv.round_action_space,
                 observation_space=WarlockEnv.round_observation_space,
             ),
             "random_shop": PolicySpec(
-                policy_class=RandomPolicy,
+                policy_class=TimedRandomPolicy,
                 action_space=WarlockEnv.shop_action_space,
                 observation_space=WarlockEnv.shop_observation_space,
             ),
+            "league": league_policy_spec(
+                WarlockEnv.round_action_space, WarlockEnv.round_observation_space
+            ),
+            **({} if RANDOM_SHOP else {
+                "league_shop": league_policy_spec(
+                    WarlockEnv.shop_action_space, WarlockEnv.shop_observation_space
+                ),
+            }),
         },
         policy_mapping_fn=policy_mapping_fn,
         policies_to_train=["main"] + ([] if RANDOM_SHOP else ["main_shop"]),
@@ -263,10 +260,21 @@ algo = (
     .callbacks(SelfPlayCallback)
     .environment(
         env=WarlockEnv,
+        env_config={
+            # "off", "vectorized" or "sampled"
+            "obs_validation": "off",
+            # Simulator processes kept started on every worker
+            "simulator_pool_size": 2,
+            # Host all envs of a worker in one simulator and step them together
+            "vector_env": True,
+            # Drop logged games rather than stall sampling when writes fall behind
+            "replay_queue_policy": "drop",
+        },
         disable_env_checking=True,  # fails with multiagent
     )
 )
 
+# Restores the policies but not the league, which starts empty again
 # algo = Algorithm.from_checkpoint("/tmp/tmpy010_u6o")
 
 callbacks = []
@@ -0,0 +1,175 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+from collections import Counter
+from typing import Iterable, Literal
+
+import ujson as json
+
+from warlock_rl.catalog import ReplayCatalog
+from warlock_rl.replay_file import write_replay_file
+
+# What to do with a replay when the queue is full
+ReplayWriterPolicy = Literal["block", "drop"]
+
+REPLAY_QUEUE_SIZE = 8
+
+
+class ReplayWriter:
+    # Writes replays into replay files (see replay_file.py) on a background
+    # thread so logging a game doesn't stall the rollout. Replays wait in a
+    # bounded queue, when it is full `write` either blocks until there is
+    # room or drops the replay. Written replays can be added to a replay
+    # catalog (see catalog.py).
+
+    def __init__(
+        self,
+        max_queue_size: int = REPLAY_QUEUE_SIZE,
+        policy: ReplayWriterPolicy = "block",
+    ):
+        assert policy in ("block", "drop")
+        self._policy = policy
+        self._queue: queue.Queue[tuple[str, bytes, str | None] | None] = queue.Queue(
+            max_queue_size
+        )
+        # Catalogs by log directory, only used by the writer thread
+        self._catalogs: dict[str, ReplayCatalog] = {}
+        self._num_written = 0
+        self._num_dropped = 0
+        self._num_failed = 0
+        # Queued replays by path so a game can wait for its own replays
+        # without waiting for the others
+        self._pending: Counter[str] = Counter()
+        self._pending_changed = threading.Condition()
+
+        self._thread = threading.Thread(
+            target=self._run, name="ReplayWriter", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def policy(self) -> ReplayWriterPolicy:
+        return self._policy
+
+    @property
+    def max_queue_size(self) -> int:
+        return self._queue.maxsize
+
+    @property
+    def num_written(self) -> int:
+        return self._num_written
+
+    @property
+    def num_dropped(self) -> int:
+        return self._num_dropped
+
+    @property
+    def num_failed(self) -> int:
+        return self._num_failed
+
+    def write(self, path: str, data: bytes, catalog_dir: str | None = None) -> bool:
+        # Queues the replay JSON to be written to the path and added to the
+        # catalog of catalog_dir, returns whether it was queued
+        with self._pending_changed:
+            self._pending[path] += 1
+
+        if self._policy == "block":
+            self._queue.put((path, data, catalog_dir))
+            return True
+
+        try:
+            self._queue.put_nowait((path, data, catalog_dir))
+            return True
+        except queue.Full:
+            self._done(path)
+            self._num_dropped += 1
+            print("Replay queue full, dropping", path)
+            return False
+
+    def _done(self, path: str):
+        with self._pending_changed:
+            self._pending[path] -= 1
+            if self._pending[path] <= 0:
+                del self._pending[path]
+            self._pending_changed.notify_all()
+
+    def is_pending(self, path: str) -> bool:
+        with self._pending_changed:
+            return path in self._pending
+
+    def _write_file(self, path: str, data: bytes, catalog_dir: str | None):
+        # Written to a temporary file first so readers never see a partial
+        # replay
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        replay = json.loads(data)
+        write_replay_file(temp_path, replay)
+        os.replace(temp_path, path)
+
+        if catalog_dir is not None:
+            try:
+                if catalog_dir not in self._catalogs:
+                    self._catalogs[catalog_dir] = ReplayCatalog(catalog_dir)
+                self._catalogs[catalog_dir].add(path, replay)
+            except sqlite3.Error as e:
+                print("Failed to add replay to catalog", e)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    for catalog in self._catalogs.values():
+                        catalog.close()
+                    return
+                self._write_file(*item)
+                self._num_written += 1
+            except Exception as e:
+                # Keep the thread alive, flush would wait for it forever
+                self._num_failed += 1
+                print("Failed to write replay", e)
+            finally:
+                if item is not None:
+                    self._done(item[0])
+                self._queue.task_done()
+
+    def flush(self):
+        # Waits until all queued replays are written
+        self._queue.join()
+
+    def wait(self, paths: Iterable[str]):
+        # Waits until the replays queued for the paths are written (or
+        # failed), the replays of other paths may still be queued
+        paths = list(paths)
+        with self._pending_changed:
+            self._pending_changed.wait_for(
+                lambda: not any(path in self._pending for path in paths)
+            )
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+_replay_writers: dict[tuple[int, ReplayWriterPolicy], ReplayWriter] = {}
+_replay_writer_lock = threading.Lock()
+
+
+def get_replay_writer(
+    max_queue_size: int | None = None, policy: ReplayWriterPolicy | None = None
+) -> ReplayWriter:
+    # The writer shared by all games of this process with the same queue
+    # size and policy, flushed on exit. Envs with different configs get
+    # their own writers instead of changing each other's.
+    key = (
+        REPLAY_QUEUE_SIZE if max_queue_size is None else max_queue_size,
+        "block" if policy is None else policy,
+    )
+    with _replay_writer_lock:
+        if key not in _replay_writers:
+            _replay_writers[key] = ReplayWriter(*key)
+            atexit.register(_replay_writers[key].flush)
+        return _replay_writers[key]